@@ -22,53 +22,120 @@ import labscript_devices.atsapi as ats
 tqdm_kwargs = {'file': sys.stdout, 'ascii': False, 'ncols': 80}
 
 # Talk mv to card set range
-# All ATS ranges given below,
-# but have commented out the ones that don't work with our ATS9462
+# All ATS ranges given below. Those supported by each board are listed in atsBoardCapabilities.
 atsRanges = {
-    # 40: ats.INPUT_RANGE_PM_40_MV,
-    # 50: ats.INPUT_RANGE_PM_50_MV,
-    # 80: ats.INPUT_RANGE_PM_80_MV,
-    # 100: ats.INPUT_RANGE_PM_100_MV,
+    40: ats.INPUT_RANGE_PM_40_MV,
+    50: ats.INPUT_RANGE_PM_50_MV,
+    80: ats.INPUT_RANGE_PM_80_MV,
+    100: ats.INPUT_RANGE_PM_100_MV,
+    125: ats.INPUT_RANGE_PM_125_MV,
     200: ats.INPUT_RANGE_PM_200_MV,
+    250: ats.INPUT_RANGE_PM_250_MV,
     400: ats.INPUT_RANGE_PM_400_MV,
-    # 500: ats.INPUT_RANGE_PM_500_MV,
+    500: ats.INPUT_RANGE_PM_500_MV,
     800: ats.INPUT_RANGE_PM_800_MV,
-    # 1000: ats.INPUT_RANGE_PM_1_V,
+    1000: ats.INPUT_RANGE_PM_1_V,
+    1250: ats.INPUT_RANGE_PM_1_V_25,
     2000: ats.INPUT_RANGE_PM_2_V,
+    2500: ats.INPUT_RANGE_PM_2_V_5,
     4000: ats.INPUT_RANGE_PM_4_V,
-    # 5000: ats.INPUT_RANGE_PM_5_V,
-    # 8000: ats.INPUT_RANGE_PM_8_V,
-    # 10000: ats.INPUT_RANGE_PM_10_V,
-    # 20000: ats.INPUT_RANGE_PM_20_V,
-    # 40000: ats.INPUT_RANGE_PM_40_V,
-    # 16000: ats.INPUT_RANGE_PM_16_V,
-    # 1250: ats.INPUT_RANGE_PM_1_V_25,
-    # 2500: ats.INPUT_RANGE_PM_2_V_5,
-    # 125: ats.INPUT_RANGE_PM_125_MV,
-    # 250: ats.INPUT_RANGE_PM_250_MV
+    5000: ats.INPUT_RANGE_PM_5_V,
+    8000: ats.INPUT_RANGE_PM_8_V,
+    10000: ats.INPUT_RANGE_PM_10_V,
+    16000: ats.INPUT_RANGE_PM_16_V,
+    20000: ats.INPUT_RANGE_PM_20_V,
+    40000: ats.INPUT_RANGE_PM_40_V,
 }
 
 atsSampleRates = {
-    1000:      ats.SAMPLE_RATE_1KSPS,
-    2000:      ats.SAMPLE_RATE_2KSPS,
-    5000:      ats.SAMPLE_RATE_5KSPS,
-    10000:     ats.SAMPLE_RATE_10KSPS,
-    20000:     ats.SAMPLE_RATE_20KSPS,
-    50000:     ats.SAMPLE_RATE_50KSPS,
-    100000:    ats.SAMPLE_RATE_100KSPS,
-    200000:    ats.SAMPLE_RATE_200KSPS,
-    500000:    ats.SAMPLE_RATE_500KSPS,
-    1000000:   ats.SAMPLE_RATE_1MSPS,
-    2000000:   ats.SAMPLE_RATE_2MSPS,
-    5000000:   ats.SAMPLE_RATE_5MSPS,
-    10000000:  ats.SAMPLE_RATE_10MSPS,
-    20000000:  ats.SAMPLE_RATE_20MSPS,
-    25000000:  ats.SAMPLE_RATE_25MSPS,
-    50000000:  ats.SAMPLE_RATE_50MSPS,
-    100000000: ats.SAMPLE_RATE_100MSPS,
-    125000000: ats.SAMPLE_RATE_125MSPS,
-    160000000: ats.SAMPLE_RATE_160MSPS,
-    180000000: ats.SAMPLE_RATE_180MSPS
+    1000:       ats.SAMPLE_RATE_1KSPS,
+    2000:       ats.SAMPLE_RATE_2KSPS,
+    5000:       ats.SAMPLE_RATE_5KSPS,
+    10000:      ats.SAMPLE_RATE_10KSPS,
+    20000:      ats.SAMPLE_RATE_20KSPS,
+    50000:      ats.SAMPLE_RATE_50KSPS,
+    100000:     ats.SAMPLE_RATE_100KSPS,
+    200000:     ats.SAMPLE_RATE_200KSPS,
+    500000:     ats.SAMPLE_RATE_500KSPS,
+    1000000:    ats.SAMPLE_RATE_1MSPS,
+    2000000:    ats.SAMPLE_RATE_2MSPS,
+    5000000:    ats.SAMPLE_RATE_5MSPS,
+    10000000:   ats.SAMPLE_RATE_10MSPS,
+    20000000:   ats.SAMPLE_RATE_20MSPS,
+    25000000:   ats.SAMPLE_RATE_25MSPS,
+    50000000:   ats.SAMPLE_RATE_50MSPS,
+    100000000:  ats.SAMPLE_RATE_100MSPS,
+    125000000:  ats.SAMPLE_RATE_125MSPS,
+    160000000:  ats.SAMPLE_RATE_160MSPS,
+    180000000:  ats.SAMPLE_RATE_180MSPS,
+    200000000:  ats.SAMPLE_RATE_200MSPS,
+    250000000:  ats.SAMPLE_RATE_250MSPS,
+    400000000:  ats.SAMPLE_RATE_400MSPS,
+    500000000:  ats.SAMPLE_RATE_500MSPS,
+    800000000:  ats.SAMPLE_RATE_800MSPS,
+    1000000000: ats.SAMPLE_RATE_1000MSPS,
+    1200000000: ats.SAMPLE_RATE_1200MSPS,
+    1500000000: ats.SAMPLE_RATE_1500MSPS,
+    1800000000: ats.SAMPLE_RATE_1800MSPS,
+}
+
+# Channels of a board, in the order their samples are interleaved in DMA buffers:
+atsChannels = [('A', ats.CHANNEL_A), ('B', ats.CHANNEL_B), ('C', ats.CHANNEL_C), ('D', ats.CHANNEL_D)]
+
+# What each supported board can do, from the datasheets. This drives clock selection, input range
+# checking, and buffer geometry, so supporting another board should only need an entry here.
+#   internal_sample_rates: rates in samples per second available from the internal clock,
+#                          each of which must be in atsSampleRates.
+#   input_ranges:          input ranges in millivolts, each of which must be in atsRanges.
+#   reference_clocks:      sample clocks the PLL can generate from a 10 MHz reference, which
+#                          may then be divided by up to max_divisor.
+#   bits_per_sample:       ADC resolution. Samples are transferred in bytes_per_sample bytes,
+#                          left justified, so the resolution doesn't affect conversion to volts.
+#   record_alignment:      samples per record (and so per buffer) must be a multiple of this.
+# On-board memory is not listed, as it depends on the memory option fitted and is queried from
+# the board. It is not used when streaming.
+meg = 1000000
+atsBoardCapabilities = {
+    'ATS9462': {
+        'num_channels': 2,
+        'bits_per_sample': 16,
+        'bytes_per_sample': 2,
+        'internal_sample_rates': [r for r in atsSampleRates if r <= 180*meg],
+        'input_ranges': [200, 400, 800, 2000, 4000],
+        'reference_clocks': list(range(150*meg, 181*meg, 1*meg)),
+        'max_divisor': 10000,
+        'record_alignment': 16,
+    },
+    'ATS9440': {
+        'num_channels': 4,
+        'bits_per_sample': 14,
+        'bytes_per_sample': 2,
+        'internal_sample_rates': [r for r in atsSampleRates if r <= 125*meg],
+        'input_ranges': [100, 200, 400, 1000, 2000, 4000],
+        'reference_clocks': [100*meg, 125*meg],
+        'max_divisor': 10000,
+        'record_alignment': 32,
+    },
+    'ATS9360': {
+        'num_channels': 2,
+        'bits_per_sample': 12,
+        'bytes_per_sample': 2,
+        'internal_sample_rates': [r for r in atsSampleRates if r <= 1800*meg],
+        'input_ranges': [400],
+        'reference_clocks': list(range(300*meg, 1801*meg, 1*meg)),
+        'max_divisor': 10000,
+        'record_alignment': 128,
+    },
+    'ATS9870': {
+        'num_channels': 2,
+        'bits_per_sample': 8,
+        'bytes_per_sample': 1,
+        'internal_sample_rates': [r for r in atsSampleRates if r <= 1000*meg],
+        'input_ranges': [40, 50, 80, 100, 200, 400, 500, 800, 1000, 2000, 4000],
+        'reference_clocks': [1000*meg],
+        'max_divisor': 10000,
+        'record_alignment': 64,
+    },
 }
 
 atsExternalClockAdvice = {
@@ -89,8 +156,7 @@ class AlazarTechBoard(Device):
 # Anything to do with board memory
 # Anything "for scanning"
     @set_passed_properties(property_names={
-        "device_properties": ["ats_system_id", "ats_board_id",
-                              "requested_acquisition_rate", "acquisition_duration",
+        "device_properties": ["requested_acquisition_rate", "acquisition_duration",
                               "clock_source_id", "sample_rate_id_or_value", "clock_edge_id", "decimation",
                               "trig_operation",
                               "trig_engine_id1", "trig_source_id1", "trig_slope_id1",  "trig_level_id1",
@@ -99,11 +165,17 @@ class AlazarTechBoard(Device):
                               "trig_delay_samples", "trig_timeout_10usecs", "input_range",
                               "channels",
                               "chA_coupling_id", "chA_input_range", "chA_impedance_id", "chA_bw_limit",
-                              "chB_coupling_id", "chB_input_range", "chB_impedance_id", "chB_bw_limit"
-                              ]
+                              "chB_coupling_id", "chB_input_range", "chB_impedance_id", "chB_bw_limit",
+                              "chC_coupling_id", "chC_input_range", "chC_impedance_id", "chC_bw_limit",
+                              "chD_coupling_id", "chD_input_range", "chD_impedance_id", "chD_bw_limit",
+                              "store_volts", "store_raw", "dsp_stages"
+                              ],
+        "connection_table_properties": ["ats_system_id", "ats_board_id", "slave_board_ids",
+                                        "buffer_count", "samples_per_buffer", "scratch_directory", "dsp_threads"]
     })
     def __init__(self, name, server,
                  ats_system_id=1, ats_board_id=1,
+                 slave_board_ids         = [], # Boards of the same system, synchronised to this one through a SyncBoard
                  requested_acquisition_rate=0, # No default for this, must be calculated and set!
                  acquisition_duration    = 1,  # In seconds. This should be set up by .acquire calls, but too bad for now.
                  clock_source_id         = ats.INTERNAL_CLOCK,
@@ -131,7 +203,35 @@ class AlazarTechBoard(Device):
                  chB_coupling_id         = ats.AC_COUPLING,
                  chB_input_range         = 4000,
                  chB_impedance_id        = ats.IMPEDANCE_1M_OHM,
-                 chB_bw_limit            = 0):
+                 chB_bw_limit            = 0,
+                 chC_coupling_id         = ats.AC_COUPLING, # Channels C and D are only used with four channel boards
+                 chC_input_range         = 4000,
+                 chC_impedance_id        = ats.IMPEDANCE_1M_OHM,
+                 chC_bw_limit            = 0,
+                 chD_coupling_id         = ats.AC_COUPLING,
+                 chD_input_range         = 4000,
+                 chD_impedance_id        = ats.IMPEDANCE_1M_OHM,
+                 chD_bw_limit            = 0,
+                 store_volts             = True,   # If False, save only raw samples. Use get_volts() to read them as volts.
+                 store_raw               = True,   # If False, save only the products of dsp_stages
+                 dsp_stages              = None,   # List of dicts configuring processing, see dsp_stage_types
+                 buffer_count            = 16,     # Number of DMA buffers in the ring, allocated once by BLACS
+                 samples_per_buffer      = 204800, # Samples per channel in each DMA buffer
+                 scratch_directory       = None,   # Where to stream samples during a shot. Default: system temp directory
+                 dsp_threads             = None):  # Threads processing dsp_stages. Default: number of CPUs
+        for input_range in [chA_input_range, chB_input_range, chC_input_range, chD_input_range]:
+            if input_range not in atsRanges:
+                raise LabscriptError("Input range {:s} is not recognised. Make sure you use millivolts, one of {:s}.".format(
+                    repr(input_range), ', '.join(map(str, sorted(atsRanges)))))
+        if ats_board_id in slave_board_ids:
+            raise LabscriptError("Board {:d} can't be its own slave".format(ats_board_id))
+        for parameters in dsp_stages or []:
+            try:
+                stage_type = dsp_stage_types[parameters['type']]
+            except KeyError:
+                raise LabscriptError("DSP stage {:s} must have a 'type' out of {:s}".format(
+                    repr(parameters), ', '.join(sorted(dsp_stage_types))))
+            stage_type.check_parameters(parameters)
         Device.__init__(self, name, None, None)
         self.name = name
         # This line makes BLACS think the device is connected to something
@@ -173,12 +273,198 @@ class AlazarTechBoard(Device):
                 input_attrs), location='device_properties')
 
 
+def raw_to_volts(raw, input_range, bits_per_sample=16):
+    """Convert raw sample codes to volts, given the input range in millivolts"""
+    offset = float(2**(bits_per_sample-1))
+    return (np.asarray(raw, np.float32)-offset)/offset * input_range * 0.001
+
+
+class LazyVolts(object):
+    """Read-only view of a rawsamples dataset saved by AlazarTechBoard, returning
+    volts when sliced. Only the samples requested are read and converted"""
+    def __init__(self, raw_dataset):
+        self.raw_dataset = raw_dataset
+        # As Python scalars, so as not to promote the result to float64:
+        self.input_range = raw_dataset.attrs['input_range'].item()
+        self.bits_per_sample = raw_dataset.attrs['bits_per_sample'].item()
+        self.shape = raw_dataset.shape
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.raw_dataset)
+
+    def __getitem__(self, key):
+        return raw_to_volts(self.raw_dataset[key], self.input_range, self.bits_per_sample)
+
+
+def get_volts(hdf5_file, device_name, channel):
+    """Return the trace of channel 'A' or 'B' of the named device in a shot file, in
+    volts. This is the saved volts dataset if there is one, otherwise a LazyVolts
+    view of the raw samples. Either is read from the file only when sliced"""
+    group = hdf5_file['/data/traces/'+device_name]
+    if 'channel'+channel in group:
+        return group['channel'+channel]
+    return LazyVolts(group['rawsamples'+channel])
+
+
+class DSPStage(object):
+    """Processing of an acquisition whilst it is in progress, saving reduced products in
+    place of, or alongside, the raw samples. Stages are configured with a dict of
+    parameters in the dsp_stages property of AlazarTechBoard, whose 'type' is a key of
+    dsp_stage_types. Adding a subclass to dsp_stage_types makes it available.
+
+    The acquisition is processed in blocks of whole segments of segment_length samples,
+    in a pool of threads, so process() must only write results for the given block."""
+    required_parameters = []
+
+    def __init__(self, parameters, sample_rate, channels, n_samples):
+        # channels is a list of (name, input_range, bits_per_sample) of acquired channels:
+        self.parameters = parameters
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.n_samples = n_samples
+        self.segment_length = 1
+
+    @classmethod
+    def check_parameters(cls, parameters):
+        for name in cls.required_parameters:
+            if name not in parameters:
+                raise LabscriptError("DSP stage of type '{:s}' requires parameter '{:s}'".format(
+                    parameters['type'], name))
+
+    @property
+    def n_segments(self):
+        return self.n_samples // self.segment_length
+
+    def volts(self, raw, column):
+        name, input_range, bits_per_sample = self.channels[column]
+        return raw_to_volts(raw[:, column], input_range, bits_per_sample)
+
+    def process(self, start, raw):
+        """Process raw samples of all channels, of shape (n_samples, n_channels),
+        starting at sample index start, a multiple of segment_length"""
+        raise NotImplementedError
+
+    def save(self, group):
+        """Save the products to the given group of the shot file"""
+        raise NotImplementedError
+
+
+class DigitalDownconverter(DSPStage):
+    """Mixes each channel with a local oscillator at 'frequency' (Hz) and averages over
+    'decimation' samples (default 1). Saves the amplitude (V) and phase (rad) of the
+    signal at that frequency as ddc_amplitudeX and ddc_phaseX."""
+    required_parameters = ['frequency']
+
+    def __init__(self, parameters, sample_rate, channels, n_samples):
+        DSPStage.__init__(self, parameters, sample_rate, channels, n_samples)
+        self.frequency = parameters['frequency']
+        self.segment_length = int(parameters.get('decimation', 1))
+        self.iq = np.zeros((self.n_segments, len(channels)), dtype=np.complex64)
+        # The local oscillator over a segment starting at phase zero. Mixing and averaging
+        # a segment is then a dot product with this, times the local oscillator at its start:
+        cycles = np.arange(self.segment_length) * (self.frequency / self.sample_rate)
+        self.segment_cos = np.cos(2 * np.pi * cycles).astype(np.float32)
+        self.segment_sin = np.sin(2 * np.pi * cycles).astype(np.float32)
+
+    def process(self, start, raw):
+        # Cycles of the local oscillator at the start of each segment, modulo 1 so as to
+        # retain precision late in long acquisitions:
+        segment_starts = np.arange(start, start + len(raw), self.segment_length)
+        cycles = (segment_starts * (self.frequency / self.sample_rate)) % 1.0
+        start_phase = np.exp(-2j * np.pi * cycles)
+        segments = slice(start // self.segment_length, (start + len(raw)) // self.segment_length)
+        for column in range(len(self.channels)):
+            volts = self.volts(raw, column).reshape(-1, self.segment_length)
+            mixed = volts.dot(self.segment_cos) - 1j * volts.dot(self.segment_sin)
+            # Factor of two for the power in the negative frequency component:
+            self.iq[segments, column] = 2 * start_phase * mixed / self.segment_length
+
+    def save(self, group):
+        for column, (name, input_range, bits_per_sample) in enumerate(self.channels):
+            for product, data in [('ddc_amplitude', np.abs(self.iq[:, column])),
+                                  ('ddc_phase', np.angle(self.iq[:, column]))]:
+                dset = group.create_dataset(product+name, data=data.astype(np.float32))
+                dset.attrs['frequency'] = self.frequency
+                dset.attrs['sample_interval'] = self.segment_length / self.sample_rate
+
+
+class BoxcarAverager(DSPStage):
+    """Averages each channel over consecutive, non-overlapping windows of 'length'
+    samples. Saves the averages (V) as boxcarX."""
+    required_parameters = ['length']
+
+    def __init__(self, parameters, sample_rate, channels, n_samples):
+        DSPStage.__init__(self, parameters, sample_rate, channels, n_samples)
+        self.segment_length = int(parameters['length'])
+        self.averages = np.zeros((self.n_segments, len(channels)), dtype=np.float32)
+
+    def process(self, start, raw):
+        segments = slice(start // self.segment_length, (start + len(raw)) // self.segment_length)
+        for column in range(len(self.channels)):
+            volts = self.volts(raw, column)
+            self.averages[segments, column] = volts.reshape(-1, self.segment_length).mean(axis=1)
+
+    def save(self, group):
+        for column, (name, input_range, bits_per_sample) in enumerate(self.channels):
+            dset = group.create_dataset('boxcar'+name, data=self.averages[:, column])
+            dset.attrs['sample_interval'] = self.segment_length / self.sample_rate
+
+
+class SegmentedFFT(DSPStage):
+    """Computes the magnitude of the FFT of each consecutive segment of 'segment_length'
+    samples of each channel, with a 'window' of 'hann' (default) or 'rectangular'.
+    Magnitudes are scaled to the amplitude (V) of a sinusoid at the centre of a bin.
+    Saves them as fft_magnitudeX, of shape (n_segments, segment_length // 2 + 1)."""
+    required_parameters = ['segment_length']
+    windows = {'hann': np.hanning, 'rectangular': np.ones}
+
+    @classmethod
+    def check_parameters(cls, parameters):
+        super(SegmentedFFT, cls).check_parameters(parameters)
+        if parameters.get('window', 'hann') not in cls.windows:
+            raise LabscriptError("FFT window must be one of {:s}".format(', '.join(sorted(cls.windows))))
+
+    def __init__(self, parameters, sample_rate, channels, n_samples):
+        DSPStage.__init__(self, parameters, sample_rate, channels, n_samples)
+        self.segment_length = int(parameters['segment_length'])
+        self.window = self.windows[parameters.get('window', 'hann')](self.segment_length).astype(np.float32)
+        self.scale = 2 / self.window.sum()
+        self.magnitudes = np.zeros((len(channels), self.n_segments, self.segment_length // 2 + 1),
+                                   dtype=np.float32)
+
+    def process(self, start, raw):
+        segments = slice(start // self.segment_length, (start + len(raw)) // self.segment_length)
+        for column in range(len(self.channels)):
+            volts = self.volts(raw, column).reshape(-1, self.segment_length)
+            spectra = np.fft.rfft(volts * self.window, axis=1)
+            self.magnitudes[column, segments] = np.abs(spectra) * self.scale
+
+    def save(self, group):
+        for column, (name, input_range, bits_per_sample) in enumerate(self.channels):
+            dset = group.create_dataset('fft_magnitude'+name, data=self.magnitudes[column])
+            dset.attrs['frequency_spacing'] = self.sample_rate / self.segment_length
+            dset.attrs['segment_interval'] = self.segment_length / self.sample_rate
+
+
+dsp_stage_types = {
+    'ddc': DigitalDownconverter,
+    'boxcar': BoxcarAverager,
+    'fft': SegmentedFFT,
+}
+
+
 from labscript_devices import BLACS_tab
 from blacs.tab_base_classes import Worker, define_state
 from blacs.tab_base_classes import MODE_MANUAL, MODE_TRANSITION_TO_BUFFERED, MODE_TRANSITION_TO_MANUAL, MODE_BUFFERED
 from blacs.device_base_class import DeviceTab
 import os
 import copy
+import tempfile
+if PY2:
+    from Queue import Empty
+else:
+    from queue import Empty
 
 # A BLACS tab for a purely remote device which does not need configuration of parameters in BLACS
 
@@ -195,14 +481,25 @@ class GuilessTab(DeviceTab):
         pass
 
     def initialise_workers(self):
+        connection_table_properties = self.settings['connection_table'].find_by_name(
+            self.device_name).properties
+        worker_kwargs = {
+            'ats_system_id': connection_table_properties.get('ats_system_id', 1),
+            'ats_board_id': connection_table_properties.get('ats_board_id', 1),
+            'slave_board_ids': connection_table_properties.get('slave_board_ids', []),
+            'buffer_count': connection_table_properties.get('buffer_count', 16),
+            'samples_per_buffer': connection_table_properties.get('samples_per_buffer', 204800),
+            'scratch_directory': connection_table_properties.get('scratch_directory', None),
+            'dsp_threads': connection_table_properties.get('dsp_threads', None),
+        }
         # Create and set the primary worker
-        self.create_worker("main_worker", GuilessWorker, {})
+        self.create_worker("main_worker", GuilessWorker, worker_kwargs)
         self.primary_worker = "main_worker"
 
 # Helper functions that don't need to be class methods
 def find_nearest_internal_clock(array, value):
     if not isinstance(array, np.ndarray):
-        array = np.array(array)
+        array = np.array(list(array))
     ix = np.abs(array - value).argmin()
     return array[ix]
 
@@ -221,45 +518,62 @@ def find_clock_and_r(f, clocks):
     return bestopt['clock'], bestopt['div']
 
 
-def ats9462_clock(f):
-    # Finds the clock and divider settings to best achieve sample rate f
+def select_internal_clock(capabilities, f):
+    # Finds the internal clock of a board nearest to sample rate f
+    # Returns (sample rate, sample rate ID)
+    rate = int(find_nearest_internal_clock(capabilities['internal_sample_rates'], f))
+    return rate, atsSampleRates[rate]
+
+
+def select_reference_clock(capabilities, f):
+    # Finds the clock and divider settings to best achieve sample rate f, for a board
+    # clocked from an external 10MHz reference.
     # If it can't be achieved, find nearest possible clock that is faster
     # ... and warn the user that we have done this.
     # Returns (PLL clock, divider)
-    meg = 1000000
-    rlimit = 10000
-    clocks_allowed = np.arange(150*meg, 181*meg, 1*meg)
-    clock, divider = find_clock_and_r(f, clocks_allowed)
+    rlimit = capabilities['max_divisor']
+    clock, divider = find_clock_and_r(f, np.array(capabilities['reference_clocks']))
     if divider > rlimit:
         raise LabscriptError(
             "Required clock divisor {:d} exceeds maximum value of {:d}".format(divider, rlimit))
+    if divider < 1:
+        raise LabscriptError(
+            "Requested sample rate {:f} SPS exceeds the maximum of {:d} SPS".format(f, max(capabilities['reference_clocks'])))
     if clock % divider != 0:
         warning = "Warning: Couldn't match requested sample rate {:f} SPS! Using the slightly greater value of {:d} SPS...".format(
             f, clock//divider)
         print(warning, file=sys.stderr)
     return clock, divider
 
+
+def ats9462_clock(f):
+    # Kept for backward compatibility
+    return select_reference_clock(atsBoardCapabilities['ATS9462'], f)
+
 # As a substitute for real documentation, here's an outline for what the Alazar worker does.
 # This should be sphinx'ed or whatever.
 # The main thread in init() kicks off a long-lived (as long as the main thread) "acquisition thread", running acquisition_loop()
 # The acquisition thread is an infinite loop, at the top of which it immediately waits on the acquisition_queue.
 # This is where we are when BLACS is 'idle'.
 # *** How it SHOULD operate:
-# At transition_to_buffered, the main thread sets up the card params and the acquisition buffers, and just before returning sends a 'start' down the queue to the acq thread.
-# The acquisition thread proceeds to the blocking waitNextAsyncBufferComplete() call, which waits for the first buffer to be filled.
-# All being well, the buffers are filled in sequence and the acquisition thread set the acqusition_done flag,
+# A ring of DMA buffers is allocated once in init() and reused by every shot. A second long-lived "consumer thread", running consumer_loop(), saves the
+# contents of completed buffers to a memory-mapped scratch file, so that neither page-locked memory nor RAM limit the length of an acquisition.
+# At transition_to_buffered, the main thread sets up the card params and the scratch file, posts the ring of buffers to the board, starts the capture, and just before returning sends a 'start' down the queue to the acq thread.
+# The acquisition thread proceeds to the blocking waitAsyncBufferComplete() call, which waits for the first buffer to be filled.
+# All being well, the buffers are filled in sequence. The acquisition thread passes each completed buffer to the consumer thread, and reposts buffers to the board
+# as the consumer thread finishes saving them. Once all buffers of the acquisition are complete, it sets the acqusition_done flag,
 # and continues to the top of its loop, waiting for the next 'start' command down the queue.
 # Eventually it's transition_to_manual time, and starts by checking the 'acquisition_done' flag via wait_acquisition_complete(), with a short timeout of 2 seconds.
-# If the acquisition is actually done, the flag is cleared, and it proceeds to write the buffers into the h5 file and free them, returning.
+# If the acquisition is actually done, the flag is cleared, and it waits for the consumer thread to save the remaining buffers, copies the scratch file into the h5 file and deletes it, returning.
 # We are back in BLACS-idle, with the acquisition thread waiting for a 'start' command again.
 # *** What happens if the trigger isn't sent
-# In the acquisition thread, the call to waitNextAsyncBufferComplete() eventually times out, generating an exception.
+# In the acquisition thread, the call to waitAsyncBufferComplete() eventually times out, generating an exception.
 # This timout is set to 60s (and should be set to experiment_duration), but has no way of knowing when in the experiment the acquisition started, so it will likely
 # not time out until well after transition_to_manual is called.
 # Transition_to_manual gets called, finds the acquisition_done flag is low, times out quickly (2s) waiting for this, and raises an exception 'Waiting for acquisition to complete timed out'
 # This exception kills the main thread, which should lead to the death of the acquisition thread too, but it is still blocking.
 # Eventually the acquisition thread would time out and die with an AlazarException (code ApiWaitTimeout). But rather than waiting for this, we call abortAsyncRead() from the main thread.
-# This forces the waitNextAsyncBufferComplete() to return, with an ApiDmaCalled error code in the AlazarException. This is caught and the acquisition thread continues, but not for long...
+# This forces the waitAsyncBufferComplete() to return, with an ApiDmaCalled error code in the AlazarException. This is caught and the acquisition thread continues, but not for long...
 # Unless this was caused by an abort, the demise of the main thread causes the acquisition thread to be collected.
 # At this point, everything in the worker is dead and restart is clean.
 # *** What happens if an abort is sent:
@@ -271,6 +585,9 @@ def ats9462_clock(f):
 
 
 class GuilessWorker(Worker):
+    # Samples per channel written to the shot file at once, to limit memory use
+    samples_per_write = 2**22
+
     def init(self):
         global h5py
         import labscript_utils.h5_lock
@@ -287,30 +604,55 @@ class GuilessWorker(Worker):
         self.sdk_version_string = '.'.join(map(str, self.sdk_version))
         print("AlazarTech SDK version {:s}".format(self.sdk_version_string))
 
-        # Board init, hard-coded again for now
-        system_id = 1
-        board_id = 1
-        self.board = board = ats.Board(systemId=system_id, boardId=board_id)
+        # Board init. Slave boards are clocked and triggered by the master through a SyncBoard,
+        # and are acquired from along with it.
+        system_id = self.ats_system_id
+        board_ids = [self.ats_board_id] + list(self.slave_board_ids)
+        self.boards = [ats.Board(systemId=system_id, boardId=board_id) for board_id in board_ids]
+        self.board = board = self.boards[0]
         #self.driver_version = ats.getDriverVersion()
         #self.driver_version_string = '.'.join(map(str, self.driver_version))
         self.driver_version_string = '(unknown)'
 
         self.board_name = ats.boardNames[self.board.type]
-        assert self.board_name == "ATS9462",\
-            "This labscript device driver only supports the ATS9462 board at present."
-        assert board.num_channels == 2,\
-            "This labscript device driver only support two channel boards at present."
-
-        print("Initialised AlazarTech {:s} (SN {:d}) connected as system {:d}, board {:d}.".
-              format(self.board_name, board.serial_number, system_id, board_id))
-        print("Hardware revision {:s}, driver version {:s}, CPLD version {:s}.".
-              format(board.revision_string, self.driver_version_string, board.cpld_version_string))
-        # For some reason can't make the API return these from queryCapability, but can get all the others.
-        # Particularly odd because it works in C!
-        #print("PCIe connection width {:d}, speed {:d}".format(board.pcie_link_speed, board.pcie_link_width))
-        print("{:d} channels. Board memory {:d}, quantising {:d} bits per sample.".format(
-            board.num_channels, board.memorysize_samples, board.bits_per_sample))
-        board.abortAsyncRead()
+        try:
+            self.capabilities = atsBoardCapabilities[self.board_name]
+        except KeyError:
+            raise LabscriptError("This labscript device driver does not support the {:s} board. Supported boards are {:s}.".format(
+                self.board_name, ', '.join(sorted(atsBoardCapabilities))))
+        for slave, board_id in zip(self.boards[1:], board_ids[1:]):
+            if slave.type != board.type:
+                raise LabscriptError("Slave board {:d} is an {:s}, but must be the same model as the master, an {:s}.".format(
+                    board_id, ats.boardNames[slave.type], self.board_name))
+
+        for b, board_id in zip(self.boards, board_ids):
+            print("Initialised AlazarTech {:s} (SN {:d}) connected as system {:d}, board {:d}{:s}.".
+                  format(self.board_name, b.serial_number, system_id, board_id, ' (slave)' if b is not board else ''))
+            print("Hardware revision {:s}, driver version {:s}, CPLD version {:s}.".
+                  format(b.revision_string, self.driver_version_string, b.cpld_version_string))
+            # For some reason can't make the API return these from queryCapability, but can get all the others.
+            # Particularly odd because it works in C!
+            #print("PCIe connection width {:d}, speed {:d}".format(board.pcie_link_speed, board.pcie_link_width))
+            print("{:d} channels. Board memory {:d}, quantising {:d} bits per sample.".format(
+                b.num_channels, b.memorysize_samples, b.bits_per_sample))
+            b.abortAsyncRead()
+
+        # Allocate a ring of DMA buffers for each board once, large enough for all channels.
+        # They are kept for the lifetime of the worker:
+        alignment = self.capabilities['record_alignment']
+        self.samplesPerBuffer = -(-self.samples_per_buffer // alignment) * alignment
+        if self.samplesPerBuffer != self.samples_per_buffer:
+            print("Rounded samples per buffer up to {:d}, a multiple of {:d} as required by the {:s}.".format(
+                self.samplesPerBuffer, alignment, self.board_name))
+        self.bytesPerDatum = self.capabilities['bytes_per_sample']
+        self.sample_dtype = {1: np.uint8, 2: np.uint16}[self.bytesPerDatum]
+        sample_type = {1: ctypes.c_uint8, 2: ctypes.c_uint16}[self.bytesPerDatum]
+        self.bytesPerBufferAllocated = self.bytesPerDatum * self.capabilities['num_channels'] * self.samplesPerBuffer
+        print("Allocating {:d} DMA buffers of {:d} bytes per board... ".format(
+            self.buffer_count, self.bytesPerBufferAllocated), end='')
+        self.buffers = [[ats.DMABuffer(sample_type, self.bytesPerBufferAllocated) for i in range(self.buffer_count)]
+                        for b in self.boards]
+        print('done.')
 
         # Multiprocessing init
         self.acquisition_queue = Queue()
@@ -322,6 +664,23 @@ class GuilessWorker(Worker):
         self.acquisition_thread.start()
         self.aborting = False
 
+        # Completed buffers are passed to the consumer thread by index in the
+        # acquisition, and handed back once saved so that they can be reposted:
+        self.completed_buffers = Queue()
+        self.free_buffers = Queue()
+        self.consumer_thread = threading.Thread(target=self.consumer_loop)
+        self.consumer_thread.daemon = True
+        self.consumer_exception = None
+        self.consumer_thread.start()
+        self.scratch = None
+        self.scratch_filepath = None
+
+        # Threads processing DSP stages as buffers are saved to the scratch file:
+        from multiprocessing.pool import ThreadPool
+        self.dsp_pool = ThreadPool(self.dsp_threads)
+        self.dsp_stages = []
+        self.dsp_results = []
+
     def transition_to_buffered(self, device_name, h5file, initial_values, fresh):
         self.h5file = h5file  # We'll need this in transition_to_manual
         self.device_name = device_name
@@ -336,17 +695,16 @@ class GuilessWorker(Worker):
         clock_edge_id = atsparam['clock_edge_id']
         if clock_source_id == ats.INTERNAL_CLOCK:
             # Actually we should find smallest internal clock faster than the one asked for. Next time.
-            actual_acquisition_rate = find_nearest_internal_clock(
-                atsSampleRates.keys(), requested_acquisition_rate)
             # This is an ID not a sample per sec. It takes both.
-            atsSamplesPerSec_or_id = atsSampleRates[actual_acquisition_rate]
+            actual_acquisition_rate, atsSamplesPerSec_or_id = select_internal_clock(
+                self.capabilities, requested_acquisition_rate)
             decimation = 0  # Must be zero for internal clocking
             clock_edge_id = ats.CLOCK_EDGE_RISING
             print('Internal clocking at {:.0f} samples per second ({:.1f} MS/s), from internal reference.'.
                   format(actual_acquisition_rate, actual_acquisition_rate/1e6))
         elif clock_source_id == ats.EXTERNAL_CLOCK_10MHz_REF:
-            atsSamplesPerSec_or_id, divisor = ats9462_clock(
-                requested_acquisition_rate)
+            atsSamplesPerSec_or_id, divisor = select_reference_clock(
+                self.capabilities, requested_acquisition_rate)
             actual_acquisition_rate = atsSamplesPerSec_or_id // divisor
             decimation = divisor - 1
             clock_edge_id = ats.CLOCK_EDGE_RISING
@@ -371,6 +729,7 @@ class GuilessWorker(Worker):
             raise LabscriptError("Requested capture clock type with code {:d} is not recognised".format(
                 atsparam['clock_source_id']))
         # The clock_edge_id parameter is not needed for INTERNAL_CLOCK and EXTERNAL_CLOCK_10MHz_REF modes but is here for future extension
+        # Clock and trigger are only configured on the master. Slaves receive them through the SyncBoard.
         try:
             self.board.setCaptureClock(
                 atsparam['clock_source_id'], atsSamplesPerSec_or_id, clock_edge_id, decimation)
@@ -429,31 +788,22 @@ class GuilessWorker(Worker):
         self.board.configureAuxIO(ats.AUX_OUT_TRIGGER, 0)
         #print("Aux output set to sample clock.")
 
-        try:
-            chA_range_id = atsRanges[atsparam['chA_input_range']]
-        except KeyError:
-            print("Voltage setting {:d}mV for Channel A is not recognised in atsapi. Make sure you use millivolts.".format(
-                atsparam['chA_input_range']))
-        self.board.inputControl(
-            ats.CHANNEL_A, atsparam['chA_coupling_id'], chA_range_id, atsparam['chA_impedance_id'])
-        self.board.setBWLimit(ats.CHANNEL_A, atsparam['chA_bw_limit'])
-        print("Channel A input full scale: {:d}, coupling: {:d}, impedance: {:d}, bandwidth limit: {:d}.".format(
-            atsparam['chA_input_range'], atsparam['chA_coupling_id'], atsparam['chA_impedance_id'], atsparam['chA_bw_limit']))
-
-        try:
-            chB_range_id = atsRanges[atsparam['chB_input_range']]
-        except KeyError:
-            print("Voltage setting {:d}mV for Channel B is not recognised in atsapi. Make sure you use millivolts.".format(
-                atsparam['chB_input_range']))
-        self.board.inputControl(
-            ats.CHANNEL_B, atsparam['chB_coupling_id'], chB_range_id, atsparam['chB_impedance_id'])
-        self.board.setBWLimit(ats.CHANNEL_B, atsparam['chB_bw_limit'])
-        print("Channel B input full scale: {:d}, coupling: {:d}, impedance: {:d}, bandwidth limit: {:d}.".format(
-            atsparam['chB_input_range'], atsparam['chB_coupling_id'], atsparam['chB_impedance_id'], atsparam['chB_bw_limit']))
+        # Inputs are configured on every board
+        for name, channel in atsChannels[:self.capabilities['num_channels']]:
+            input_range = atsparam['ch{:s}_input_range'.format(name)]
+            if input_range not in self.capabilities['input_ranges']:
+                raise LabscriptError("Input range {:d}mV for Channel {:s} is not supported by the {:s}. Supported ranges are {:s}mV.".format(
+                    input_range, name, self.board_name, ', '.join(map(str, self.capabilities['input_ranges']))))
+            coupling_id = atsparam['ch{:s}_coupling_id'.format(name)]
+            impedance_id = atsparam['ch{:s}_impedance_id'.format(name)]
+            bw_limit = atsparam['ch{:s}_bw_limit'.format(name)]
+            for b in self.boards:
+                b.inputControl(channel, coupling_id, atsRanges[input_range], impedance_id)
+                b.setBWLimit(channel, bw_limit)
+            print("Channel {:s} input full scale: {:d}, coupling: {:d}, impedance: {:d}, bandwidth limit: {:d}.".format(
+                name, input_range, coupling_id, impedance_id, bw_limit))
 
         # ====== Acquisition code starts here =====
-        # This is a magic number and should at the very least move up
-        self.samplesPerBuffer = 204800
         self.oneM = 2**20
         # This should be determined by experiment run time.
         self.timeout = 60000
@@ -461,16 +811,27 @@ class GuilessWorker(Worker):
         # Check which channels we are acquiring
         #channels = ats.CHANNEL_A | ats.CHANNEL_B
         self.channels = atsparam['channels']
-        if not (self.channels & ats.CHANNEL_A or self.channels & ats.CHANNEL_B):
-            raise LabscriptError(
-                "You must select either Channel-A or Channel-B, or both. Zero or >2 channels not supported.")
+        board_channels = atsChannels[:self.capabilities['num_channels']]
         self.channelCount = 0
         for c in ats.channels:
             self.channelCount += (c & self.channels == c)
+        if (self.channelCount not in (1, 2, 4) or
+                self.channels & ~sum(channel for name, channel in board_channels)):
+            raise LabscriptError(
+                "You must select 1, 2 or 4 of the {:s}'s channels {:s}.".format(
+                    self.board_name, ', '.join(name for name, channel in board_channels)))
+        # Names of the columns of the scratch file: the acquired channels of each board in turn.
+        # Channels of slave boards are suffixed with their board ID:
+        self.channel_names = []
+        for b, board_id in enumerate([self.ats_board_id] + list(self.slave_board_ids)):
+            for name, channel in board_channels:
+                if self.channels & channel:
+                    self.channel_names.append(name if b == 0 else '{:s}_board{:d}'.format(name, board_id))
+        self.columnCount = len(self.channel_names)
 
-        # Compute the number of bytes per record and per buffer
-        memorySize_samples, self.bitsPerSample = self.board.getChannelInfo()
-        self.bytesPerDatum = (self.bitsPerSample + 7) // 8
+        # Samples are transferred left justified in bytesPerDatum bytes, so are converted
+        # to volts as if they had 8 * bytesPerDatum bits
+        self.bitsPerSample = 8 * self.bytesPerDatum
 
         # One 'sample' is one datum from each channel
         print("bytesPerDatum = {:d}. channelcount = {:d}.".format(
@@ -482,48 +843,162 @@ class GuilessWorker(Worker):
         self.samplesPerAcquisition = int(
             actual_acquisition_rate * atsparam['acquisition_duration'] + 0.5)
         memoryPerAcquisition = self.bytesPerDatum * \
-            self.samplesPerAcquisition * self.channelCount
+            self.samplesPerAcquisition * self.columnCount
         self.buffersPerAcquisition = ((self.samplesPerAcquisition + self.samplesPerBuffer - 1) //
                                       self.samplesPerBuffer)
         print('Acquiring for {:5.3f}s generates {:5.3f} MS ({:5.3f} MB total)'.format(
             atsparam['acquisition_duration'], self.samplesPerAcquisition/1e6, memoryPerAcquisition/self.oneM))
-        print('Buffers are {:5.3f} MS and {:d} bytes. Allocating {:d} buffers... '.format(
-            self.samplesPerBuffer/1e6, self.bytesPerBuffer, self.buffersPerAcquisition), end='')
-        self.board.setRecordSize(0, self.samplesPerBuffer)
+        print('Buffers are {:5.3f} MS and {:d} bytes. Acquiring {:d} buffers per board through a ring of {:d}.'.format(
+            self.samplesPerBuffer/1e6, self.bytesPerBuffer, self.buffersPerAcquisition, self.buffer_count))
+        for b in self.boards:
+            b.setRecordSize(0, self.samplesPerBuffer)
 
-        # Allocate buffers
-        # We know that disk can't keep up, so we preallocate all buffers
-        sample_type = ctypes.c_uint16  # It's 16bit, let's not stuff around
-        self.buffers = []
-        for i in range(self.buffersPerAcquisition):
-            self.buffers.append(ats.DMABuffer(
-                sample_type, self.bytesPerBuffer))
-            #print('{:d} '.format(i),end="")
-        print('done.')
+        # Set up processing of the acquisition, done as buffers complete:
+        channel_info = [(name, atsparam['ch{:s}_input_range'.format(name[0])], self.bitsPerSample)
+                        for name in self.channel_names]
+        self.dsp_stages = [dsp_stage_types[parameters['type']](
+                               parameters, actual_acquisition_rate, channel_info, self.samplesPerAcquisition)
+                           for parameters in atsparam.get('dsp_stages', None) or []]
+        self.dsp_dispatched = [0] * len(self.dsp_stages)
+        self.dsp_results = []
+
+        # Samples are streamed to a scratch file as buffers complete:
+        self.create_scratch_file()
+        # Discard notifications of buffers freed during any previous shot, and any
+        # exception raised saving its buffers, which has no bearing on this one:
+        while not self.free_buffers.empty():
+            self.free_buffers.get()
+        self.consumer_exception = None
 
-        # This works but ADMA_ALLOC_BUFFERS is questionable because we have allocated the buffers (well atsapi.py buffer class has)
-        acqflags = ats.ADMA_TRIGGERED_STREAMING | ats.ADMA_ALLOC_BUFFERS | ats.ADMA_FIFO_ONLY_STREAMING
+        # We post our own buffers rather than having the driver allocate them:
+        acqflags = ats.ADMA_TRIGGERED_STREAMING | ats.ADMA_FIFO_ONLY_STREAMING
         #print("Acqflags in decimal: {:d}".format(acqflags))
 
         # This does not actually start the capture, it just sets it up
-        self.board.beforeAsyncRead(self.channels,
-                                   0,                 # Trig offset, must be 0
-                                   self.samplesPerBuffer,
-                                   1,                 # Must be 1
-                                   0x7FFFFFFF,        # Ignored
-                                   acqflags)
+        for b in self.boards:
+            b.beforeAsyncRead(self.channels,
+                              0,                 # Trig offset, must be 0
+                              self.samplesPerBuffer,
+                              1,                 # Must be 1
+                              0x7FFFFFFF,        # Ignored
+                              acqflags)
+
+        # Post as much of the ring as the acquisition needs. The acquisition thread
+        # reposts the rest as they become free:
+        self.buffersPosted = 0
+        while self.buffersPosted < min(self.buffer_count, self.buffersPerAcquisition):
+            self.post_buffer()
+        # Starting the master starts the slaves too:
+        self.board.startCapture()
 
         self.acquisition_queue.put('start')
         return {}  # ? Check this
 
-    # This becomes a long-running thread which fills the buffers allocated in the main thread.
-    # Buffers are saved and freed in transition_to_manual().
+    def post_buffer(self):
+        """Post the next buffer of each board's ring to the board"""
+        for b, ring in zip(self.boards, self.buffers):
+            buffer = ring[self.buffersPosted % self.buffer_count]
+            b.postAsyncBuffer(buffer.addr, self.bytesPerBuffer)
+        self.buffersPosted += 1
+
+    def repost_free_buffers(self, block):
+        """Repost buffers that the consumer thread has finished with. If block is True,
+        wait for at least one, unless aborting"""
+        while self.buffersPosted < self.buffersPerAcquisition:
+            try:
+                if block:
+                    self.free_buffers.get(timeout=0.1)
+                else:
+                    self.free_buffers.get_nowait()
+            except Empty:
+                if block and not self.aborting:
+                    continue
+                return
+            # Buffers are freed in the order they were filled, which is the order they
+            # must be reposted in:
+            self.post_buffer()
+            block = False
+
+    def create_scratch_file(self):
+        """Create a memory-mapped file to hold the samples of the acquisition"""
+        fd, self.scratch_filepath = tempfile.mkstemp(
+            suffix='.npy', prefix='alazar_', dir=self.scratch_directory)
+        os.close(fd)
+        self.scratch = np.lib.format.open_memmap(
+            self.scratch_filepath, mode='w+', dtype=self.sample_dtype,
+            shape=(self.samplesPerAcquisition * self.columnCount,))
+
+    def remove_scratch_file(self):
+        if self.scratch_filepath is None:
+            return
+        # Close the memory map before deleting the file:
+        self.scratch = None
+        os.remove(self.scratch_filepath)
+        self.scratch_filepath = None
+
+    # This becomes a long-running thread which saves buffers completed by the acquisition thread to the scratch file,
+    # then hands them back to be reposted.
+    def consumer_loop(self):
+        while True:
+            index = self.completed_buffers.get()
+            try:
+                # After an error or abort, discard the remaining buffers:
+                if self.consumer_exception is None and not self.aborting:
+                    # Samples are saved still interleaved, and deinterleaved when saved to the shot file.
+                    # Each board's channels are consecutive columns:
+                    samples = self.scratch.reshape(self.samplesPerAcquisition, self.columnCount)
+                    start = index * self.samplesPerBuffer
+                    n_samples = min(self.samplesPerBuffer, self.samplesPerAcquisition - start)
+                    for b, ring in enumerate(self.buffers):
+                        columns = slice(b * self.channelCount, (b + 1) * self.channelCount)
+                        samples[start: start + n_samples, columns] = ring[index % self.buffer_count].buffer[
+                            : n_samples * self.channelCount].reshape(n_samples, self.channelCount)
+                    self.dispatch_dsp(start + n_samples)
+            except Exception:
+                self.consumer_exception = sys.exc_info()
+            finally:
+                self.free_buffers.put(index)
+                self.completed_buffers.task_done()
+
+    def dispatch_dsp(self, available, final=False):
+        """Submit blocks of the scratch file up to sample index available to the DSP
+        thread pool, in blocks of about a buffer's worth of whole segments. Unless final
+        is True, a partial block is left until more samples are available."""
+        samples = self.scratch.reshape(self.samplesPerAcquisition, self.columnCount)
+        for i, stage in enumerate(self.dsp_stages):
+            block_size = max(1, self.samplesPerBuffer // stage.segment_length) * stage.segment_length
+            start = self.dsp_dispatched[i]
+            while True:
+                stop = start + block_size
+                if stop > available:
+                    if not final:
+                        break
+                    stop = available // stage.segment_length * stage.segment_length
+                    if stop <= start:
+                        break
+                self.dsp_results.append(
+                    self.dsp_pool.apply_async(stage.process, (start, samples[start: stop])))
+                start = stop
+            self.dsp_dispatched[i] = start
+
+    def wait_dsp_complete(self):
+        """Process the rest of the acquisition and wait for the DSP thread pool, raising
+        any exception from a DSP stage"""
+        try:
+            self.dispatch_dsp(self.samplesPerAcquisition, final=True)
+            for result in self.dsp_results:
+                result.get()
+        finally:
+            self.dsp_results = []
+
+    # This becomes a long-running thread which waits for the buffers posted in the main thread to be filled,
+    # passes them to the consumer thread, and reposts them once it is done with them.
     def acquisition_loop(self):
         while True:
             command = self.acquisition_queue.get()
             assert command == 'start'
             #print("acquisition thread: starting new acquisition")
-            start = time.clock()               # Keep track of when acquisition started
+            start = time.time()                # Keep track of when acquisition started
             # This is a fresh trip through the acquisition loop, no exception has occurred yet!
             self.acquisition_exception = None
             self.acquisition_done.clear()      # I don't understand why this is needed here!
@@ -535,39 +1010,47 @@ class GuilessWorker(Worker):
                 print('Read buffer:', end="")
                 with tqdm(total=self.buffersPerAcquisition, unit='buffers', desc='Capturing buffers', **tqdm_kwargs) as pbar:
                     while (buffersCompleted < self.buffersPerAcquisition and not self.aborting):
-                        buffer = self.buffers[buffersCompleted]
-                        self.board.waitNextAsyncBufferComplete(
-                            buffer.addr, self.bytesPerBuffer, timeout_ms=self.timeout)
+                        if buffersCompleted == self.buffersPosted:
+                            # The consumer thread has all the buffers. Wait for one back:
+                            self.repost_free_buffers(block=True)
+                            continue
+                        for b, ring in zip(self.boards, self.buffers):
+                            buffer = ring[buffersCompleted % self.buffer_count]
+                            b.waitAsyncBufferComplete(buffer.addr, timeout_ms=self.timeout)
+                        self.completed_buffers.put(buffersCompleted)
                         buffersCompleted += 1
                         #print(' {:d}'.format(buffersCompleted),end="")
                         pbar.update(1)
-                        bytesTransferred += buffer.size_bytes
+                        bytesTransferred += self.bytesPerBuffer * len(self.boards)
+                        self.repost_free_buffers(block=False)
             except ats.AlazarException as e:
-                # Assume that if we got here it was due to an exception in waitNextAsyncBufferComplete.
+                # Assume that if we got here it was due to an exception in waitAsyncBufferComplete.
                 errstring, funcname, arguments, retCode, retText = e.args
                 print("\n\nAPI error string is: {:s}".format(errstring))
                 # Even if in an abort, we still process this exception up to the main thread via shared state
                 self.acquisition_exception = sys.exc_info()
-                print("acquisition thread: acquisition_exception is {:s}".format(
-                    self.acquisition_exception))
+                print("acquisition thread: acquisition_exception is {!r}".format(e))
                 continue  # Next iteration of the infinite loop, wait for next acquisition, or have the main thread decide to die
             except Exception as e:
-                print("Got some other exception {:s}".format(e))
+                print("Got some other exception {!r}".format(e))
                 self.acquisition_exception = sys.exc_info()
                 continue  # Next iteration of the infinite loop, wait for next acquisition, or have the main thread decide to die
             finally:
-                self.board.abortAsyncRead()
+                self.abort_async_reads()
                 self.acquisition_done.set()
             if self.aborting:
                 print("acquisition thread: capture aborted.")
                 continue
 
+    def abort_async_reads(self):
+        for b in self.boards:
+            b.abortAsyncRead()
+
     def program_manual(self, values):
         return values
 
     def to_volts(self, zeroToFullScale, buf):
-        offset = float(2**(self.bitsPerSample-1))
-        return (np.asfarray(buf, np.float32)-offset)/offset * zeroToFullScale * 0.001
+        return raw_to_volts(buf, zeroToFullScale, self.bitsPerSample)
 
     # This helper function waits for the acquisition_loop thread to finish the acquisition,
     # either successfully or after an exception.
@@ -582,62 +1065,86 @@ class GuilessWorker(Worker):
                     'Waiting for acquisition to complete timed out')
             #print("acquisition_exception is {:s}".format(self.acquisition_exception))
             if self.acquisition_exception is not None and not self.aborting:
-                raise self.acquisition_exception
+                raise self.acquisition_exception[1]
         finally:
             # This ensures that the blocking call in the acquisition thread is aborted.
-            self.board.abortAsyncRead()
+            self.abort_async_reads()
             self.acquisition_done.clear()
             self.acquisition_exception = None
 
     def transition_to_manual(self):
         #print("transition_to_manual: using " + self.h5file)
         # Waits on the acquisition thread, and manages the lock
-        self.wait_acquisition_complete()
+        try:
+            self.wait_acquisition_complete()
+            # Wait for the consumer thread to save the remaining buffers:
+            self.completed_buffers.join()
+            if self.consumer_exception is not None:
+                exc_info = self.consumer_exception
+                self.consumer_exception = None
+                raise exc_info[1]
+            self.wait_dsp_complete()
+        except Exception:
+            # The consumer thread and DSP stages must be done with the scratch file
+            # before it is removed:
+            self.completed_buffers.join()
+            for result in self.dsp_results:
+                result.wait()
+            self.dsp_results = []
+            self.remove_scratch_file()
+            raise
         # Write data to HDF5 file
         with h5py.File(self.h5file) as hdf5_file:
-            grp = hdf5_file.create_group('/data/traces/'+self.device_name)
-            if self.channels & ats.CHANNEL_A:
-                dsetA = grp.create_dataset(
-                    'channelA',    (self.samplesPerAcquisition,), dtype='float32')
-                dsetAraw = grp.create_dataset(
-                    'rawsamplesA', (self.samplesPerAcquisition,), dtype='uint16')
-            if self.channels & ats.CHANNEL_B:
-                dsetB = grp.create_dataset(
-                    'channelB',    (self.samplesPerAcquisition,), dtype='float32')
-                dsetBraw = grp.create_dataset(
-                    'rawsamplesB', (self.samplesPerAcquisition,), dtype='uint16')
-            start = 0
-            samplesToProcess = self.samplesPerAcquisition
-            # This slightly silly logic assumes that if you are acquiring only one channel then it's chA.
-            # This should be redone
-            for buf, counter in tqdm(zip(self.buffers, range(1, len(self.buffers)+1)),
-                                     unit='buffers', desc='Writing buffers to HDF5', **tqdm_kwargs):
-                bufferData = buf.buffer
-                # lastI shortens the buffer aquisition at the end of a sample, ie last buffer. I'm sure this could be nicer!
-                lastI = (samplesToProcess if (samplesToProcess < self.samplesPerBuffer)
-                         else self.samplesPerBuffer) * self.channelCount
-                end = start+len(bufferData[0: lastI])//self.channelCount
-                if self.channels & ats.CHANNEL_A:
-                    dsetAraw[start: end] = bufferData[0: lastI: self.channelCount]
-                    dsetA[start: end] = self.to_volts(
-                        self.atsparam['chA_input_range'], bufferData[0: lastI: self.channelCount])
-                if self.channels & ats.CHANNEL_B:
-                    dsetBraw[start: end] = bufferData[1: lastI: self.channelCount]
-                    dsetB[start: end] = self.to_volts(
-                        self.atsparam['chB_input_range'], bufferData[1: lastI: self.channelCount])
-                samplesToProcess -= self.samplesPerBuffer
-                start += self.samplesPerBuffer
-        print("Freeing buffers... ", end="")
-        for buf in self.buffers:
-            buf.__exit__()
-        self.buffers = []
-        print('done.')
+            self.save_traces(hdf5_file)
+        self.remove_scratch_file()
         return True
 
+    def save_traces(self, hdf5_file):
+        """Save the samples in the scratch file to the shot file, unless the store_raw property
+        is False, along with the products of any DSP stages. Raw samples are saved with the
+        input range and bits per sample needed to convert them to volts as attributes. Volts are
+        saved too, unless the store_volts property is False."""
+        grp = hdf5_file.create_group('/data/traces/'+self.device_name)
+        store_volts = self.atsparam.get('store_volts', True)
+        # A single reshape deinterleaves all buffers. Columns are the acquired channels, in order:
+        samples = self.scratch.reshape(self.samplesPerAcquisition, self.columnCount)
+        acquired = self.channel_names
+        if not self.atsparam.get('store_raw', True):
+            acquired = []
+        for column, name in enumerate(acquired):
+            # Slave board channels have the same settings as the master's:
+            input_range = self.atsparam['ch{:s}_input_range'.format(name[0])]
+            dset_raw = grp.create_dataset(
+                'rawsamples'+name, (self.samplesPerAcquisition,), dtype=self.sample_dtype)
+            dset_raw.attrs['input_range'] = input_range  # mV
+            dset_raw.attrs['bits_per_sample'] = self.bitsPerSample
+            # volts = (raw - volts_offset) * volts_per_code, for readers not using raw_to_volts():
+            dset_raw.attrs['volts_offset'] = 2**(self.bitsPerSample-1)
+            dset_raw.attrs['volts_per_code'] = input_range * 0.001 / 2**(self.bitsPerSample-1)
+            if store_volts:
+                dset = grp.create_dataset(
+                    'channel'+name, (self.samplesPerAcquisition,), dtype='float32')
+            for start in tqdm(range(0, self.samplesPerAcquisition, self.samples_per_write),
+                              unit='blocks', desc='Writing channel {:s} to HDF5'.format(name), **tqdm_kwargs):
+                end = min(start + self.samples_per_write, self.samplesPerAcquisition)
+                raw = samples[start: end, column]
+                dset_raw[start: end] = raw
+                if store_volts:
+                    dset[start: end] = self.to_volts(input_range, raw)
+        for stage in self.dsp_stages:
+            stage.save(grp)
+
     def abort(self):
         print("aborting! ... ")
         self.aborting = True
         self.wait_acquisition_complete()
+        self.completed_buffers.join()
+        self.consumer_exception = None
+        for result in self.dsp_results:
+            result.wait()
+        self.dsp_results = []
+        self.dsp_stages = []
+        self.remove_scratch_file()
         self.aborting = False
         print("abort complete.")
         return True
@@ -653,9 +1160,17 @@ class GuilessWorker(Worker):
     def shutdown(self):
         if self.aborting:
             print('Shutdown requested during abort; waiting 10 seconds.')
-            start = time.clock()
-            while self.aborting and time.clock() - start < 10:
+            start = time.time()
+            while self.aborting and time.time() - start < 10:
                 time.sleep(0.5)
         if self.aborting:
             print('Proceeding in lieu of complete abort.')
+        self.abort_async_reads()
+        print("Freeing buffers... ", end="")
+        for ring in self.buffers:
+            for buf in ring:
+                buf.__exit__()
+        self.buffers = []
+        print('done.')
+        self.dsp_pool.terminate()
         return
\ No newline at end of file
@@ -18,6 +18,7 @@ if PY2:
 
 from labscript import Device, PseudoclockDevice, Pseudoclock, ClockLine, config, LabscriptError, set_passed_properties, compiler, IntermediateDevice, WaitMonitor, DigitalOut
 from labscript_devices import runviewer_parser, BLACS_tab, BLACS_worker, labscript_device
+from labscript_devices.clock_expansion import expand_clock
 
 import numpy as np
 import labscript_utils.h5_lock, h5py
@@ -67,6 +68,17 @@ def add_instruction_to_bytearray(data, instruction, on, off, reps):
     data[offset+14] = reps[3]
     data[offset+15] = reps[2]   
     
+def pulse_program_to_bytearray(pulse_program):
+    # converts a PULSE_PROGRAM table to the data written to the FPGA, identical to calling
+    # add_instruction_to_bytearray() for each instruction, but for the whole table at once.
+    # Each instruction is 16 bytes of 16-bit little endian words, most significant word first:
+    # 3 words for on_period, 3 for off_period and 2 for reps
+    words = []
+    for name, n_words in [('on_period', 3), ('off_period', 3), ('reps', 2)]:
+        shifts = 16*np.arange(n_words-1, -1, -1)
+        words.append((pulse_program[name].astype(np.int64)[:, np.newaxis] >> shifts) & 0xFFFF)
+    return bytearray(np.concatenate(words, axis=1).astype('<u2').tobytes())
+    
         
 # Define a CiceroOpalKellyXEM3001Clock that only accepts one child clockline
 class CiceroOpalKellyXEM3001Pseudoclock(Pseudoclock):    
@@ -136,10 +148,10 @@ class CiceroOpalKellyXEM3001(PseudoclockDevice):
     max_instructions = 2048
     
     @set_passed_properties(property_names = {
-        "connection_table_properties": ["reference_clock", "clock_frequency", "trigger_debounce_clock_ticks"],
+        "connection_table_properties": ["reference_clock", "clock_frequency", "trigger_debounce_clock_ticks", "wait_monitor_poll_interval"],
         "device_properties": ["trigger_delay", "wait_delay"]}
         )    
-    def __init__(self, name, trigger_device=None, trigger_connection=None, serial='', reference_clock='internal', clock_frequency=100e6, use_wait_monitor=False, trigger_debounce_clock_ticks=10):
+    def __init__(self, name, trigger_device=None, trigger_connection=None, serial='', reference_clock='internal', clock_frequency=100e6, use_wait_monitor=False, trigger_debounce_clock_ticks=10, wait_monitor_poll_interval=1e-3):
         # set device properties based on clock frequency
         self.clock_limit = clock_frequency/2
         self.clock_resolution = 1/clock_frequency
@@ -164,6 +176,10 @@ class CiceroOpalKellyXEM3001(PseudoclockDevice):
         if trigger_debounce_clock_ticks >= 2**16:
             raise LabscriptError('The %s %s trigger_debounce_clock_ticks parameter must be between 0 and 65535'%(self.description, self.name))
         
+        # Waits must be further apart than this to be measured individually
+        if wait_monitor_poll_interval <= 0:
+            raise LabscriptError('The %s %s wait_monitor_poll_interval parameter must be greater than 0'%(self.description, self.name))
+        
         # create Pseudoclock and clockline
         self._pseudoclock = CiceroOpalKellyXEM3001Pseudoclock('%s_pseudoclock'%name, self, 'clock') # possibly a better connection name than 'clock'?
         # Create the internal direct output clock_line
@@ -288,30 +304,13 @@ class RunviewerClass(object):
         
         clock_frequency = connection_table_properties['clock_frequency']
 
-        time = []
-        states = []
-        trigger_index = 0
-        # t = 0 if clock is None else clock_ticks[trigger_index]+device_properties['trigger_delay']
-        # trigger_index += 1
-        t = 0
-               
-        for row in pulse_program:
-            if row['reps'] == 0: # WAIT
-                if clock is not None:
-                    t = clock_ticks[trigger_index]+device_properties['trigger_delay']
-                    trigger_index += 1
-                else:
-                    t += device_properties['wait_delay']
-            else:    
-                for i in range(row['reps']):
-                    time.append(t)
-                    states.append(1)
-                    t += row['on_period']/clock_frequency
-                    time.append(t)
-                    states.append(0)
-                    t += row['off_period']/clock_frequency
-        
-        clock = (np.array(time), np.array(states))
+        # Each trigger resumes the clock after a wait
+        resume_times = None if clock is None else clock_ticks+device_properties['trigger_delay']
+        
+        waits = pulse_program['reps'] == 0
+        clock = expand_clock(pulse_program['on_period']/clock_frequency, pulse_program['off_period']/clock_frequency,
+                             pulse_program['reps'], waits, wait_delay=device_properties['wait_delay'],
+                             resume_times=resume_times)
         
         clocklines_and_triggers = {}
         for pseudoclock_name, pseudoclock in self.device.child_list.items():
@@ -345,12 +344,14 @@ class CiceroOpalKellyXEM3001Tab(DeviceTab):
         self.serial = str(connection_object.BLACS_connection)
         self.reference_clock = connection_object.properties.get('reference_clock', 'internal')
         self.logger.debug('reference clock scheme is: %s'%self.reference_clock)
+        self.wait_monitor_poll_interval = connection_object.properties.get('wait_monitor_poll_interval', 1e-3)
         # Create and set the primary worker
-        self.create_worker("main_worker", CiceroOpalKellyXEM3001Worker, {'serial':self.serial, "reference_clock":self.reference_clock})
+        self.create_worker("main_worker", CiceroOpalKellyXEM3001Worker, {'serial':self.serial, "reference_clock":self.reference_clock,
+                                                                        "wait_monitor_poll_interval":self.wait_monitor_poll_interval})
         self.primary_worker = "main_worker"
         
         # Set the capabilities of this device
-        self.supports_smart_programming(False) 
+        self.supports_smart_programming(True) 
         
         # Add button to force reflash
         self.flash_fpga_button = QPushButton('Flash FPGA firmware (this should be handled automatically by BLACS, if the device is not working correctly, try this button!)')
@@ -428,7 +429,8 @@ class CiceroOpalKellyXEM3001Tab(DeviceTab):
     def start_run(self, notify_queue):
         """Starts the CiceroOpalKellyXEM3001, notifying the queue manager when
         the run is over"""
-        # TODO: This 100ms (+ overhead) limits the minimum time you can have between 2 consecutive wait commands in labscript. Anything faster than this will not be detected properly.
+        # Waits are detected by a thread in the worker, polling every wait_monitor_poll_interval,
+        # so this only needs to notice the end of the run
         self.statemachine_timeout_add(100, self.status_monitor, notify_queue)
         yield(self.queue_work(self.primary_worker, 'start_run'))
 
@@ -438,8 +440,11 @@ class CiceroOpalKellyXEM3001Worker(Worker):
     def init(self):
         global h5py; import labscript_utils.h5_lock, h5py
         # global serial; import serial
+        global sys; import sys
         global time; import time
+        global threading; import threading
         global zprocess; import zprocess
+        global _reraise; from zprocess.utils import _reraise
         global ok; import ok # OpalKelly library
 
         # check the import worked correctly
@@ -456,8 +461,18 @@ class CiceroOpalKellyXEM3001Worker(Worker):
         self.wait_table = None
         self.measured_waits = None
         self.h5_file = None
+        
+        # The wait monitor thread, which polls the FPGA during the run. Access to the FPGA
+        # is shared with it under dev_lock. Any exception in the thread is saved to be raised later.
+        self.wait_monitor_thread = None
+        self.wait_monitor_thread_exception = None
+        self.shutting_down = False
+        self.dev_lock = threading.Lock()
     
         self.current_value = 0
+        
+        # The data last written to the FPGA, so that it is only written again if it changes
+        self.smart_cache = {'PULSE_PROGRAM': None}
     
         # Initialise connection to OPAL KELLY Board
         self.dev = ok.okCFrontPanel()
@@ -490,6 +505,8 @@ class CiceroOpalKellyXEM3001Worker(Worker):
         self.logger.debug('Flashing FPGA bit file located at: %s'%fpga_path)
         if PY2:
             fpga_path = bytes(fpga_path)
+        # Flashing clears the instructions
+        self.smart_cache['PULSE_PROGRAM'] = None
         self.dev.ConfigureFPGA(fpga_path)
         assert self.dev.IsFrontPanelEnabled(), 'Flashing of the FPGA failed. The device is not configured with the .bit file correctly'
 
@@ -497,6 +514,7 @@ class CiceroOpalKellyXEM3001Worker(Worker):
         return True
     
     def shutdown(self):
+        self.stop_wait_monitor(abort=True)
 		# signal the state machine to halt execution
         self.dev.ActivateTriggerIn(0x40, 1)
 		# close the connection
@@ -529,6 +547,8 @@ class CiceroOpalKellyXEM3001Worker(Worker):
             if len(dataset) > 0 and acquisition_device == '%s_internal_wait_monitor_outputs'%device_name and timeout_device == '%s_internal_wait_monitor_outputs'%device_name:      
                 self.wait_table = dataset[:]
                 self.measured_waits = numpy.zeros(len(self.wait_table))
+                # The number of samples the FPGA will have generated at the start of each wait
+                self.wait_samples = (self.wait_table['time']*self.connection_table_properties['clock_frequency']).astype(int)
             else:
                 self.wait_table = None # This device doesn't need to worry about looking at waits
                 self.measured_waits = None
@@ -541,13 +561,13 @@ class CiceroOpalKellyXEM3001Worker(Worker):
         if self.wait_table is not None and not self.is_master_pseudoclock:
             raise RuntimeError('Something has gone wrong in labscript. You should not be able to configure this device as the wait monitor while it is a secondary pseudoclock. Please contact the developers on the mailing list.')
                 
-        # Create empty data array
-        data = bytearray(len(pulse_program)*16)
-        for i, instruction in enumerate(pulse_program):
-            add_instruction_to_bytearray(data, i, instruction['on_period'], instruction['off_period'], instruction['reps'])
+        data = pulse_program_to_bytearray(pulse_program)
         
-        # program the FPGA
-        assert self.dev.WriteToPipeIn(0x80, data) == len(data)
+        # program the FPGA, unless it already has this pulse program
+        if fresh or data != self.smart_cache['PULSE_PROGRAM']:
+            self.smart_cache['PULSE_PROGRAM'] = None
+            assert self.dev.WriteToPipeIn(0x80, data) == len(data)
+            self.smart_cache['PULSE_PROGRAM'] = data
 
         # If not the master pseudoclock, then we need to start the device
         # now so that the internal state machine can hit the first wait 
@@ -559,80 +579,100 @@ class CiceroOpalKellyXEM3001Worker(Worker):
             
     def start_run(self):
         # Start in software:
-        assert self.dev.ActivateTriggerIn(0x40,0) == self.dev.NoError
+        with self.dev_lock:
+            assert self.dev.ActivateTriggerIn(0x40,0) == self.dev.NoError
+        
+        # Measure waits as they happen, if this device is the wait monitor
+        if self.wait_table is not None:
+            self.wait_monitor_thread = threading.Thread(target=self.wait_monitor)
+            self.wait_monitor_thread.daemon = True
+            self.wait_monitor_thread.start()
     
-    def status_monitor(self):
-        def ReadU32(addr):
-            lo = self.dev.GetWireOutValue(addr)
-            hi = self.dev.GetWireOutValue(addr+1)
-            vx = (hi << 16) | lo
-            return vx
-        
-        # update the status monitors
-        self.dev.UpdateWireOuts()
-                
+    def read_wire_outs(self):
+        # Reads all the status wires in one transfer, returning 
+        #   masterSamplesGenerated (wires 22+23)
+        #   retriggerTimeoutCount (wire 24)
+        #   status (wire 25)
+        #   retriggerWaitSamples (wires 26+27)
+        with self.dev_lock:
+            self.dev.UpdateWireOuts()
+            values = [self.dev.GetWireOutValue(addr) for addr in range(0x22, 0x28)]
+        master_samples_generated = bits_to_int(16, values[0], values[1])
+        retrigger_wait_samples = bits_to_int(16, values[4], values[5])
+        return master_samples_generated, values[2], values[3], retrigger_wait_samples
+    
+    def wait_monitor(self):
         #   WAIT ANALYSIS CODE: 
-        #       If this device has a wait monitor attached
-        #       Read wires 22+23 (masterSamplesGenerated)
-        #                  24 (retriggerTimeoutCount)
-        #                  26+27 (retriggerWaitSamples)
-        #
-        #       find out if this device was the wait monitor by looking at 
-        #       hdf5_file['waits'].attrs['wait_monitor_acquisition_device']
-        #       and hdf5_file['waits'].attrs['wait_monitor_timeout_device']
+        #       Runs in a thread during the run, if this device is the wait monitor,
+        #       polling the FPGA every wait_monitor_poll_interval until it finishes
         #
-        #       To determine the length of waits. Note this is a bit tricky 
-        #       because if waits are close we might miss one (cicero must have
-        #       the same problem). You also need to reverse engineer the 
-        #       of the wait from the retriggerWaitSamples which appears to be
-        #       a cumulative total of wait samples. You could use 
-        #       masterSamplesGenerated to work out which wait just happened
-        #       based on the clock_resolution and the wait time in the 
-        #       "waits" table of the HDF5 file.
+        #       A wait has happened when masterSamplesGenerated passes the sample
+        #       at which it started, and its length is the increase in
+        #       retriggerWaitSamples, which is a cumulative total of wait samples,
+        #       since the previous wait. If waits are closer together than the poll 
+        #       interval, we might miss one, which is an error
         #       
-        #       send ZMQ all_waits_finished event when all waits have happened.
-        #       self.all_waits_finished.post(self.h5_file)
-        if self.wait_table is not None and self.current_wait < len(self.wait_table):
-            # master_samples_generated_1 = self.dev.GetWireOutValue(0x22)
-            # master_samples_generated_2 = self.dev.GetWireOutValue(0x23)
-            # master_samples_generated = (master_samples_generated_2 << 16) + master_samples_generated_1
-            
-            master_samples_generated = bits_to_int(16, self.dev.GetWireOutValue(0x22), self.dev.GetWireOutValue(0x23))
-            self.logger.debug('Master samples generated: %d'%master_samples_generated)
-        
-            clock_frequency = self.connection_table_properties['clock_frequency']
-
-            # find time of current wait
-            wait_sample = int(self.wait_table[self.current_wait][1]*clock_frequency)
-            # for some reason this needs to be incremented by 1?
-            #wait_sample += 1
-            self.logger.debug('Wait sample: %d'%wait_sample)
-            if wait_sample < master_samples_generated:
-                # a wait has happened!
-                # let's make sure 2 waits have not happened before we noticed the first...
-                if len(self.wait_table) > self.current_wait+1:
-                    next_wait_sample = int(self.wait_table[self.current_wait+1][1]*clock_frequency)
-                    assert next_wait_sample > master_samples_generated, 'Error: a wait happened too soon after another wait to determine the length of each wait individually.'
-                
-                # work out the length of the last wait
-                retrigger_wait_samples = bits_to_int(16, self.dev.GetWireOutValue(0x26), self.dev.GetWireOutValue(0x27))
-                self.logger.debug('Retrigger wait samples: %d'%retrigger_wait_samples)
-                # store length of wait (must be stored in clock samples so that
-                # we can subtract off this number of samples for a following wait)
-                self.measured_waits[self.current_wait] = retrigger_wait_samples-self.measured_waits.sum()
-
-                # Inform any interested parties that a wait has completed:
-                self.wait_completed.post(self.h5_file, data=_ensure_str(self.wait_table[self.current_wait]['label']))
-
-                # increment the wait we are looking for!
-                self.current_wait += 1
+        #       send ZMQ wait_completed event after each wait, and
+        #       all_waits_finished event when all waits have happened.
+        try:
+            self.logger.debug('Wait monitor thread starting')
+            while not self.shutting_down:
+                master_samples_generated, _, status, retrigger_wait_samples = self.read_wire_outs()
                 
-                # post message if all waits are done
-                if len(self.wait_table) == self.current_wait:
-                    self.all_waits_finished.post(self.h5_file)
+                if self.current_wait < len(self.wait_table) and self.wait_samples[self.current_wait] < master_samples_generated:
+                    # a wait has happened!
+                    self.logger.debug('Master samples generated: %d'%master_samples_generated)
+                    # let's make sure 2 waits have not happened before we noticed the first...
+                    if len(self.wait_table) > self.current_wait+1:
+                        next_wait_sample = self.wait_samples[self.current_wait+1]
+                        assert next_wait_sample > master_samples_generated, 'Error: a wait happened too soon after another wait to determine the length of each wait individually.'
+                    
+                    self.logger.debug('Retrigger wait samples: %d'%retrigger_wait_samples)
+                    # store length of wait (must be stored in clock samples so that
+                    # we can subtract off this number of samples for a following wait)
+                    self.measured_waits[self.current_wait] = retrigger_wait_samples-self.measured_waits.sum()
+                    
+                    # Inform any interested parties that a wait has completed:
+                    self.wait_completed.post(self.h5_file, data=_ensure_str(self.wait_table[self.current_wait]['label']))
+                    
+                    # increment the wait we are looking for!
+                    self.current_wait += 1
+                    
+                    # post message if all waits are done
+                    if len(self.wait_table) == self.current_wait:
+                        self.logger.debug('All waits finished')
+                        self.all_waits_finished.post(self.h5_file)
                 
+                # stop when the run has finished or been aborted
+                if status & 3:
+                    break
+                time.sleep(self.wait_monitor_poll_interval)
+        except Exception:
+            self.logger.exception('Exception in wait monitor thread:')
+            # Save the exception so it can be raised in status_monitor and transition_to_manual
+            self.wait_monitor_thread_exception = sys.exc_info()
+    
+    def stop_wait_monitor(self, abort):
+        if self.wait_monitor_thread is not None:
+            if abort:
+                # The thread stops at its next poll
+                self.shutting_down = True
+            self.wait_monitor_thread.join()
+            self.wait_monitor_thread = None
+            self.shutting_down = False
+        exception = self.wait_monitor_thread_exception
+        self.wait_monitor_thread_exception = None
+        if exception is not None and not abort:
+            # Raise any unexpected errors from the wait monitor thread:
+            _reraise(*exception)
+    
+    def status_monitor(self):
+        # Raise any unexpected errors from the wait monitor thread, which handles waits
+        if self.wait_monitor_thread_exception is not None:
+            _reraise(*self.wait_monitor_thread_exception)
+            
         # check the status bits
-        status = self.dev.GetWireOutValue(0x25)
+        _, _, status, _ = self.read_wire_outs()
         assert not status & 2	# aborted
         return status & 1		# finished
         
@@ -654,6 +694,9 @@ class CiceroOpalKellyXEM3001Worker(Worker):
         #       self.wait_durations_analysed.post(self.h5_file)
     
         clock_frequency = self.connection_table_properties['clock_frequency']
+        
+        # The run has finished, so the wait monitor thread will stop after its last poll
+        self.stop_wait_monitor(abort=False)
 
         if self.wait_table is not None:
             with h5py.File(self.h5_file,'a') as hdf5_file:
@@ -680,14 +723,17 @@ class CiceroOpalKellyXEM3001Worker(Worker):
         return self.abort()
     
     def abort(self):
+        self.stop_wait_monitor(abort=True)
+        
         # Send abort signal on wire soft_abort_trig_in
-        assert self.dev.ActivateTriggerIn(0x40,1) == self.dev.NoError
+        with self.dev_lock:
+            assert self.dev.ActivateTriggerIn(0x40,1) == self.dev.NoError
         # NB: the state machine must notice first
         
         # update the locally stored current value flag (used in manual mode)
         self.current_value = 0
         
         # Read status of OPAL KELLY BOARD
-        self.dev.UpdateWireOuts()
-        return self.dev.GetWireOutValue(0x25) & 2
+        _, _, status, _ = self.read_wire_outs()
+        return status & 2
 
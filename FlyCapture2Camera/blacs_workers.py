@@ -16,11 +16,15 @@
 # Original PyCapture2_camera_server by dsbarker
 # Ported to BLACS worker by dihm
 
+from time import perf_counter
 import numpy as np
 from labscript_utils import dedent
 from enum import IntEnum
 
-from labscript_devices.IMAQdxCamera.blacs_workers import IMAQdxCameraWorker
+from labscript_devices.IMAQdxCamera.blacs_workers import (
+    IMAQdxCameraWorker,
+    FrameTelemetry,
+)
 
 # Don't import API yet so as not to throw an error, allow worker to run as a dummy
 # device, or for subclasses to import this module to inherit classes without requiring API
@@ -48,6 +52,8 @@ class FlyCapture2_Camera(object):
             Used by :obj:`_decode_image_data` to format images correctly.
         _abort_acquisition (bool): Abort flag that is polled during buffered
             acquisitions.
+        telemetry (FrameTelemetry): Per-frame timing of buffered acquisitions,
+            saved to the shot file by the worker.
     """
     def __init__(self, serial_number):
         """Initialize FlyCapture2 API camera.
@@ -91,6 +97,9 @@ class FlyCapture2_Camera(object):
         self.pixel_formats = IntEnum('pixel_formats',fmts)
 
         self._abort_acquisition = False
+        self.telemetry = FrameTelemetry()
+        # Timestamp of the most recently retrieved image, in microseconds:
+        self._last_timestamp = -1
         
         # check if GigE camera. If so, ensure max packet size is used
         cam_info = self.camera.getCameraInfo()
@@ -373,6 +382,8 @@ class FlyCapture2_Camera(object):
         """
         
         result = self.camera.retrieveBuffer()
+        timestamp = result.getTimeStamp()
+        self._last_timestamp = 1000000 * timestamp.seconds + timestamp.microSeconds
         
         img = result.getData()
         #result.ReleaseBuffer(), exists in documentation, not PyCapture2
@@ -391,19 +402,24 @@ class FlyCapture2_Camera(object):
             images (list): List that images will be saved to as they are acquired
         """
         print(f"Attempting to grab {n_images} images.")
+        self.telemetry.reset(n_images)
         for i in range(n_images):
             while True:
                 if self._abort_acquisition:
                     print("Abort during acquisition.")
                     self._abort_acquisition = False
                     return
+                grab_start_time = perf_counter()
                 try:
-                    images.append(self.grab())
-                    print(f"Got image {i+1} of {n_images}.")
-                    break
+                    image = self.grab()
                 except PyCapture2.Fc2error as e:
-                    print('.', end='')
+                    self.telemetry.timeout()
                     continue
+                self.telemetry.record(
+                    grab_start_time, sdk_timestamp=self._last_timestamp
+                )
+                images.append(image)
+                break
         print(f"Got {len(images)} of {n_images} images.")
         
     def _decode_image_data(self,img):
@@ -468,16 +484,22 @@ class FlyCapture2CameraWorker(IMAQdxCameraWorker):
     :obj:`get_attributes_as_dict` to use FlyCapture2Camera.get_attributes() method."""
     interface_class = FlyCapture2_Camera
 
-    def get_attributes_as_dict(self, visibility_level):
+    def get_attributes_as_dict(self, visibility_level, refresh=False):
         """Return a dict of the attributes of the camera for the given visibility
         level
         
+        FlyCapture2 properties are nested dictionaries read together by
+        :obj:`FlyCapture2_Camera.get_attributes`, so they are always read from
+        the camera rather than from the attribute snapshot.
+        
         Args:
             visibility_level (str): Normally configures level of attribute detail
                 to return. Is not used by FlyCapture2_Camera.
+            refresh (:obj:`bool`, optional): Whether to discard the attribute
+                snapshot. Only relevant in mock mode.
         """
         if self.mock:
-            return IMAQdxCameraWorker.get_attributes_as_dict(self,visibility_level)
+            return IMAQdxCameraWorker.get_attributes_as_dict(self,visibility_level,refresh)
         else:
             return self.camera.get_attributes(visibility_level)
 
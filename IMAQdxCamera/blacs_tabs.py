@@ -13,6 +13,8 @@
 
 import os
 import json
+import logging
+import threading
 from time import perf_counter
 import ast
 from queue import Empty
@@ -22,7 +24,7 @@ import h5py
 
 import numpy as np
 
-from qtutils import UiLoader, inmain_decorator
+from qtutils import UiLoader
 import qtutils.icons
 from qtutils.qt import QtWidgets, QtGui, QtCore
 import pyqtgraph as pg
@@ -33,6 +35,8 @@ from blacs.device_base_class import DeviceTab
 import labscript_utils.properties
 from labscript_utils.ls_zprocess import ZMQServer
 
+from .utils import handle_shot_request
+
 
 
 
@@ -48,59 +52,139 @@ def exp_av(av_old, data_new, dt, tau):
 
 class ImageReceiver(ZMQServer):
     """ZMQServer that receives images on a zmq.REP socket, replies 'ok', and updates the
-    image widget and fps indicator"""
-
-    def __init__(self, image_view, label_fps):
+    image widget and fps indicator.
+
+    Frames are decoded and transposed for display in the server's thread, which also
+    computes their levels until the first frame has been displayed, after which the
+    user's levels are kept and are not needed. Only the most recently prepared frame is
+    kept, and it is shown by a timer in the main thread at no more than
+    max_display_rate frames per second, so that the GUI stays responsive however fast
+    frames arrive. The rate at which frames are received and the rate at which they are
+    displayed are reported separately. Since frames are acknowledged before they are
+    prepared, errors in preparing them are logged to the given logger, if any, rather
+    than being sent back to the worker.
+
+    Workers using the 'zmq' image transfer mode also send requests to read from and
+    write to the shot file on this server's connection. These are distinguished from
+    frames by the 'type' key of their metadata, and are handled in the server's thread
+    by handle_shot_request(), which replies once the request is complete."""
+
+    def __init__(self, image_view, label_fps, max_display_rate=30.0, logger=None):
         ZMQServer.__init__(self, port=None, dtype='multipart')
         self.image_view = image_view
         self.label_fps = label_fps
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
         self.last_frame_time = None
         self.frame_rate = None
-        self.update_event = None
+        self.acquisition_rate = None
+        self.last_display_time = None
+        self.display_rate = None
+        # The most recently prepared frame not yet displayed, and its levels. Shared
+        # between the server thread and the main thread:
+        self.lock = threading.Lock()
+        self.pending_image = None
+        self.pending_levels = None
+        # Whether a frame has been displayed yet, after which levels are not needed:
+        self.image_shown = False
+        # Created in the main thread, since that is where the tab instantiates us:
+        self.display_timer = QtCore.QTimer()
+        self.display_timer.timeout.connect(self.update_display)
+        self.display_timer.start(int(1000 / max_display_rate))
 
-    @inmain_decorator(wait_for_return=True)
     def handler(self, data):
-        # Acknowledge immediately so that the worker process can begin acquiring the
-        # next frame. This increases the possible frame rate since we may render a frame
-        # whilst acquiring the next, but does not allow us to accumulate a backlog since
-        # only one call to this method may occur at a time.
-        self.send([b'ok'])
         md = json.loads(data[0])
-        image = np.frombuffer(memoryview(data[1]), dtype=md['dtype'])
+        if md.get('type', 'frame') != 'frame':
+            return handle_shot_request(md, data[1:])
+        # Acknowledge immediately so that the worker process can begin sending the next
+        # frame whilst we prepare this one. This cannot accumulate a backlog since only
+        # one call to this method may occur at a time.
+        self.send([b'ok'])
+        try:
+            self.prepare_image(md, data[1])
+        except Exception:
+            # We have already replied, so the exception must not propagate to the
+            # server, which would try to reply again and fail:
+            self.logger.exception("Failed to prepare image for display")
+        return self.NO_RESPONSE
+
+    def prepare_image(self, md, image_data):
+        """Decode a frame, update the frame rates and make the frame the one next to
+        be displayed"""
+        image = np.frombuffer(memoryview(image_data), dtype=md['dtype'])
         image = image.reshape(md['shape'])
+        # Frames acquired but dropped by the worker since the previous frame sent:
+        n_dropped = md.get('n_dropped', 0)
         this_frame_time = perf_counter()
-        if self.last_frame_time is not None:
-            dt = this_frame_time - self.last_frame_time
-            if self.frame_rate is not None:
-                # Exponential moving average of the frame rate over 1 second:
-                self.frame_rate = exp_av(self.frame_rate, 1 / dt, dt, 1.0)
+        with self.lock:
+            if self.last_frame_time is not None:
+                dt = this_frame_time - self.last_frame_time
+                if self.frame_rate is not None:
+                    # Exponential moving average of the frame rate over 1 second:
+                    self.frame_rate = exp_av(self.frame_rate, 1 / dt, dt, 1.0)
+                    self.acquisition_rate = exp_av(
+                        self.acquisition_rate, (1 + n_dropped) / dt, dt, 1.0
+                    )
+                else:
+                    self.frame_rate = 1 / dt
+                    self.acquisition_rate = (1 + n_dropped) / dt
+            self.last_frame_time = this_frame_time
+            image_shown = self.image_shown
+        # pyqtgraph expects images indexed [x, y]. Copying into a contiguous array here
+        # saves pyqtgraph from doing the equivalent work in the main thread:
+        image = np.ascontiguousarray(image.swapaxes(-1, -2))
+        if image_shown:
+            levels = None
+        else:
+            levels = (float(image.min()), float(image.max()))
+        with self.lock:
+            # Replace any frame not yet displayed:
+            self.pending_image = image
+            self.pending_levels = levels
+
+    def update_display(self):
+        """Called periodically in the main thread. Show the newest prepared frame, if
+        any, and update the fps indicator"""
+        with self.lock:
+            image = self.pending_image
+            levels = self.pending_levels
+            self.pending_image = None
+            self.pending_levels = None
+            frame_rate = self.frame_rate
+            acquisition_rate = self.acquisition_rate
+        if image is None:
+            return
+        this_display_time = perf_counter()
+        if self.last_display_time is not None:
+            dt = this_display_time - self.last_display_time
+            if self.display_rate is not None:
+                self.display_rate = exp_av(self.display_rate, 1 / dt, dt, 1.0)
             else:
-                self.frame_rate = 1 / dt
-        self.last_frame_time = this_frame_time
+                self.display_rate = 1 / dt
+        self.last_display_time = this_display_time
         if self.image_view.image is None:
-            # First time setting an image. Do autoscaling etc:
-            self.image_view.setImage(image.swapaxes(-1, -2))
+            # First time setting an image. Do autoscaling etc, using the levels
+            # computed in the server thread if it computed them:
+            self.image_view.setImage(image, levels=levels, autoLevels=levels is None)
+            with self.lock:
+                self.image_shown = True
         else:
             # Updating image. Keep zoom/pan/levels/etc settings.
-            self.image_view.setImage(
-                image.swapaxes(-1, -2), autoRange=False, autoLevels=False
-            )
+            self.image_view.setImage(image, autoRange=False, autoLevels=False)
         # Update fps indicator:
-        if self.frame_rate is not None:
-            self.label_fps.setText(f"{self.frame_rate:.01f} fps")
-
-        # Tell Qt to send posted events immediately to prevent a backlog of paint events
-        # and other low-priority events. It seems that we cannot make our qtutils
-        # CallEvents (which are used to call this method in the main thread) low enough
-        # priority to ensure all other occur before our next call to self.handler()
-        # runs. This may be because the CallEvents used by qtutils.invoke_in_main have
-        # their own event handler (qtutils.invoke_in_main.Caller), perhaps posted event
-        # priorities are only meaningful within the context of a single event handler,
-        # and not for the Qt event loop as a whole. In any case, this seems to fix it.
-        # Manually calling this is usually a sign of bad coding, but I think it is the
-        # right solution to this problem. This solves issue #36.
-        QtGui.QApplication.instance().sendPostedEvents()
-        return self.NO_RESPONSE
+        if frame_rate is not None:
+            text = f"{frame_rate:.01f} fps"
+            if self.display_rate is not None:
+                text += f", {self.display_rate:.01f} displayed"
+            drop_rate = 1 - frame_rate / acquisition_rate
+            if drop_rate > 0.005:
+                text += f" ({100 * drop_rate:.0f}% dropped)"
+            self.label_fps.setText(text)
+
+    def shutdown(self):
+        self.display_timer.stop()
+        ZMQServer.shutdown(self)
 
 
 class IMAQdxCameraTab(DeviceTab):
@@ -160,7 +244,9 @@ class IMAQdxCameraTab(DeviceTab):
                 widget.setSizePolicy(size_policy)
 
         # Start the image receiver ZMQ server:
-        self.image_receiver = ImageReceiver(self.image, self.ui.label_fps)
+        self.image_receiver = ImageReceiver(
+            self.image, self.ui.label_fps, logger=self.logger
+        )
         self.acquiring = False
 
         self.supports_smart_programming(self.use_smart_programming) 
@@ -205,7 +291,13 @@ class IMAQdxCameraTab(DeviceTab):
                 'manual_mode_camera_attributes'
             ],
             'mock': connection_table_properties['mock'],
+            'live_view_binning': connection_table_properties.get(
+                'live_view_binning', 1
+            ),
             'image_receiver_port': self.image_receiver.port,
+            'image_transfer': connection_table_properties.get(
+                'image_transfer', 'direct'
+            ),
         }
         self.create_worker(
             'main_worker', self.worker_class, worker_initialisation_kwargs
@@ -15,20 +15,38 @@
 # Refactored as a BLACS worker by cbillington
 
 
+import os
 import sys
+import json
+import pickle
+import time
+import zlib
+import tempfile
 from time import perf_counter
+from queue import Queue, Empty
 from blacs.tab_base_classes import Worker
 import threading
 import numpy as np
 from labscript_utils import dedent
 import labscript_utils.h5_lock
 import h5py
-import labscript_utils.properties
 import zmq
 
 from labscript_utils.ls_zprocess import Context
 from labscript_utils.shared_drive import path_to_local
 from labscript_utils.properties import set_attributes
+from labscript_utils.connections import _ensure_str
+
+from .utils import (
+    check_image_storage,
+    dataset_kwargs,
+    check_image_reduction,
+    reduce_frame,
+    reduced_frame_format,
+    roi_sums,
+    read_shot_properties,
+    write_image_file,
+)
 
 # Required for knowing the parent device's hostname when running remotely:
 from labscript_utils import check_version
@@ -66,63 +84,378 @@ def _monkeypatch_imaqdispose():
     nivision.core.imaqDispose = nv.imaqDispose = imaqDispose
 
 
+def wait_until_stable(get_value, stable_time, max_time, poll_interval=1e-3):
+    """Poll get_value() until its return value has not changed for stable_time
+    seconds, or until max_time seconds have elapsed, whichever is sooner, and return
+    the last value"""
+    start_time = changed_time = perf_counter()
+    value = get_value()
+    while True:
+        now = perf_counter()
+        if now - changed_time >= stable_time or now - start_time >= max_time:
+            return value
+        time.sleep(poll_interval)
+        new_value = get_value()
+        if new_value != value:
+            value = new_value
+            changed_time = perf_counter()
+
+
+class FrameTelemetry(object):
+    """Record of the timing of each frame acquired during a buffered shot, saved by the
+    worker to the shot file as a table. Camera classes call reset() when buffered
+    acquisition begins, timeout() whenever a grab times out, and record() for each
+    frame acquired. Rather than printing a message for every frame, progress is printed
+    at most once every log_interval seconds.
+
+    Columns of the table are: the time in seconds since reset() at which the frame was
+    received; the frame number and timestamp reported by the camera's SDK, in the
+    SDK's own units, or -1 if not available; the time in seconds spent in the call that
+    retrieved the frame; the number of acquired frames not yet written to the shot file
+    when the frame was received, or -1 if not known; and the number of grabs that timed
+    out since the previous frame."""
+
+    dtype = [
+        ('host_time', float),
+        ('frame_number', np.int64),
+        ('sdk_timestamp', np.int64),
+        ('grab_duration', float),
+        ('buffer_occupancy', np.int32),
+        ('timeouts', np.int32),
+    ]
+
+    # Minimum time between progress messages, in seconds:
+    log_interval = 1.0
+
+    def __init__(self):
+        # Callable returning the number of frames not yet written to the shot file.
+        # Set by the worker:
+        self.backlog = None
+        self.reset()
+
+    def reset(self, n_images=None):
+        """Clear the table, and measure times relative to now"""
+        self.n_images = n_images
+        self.rows = []
+        self.start_time = perf_counter()
+        # For converting host_time to an absolute time:
+        self.start_walltime = time.time()
+        self.last_log_time = self.start_time
+        self.n_timeouts = 0
+        self.total_timeouts = 0
+
+    def timeout(self):
+        self.n_timeouts += 1
+        self.total_timeouts += 1
+        self.log_progress()
+
+    def record(self, grab_start_time, frame_number=-1, sdk_timestamp=-1):
+        """Add a row to the table for a frame just received, given the perf_counter()
+        time at which the call that retrieved it began"""
+        now = perf_counter()
+        buffer_occupancy = self.backlog() if self.backlog is not None else -1
+        self.rows.append(
+            (
+                now - self.start_time,
+                frame_number,
+                sdk_timestamp,
+                now - grab_start_time,
+                buffer_occupancy,
+                self.n_timeouts,
+            )
+        )
+        self.n_timeouts = 0
+        self.log_progress()
+
+    def log_progress(self, force=False):
+        """Print the number of frames received so far, unless a message was printed
+        less than log_interval seconds ago and force is False"""
+        now = perf_counter()
+        if not force and now - self.last_log_time < self.log_interval:
+            return
+        self.last_log_time = now
+        msg = f"Got {len(self.rows)}"
+        if self.n_images is not None:
+            msg += f" of {self.n_images}"
+        msg += " images"
+        if self.total_timeouts:
+            msg += f" ({self.total_timeouts} grab timeouts)"
+        print(msg + '.')
+
+    def table(self):
+        """Return the table as a structured array"""
+        return np.array(self.rows, dtype=self.dtype)
+
+
+class MockTimeoutError(Exception):
+    """Raised by MockCamera.grab() when no frame arrives within the grab timeout"""
+
+
 class MockCamera(object):
-    """Mock camera class that returns fake image data."""
+    """Mock camera class that returns fake image data, for testing and benchmarking
+    without hardware. It has the same interface as the camera classes for real
+    cameras, and the behaviour of the simulated camera is configured with the
+    following attributes, which may be set via camera_attributes like those of a real
+    camera:
+
+    * Width, Height: image size in pixels.
+    * PixelFormat: 'Mono8', 'Mono12' or 'Mono16'. Mono12 images are stored as uint16.
+    * AcquisitionFrameRate: rate in frames per second at which frames arrive during
+      acquisition. Zero means frames are available immediately when grabbed.
+    * TriggerMode: 'On' or 'Off'. If 'On', each frame arrives TriggerLatency seconds
+      later than it would in free-running mode, simulating a delay between a trigger
+      and the camera delivering the resulting frame.
+    * TriggerLatency: see TriggerMode.
+    * GrabTimeout: how long in seconds grab() waits for a frame before raising
+      MockTimeoutError.
+    * TimeoutProbability: probability that a grab() times out even though a frame
+      was due, simulating an unreliable connection. The frame is not lost.
+    * DropProbability: probability that each frame is dropped, never being returned
+      by grab().
+    * Content: 'static' to return the same precomputed frame every time, 'cycle' to
+      cycle through a few precomputed frames with different noise, or 'poisson' to
+      compute a new frame with Poisson noise every time, which is realistic but slow.
+
+    Frames are precomputed when acquisition is configured or an image attribute
+    changes, so that producing a frame during acquisition costs little more than a
+    copy."""
+
+    default_attributes = {
+        'Width': 500,
+        'Height': 500,
+        'PixelFormat': 'Mono16',
+        'AcquisitionFrameRate': 0.0,
+        'TriggerMode': 'Off',
+        'TriggerLatency': 0.0,
+        'GrabTimeout': 1.0,
+        'TimeoutProbability': 0.0,
+        'DropProbability': 0.0,
+        'Content': 'cycle',
+    }
+
+    # Number of different frames to cycle through if Content is 'cycle':
+    n_cycle_frames = 16
 
     def __init__(self):
         print("Starting device worker as a mock device")
-        self.attributes = {}
+        self.attributes = dict(self.default_attributes)
+        self.telemetry = FrameTelemetry()
+        self._abort_acquisition = False
+        # Number of calls that would have been made to the SDK, for benchmarking:
+        self.n_sdk_calls = 0
+        # Simulated time taken to start and stop acquisition, and whether a running
+        # acquisition can be reconfigured without stopping it:
+        self.acquisition_start_delay = 0
+        self.acquisition_stop_delay = 0
+        self.reconfigurable = True
+        # Statistics of the simulated acquisition:
+        self.n_frames_delivered = 0
+        self.n_frames_dropped = 0
+        self.n_timeouts = 0
+        self.random = np.random.RandomState()
+        self.clean_image = None
+        self.frames = None
+        self.acquisition_start_time = None
+        self.next_frame_number = 0
 
     def set_attributes(self, attributes):
-        self.attributes.update(attributes)
+        self.n_sdk_calls += len(attributes)
+        for name, value in attributes.items():
+            if name in ['Width', 'Height', 'PixelFormat', 'Content']:
+                # Frames must be recomputed:
+                self.clean_image = None
+                self.frames = None
+            if name == 'PixelFormat' and value not in ['Mono8', 'Mono12', 'Mono16']:
+                raise ValueError(f"Unsupported (mock) PixelFormat {value}")
+            self.attributes[name] = value
 
     def get_attribute(self, name):
+        self.n_sdk_calls += 1
         return self.attributes[name]
 
-    def get_attribute_names(self, visibility_level=None):
+    def get_attribute_names(self, visibility_level=None, writeable_only=True):
+        self.n_sdk_calls += 1
         return list(self.attributes.keys())
 
+    @property
+    def dtype(self):
+        return np.uint8 if self.attributes['PixelFormat'] == 'Mono8' else np.uint16
+
+    @property
+    def max_value(self):
+        return {'Mono8': 255, 'Mono12': 4095, 'Mono16': 65535}[
+            self.attributes['PixelFormat']
+        ]
+
+    def _compute_clean_image(self):
+        """Compute a noise-free image of a Gaussian dip with "NOT REAL DATA" written on
+        it, scaled to the pixel format's range"""
+        height, width = self.attributes['Height'], self.attributes['Width']
+        x = np.linspace(-5, 5, width)
+        y = np.linspace(-5, 5, height).reshape((height, 1))
+        # Leave headroom for noise:
+        A = 0.5 * self.max_value
+        clean_image = A * (1 - 0.5 * np.exp(-(x ** 2 + y ** 2)))
+        try:
+            from PIL import Image, ImageDraw, ImageFont
+        except ImportError:
+            # The text is just decoration, don't require PIL for it:
+            return clean_image
+        # Write text on the image that says "NOT REAL DATA"
+        font = ImageFont.load_default()
+        canvas = Image.new('L', [max(width // 5, 1), max(height // 5, 1)], (0,))
+        draw = ImageDraw.Draw(canvas)
+        draw.text((10, 20), "NOT REAL DATA", font=font, fill=1)
+        text = np.asarray(canvas.resize((width, height)).rotate(20))
+        return clean_image + 0.2 * A * text
+
+    def _noisy_image(self):
+        if self.clean_image is None:
+            self.clean_image = self._compute_clean_image()
+        # Scale noise so that it is visible regardless of bit depth:
+        scale = self.max_value / 1000
+        image = scale * self.random.poisson(self.clean_image / scale)
+        return np.clip(image, 0, self.max_value).astype(self.dtype)
+
+    def _prepare_frames(self):
+        """Precompute the frames to be returned, according to the Content attribute"""
+        content = self.attributes['Content']
+        if content == 'static':
+            self.frames = [self._noisy_image()]
+        elif content == 'cycle':
+            self.frames = [self._noisy_image() for _ in range(self.n_cycle_frames)]
+        elif content == 'poisson':
+            self.frames = []
+        else:
+            raise ValueError(f"Unknown (mock) Content {content}")
+
+    def _make_frame(self, frame_number):
+        if self.frames is None:
+            self._prepare_frames()
+        if self.frames:
+            image = self.frames[frame_number % len(self.frames)]
+        else:
+            image = self._noisy_image()
+        return image.copy()
+
+    def _frame_arrival_time(self, frame_number):
+        """The perf_counter() time at which the given frame of the current
+        acquisition arrives"""
+        t = self.acquisition_start_time
+        rate = self.attributes['AcquisitionFrameRate']
+        if rate:
+            t += (frame_number + 1) / rate
+        if self.attributes['TriggerMode'] == 'On':
+            t += self.attributes['TriggerLatency']
+        return t
+
     def configure_acquisition(self, continuous=False, bufferCount=5):
-        pass
+        time.sleep(self.acquisition_start_delay)
+        if self.frames is None:
+            self._prepare_frames()
+        self.acquisition_start_time = perf_counter()
+        self.next_frame_number = 0
+
+    def reconfigure_acquisition(self, continuous=False, bufferCount=5):
+        return self.reconfigurable
+
+    def _last_buffer_number(self):
+        """Number of the most recent frame of the running acquisition to have
+        arrived, the analogue of IMAQdx's StatusInformation::LastBufferNumber"""
+        rate = self.attributes['AcquisitionFrameRate']
+        if not rate:
+            # Frames are produced on demand, so only those grabbed have arrived:
+            return self.next_frame_number - 1
+        return int((perf_counter() - self._frame_arrival_time(-1)) * rate) - 1
+
+    def flush_acquisition(self):
+        """Discard frames acquired so far by the running acquisition, waiting for them
+        to stop arriving as IMAQdx_Camera.flush_acquisition() does"""
+        wait_until_stable(
+            self._last_buffer_number,
+            IMAQdx_Camera.flush_stable_time,
+            IMAQdx_Camera.flush_settle_time,
+        )
+        self.acquisition_start_time = perf_counter()
+        self.next_frame_number = 0
 
     def grab(self):
-        return self.snap()
+        """Wait for the next frame to arrive and return it. Raise MockTimeoutError if
+        no frame arrives within GrabTimeout seconds."""
+        if self.acquisition_start_time is None:
+            raise RuntimeError("(mock) acquisition not configured")
+        # Skip any dropped frames:
+        while self.random.random_sample() < self.attributes['DropProbability']:
+            self.next_frame_number += 1
+            self.n_frames_dropped += 1
+        timeout = self.attributes['GrabTimeout']
+        arrival_time = self._frame_arrival_time(self.next_frame_number)
+        wait_time = arrival_time - perf_counter()
+        if self.random.random_sample() < self.attributes['TimeoutProbability']:
+            wait_time = timeout + 1
+        if wait_time > timeout:
+            time.sleep(timeout)
+            self.n_timeouts += 1
+            raise MockTimeoutError("(mock) grab timed out")
+        if wait_time > 0:
+            time.sleep(wait_time)
+        image = self._make_frame(self.next_frame_number)
+        self.next_frame_number += 1
+        self.n_frames_delivered += 1
+        return image
 
     def grab_multiple(self, n_images, images, waitForNextBuffer=True):
         print(f"Attempting to grab {n_images} (mock) images.")
+        self.telemetry.reset(n_images)
         for i in range(n_images):
-            images.append(self.grab())
-            print(f"Got (mock) image {i+1} of {n_images}.")
+            while True:
+                if self._abort_acquisition:
+                    print("Abort during acquisition.")
+                    self._abort_acquisition = False
+                    return
+                grab_start_time = perf_counter()
+                try:
+                    image = self.grab()
+                except MockTimeoutError:
+                    self.telemetry.timeout()
+                    continue
+                frame_number = self.next_frame_number - 1
+                arrival_time = self._frame_arrival_time(frame_number)
+                self.telemetry.record(
+                    grab_start_time, frame_number, int(arrival_time * 1e9)
+                )
+                images.append(image)
+                break
         print(f"Got {len(images)} of {n_images} (mock) images.")
 
     def snap(self):
-        N = 500
-        A = 500
-        x = np.linspace(-5, 5, 500)
-        y = x.reshape((N, 1))
-        clean_image = A * (1 - 0.5 * np.exp(-(x ** 2 + y ** 2)))
-
-        # Write text on the image that says "NOT REAL DATA"
-        from PIL import Image, ImageDraw, ImageFont
-
-        font = ImageFont.load_default()
-        canvas = Image.new('L', [N // 5, N // 5], (0,))
-        draw = ImageDraw.Draw(canvas)
-        draw.text((10, 20), "NOT REAL DATA", font=font, fill=1)
-        clean_image += 0.2 * A * np.asarray(canvas.resize((N, N)).rotate(20))
-        return np.random.poisson(clean_image)
+        if self.frames is None:
+            self._prepare_frames()
+        image = self._make_frame(self.random.randint(self.n_cycle_frames))
+        if self.attributes['TriggerMode'] == 'On':
+            time.sleep(self.attributes['TriggerLatency'])
+        return image
 
     def stop_acquisition(self):
-        pass
+        time.sleep(self.acquisition_stop_delay)
+        self.acquisition_start_time = None
 
     def abort_acquisition(self):
-        pass
+        self._abort_acquisition = True
 
     def close(self):
         pass
 
 
 class IMAQdx_Camera(object):
+    # flush_acquisition() waits until no new frame has arrived for flush_stable_time
+    # seconds, so that a frame that was being exposed or read out is discarded too, but
+    # for no longer than flush_settle_time seconds in all, since frames never stop
+    # arriving from a free-running camera. Subclasses for cameras with exposures or
+    # readouts longer than flush_stable_time should increase it:
+    flush_stable_time = 0.02
+    flush_settle_time = 0.1
+
     def __init__(self, serial_number):
         global nv
         import nivision as nv
@@ -145,6 +478,16 @@ class IMAQdx_Camera(object):
         # Keep an img attribute so we don't have to create it every time
         self.img = nv.imaqCreateImage(nv.IMAQ_IMAGE_U16)
         self._abort_acquisition = False
+        # Configuration of the running acquisition, if any:
+        self._continuous = None
+        self._bufferCount = None
+        # Per-frame timing of buffered acquisition, saved to the shot file by the worker:
+        self.telemetry = FrameTelemetry()
+        # Number of the buffer most recently returned by IMAQdxGrab:
+        self._last_buffer_number = -1
+        # Buffers numbered lower than this were flushed, and are not to be returned by
+        # grab_multiple():
+        self._first_buffer_number = 0
 
     def set_attributes(self, attr_dict):
         for k, v in attr_dict.items():
@@ -203,33 +546,69 @@ class IMAQdx_Camera(object):
             self.imaqdx, continuous=continuous, bufferCount=bufferCount
         )
         nv.IMAQdxStartAcquisition(self.imaqdx)
+        self._continuous = continuous
+        self._bufferCount = bufferCount
+        self._first_buffer_number = 0
+
+    def reconfigure_acquisition(self, continuous=True, bufferCount=5):
+        """Return whether the running acquisition can be used as is for the requested
+        configuration. A continuous acquisition can be used for buffered acquisition of
+        up to as many images as it has buffers, since grab() waits for each new
+        buffer. A buffered (one-shot) acquisition cannot be reused, as it stops after
+        its last buffer."""
+        if not self._continuous:
+            return False
+        return continuous or bufferCount <= self._bufferCount
+
+    def flush_acquisition(self):
+        """Discard the frames acquired so far by the running acquisition, including
+        any frame in flight, so that grab_multiple() only returns frames acquired
+        afterwards"""
+        last_buffer_number = wait_until_stable(
+            lambda: nv.IMAQdxGetAttribute(
+                self.imaqdx, b'StatusInformation::LastBufferNumber'
+            ),
+            self.flush_stable_time,
+            self.flush_settle_time,
+        )
+        self._first_buffer_number = last_buffer_number + 1
 
     def grab(self, waitForNextBuffer=True):
-        nv.IMAQdxGrab(self.imaqdx, self.img, waitForNextBuffer=waitForNextBuffer)
+        self._last_buffer_number = nv.IMAQdxGrab(
+            self.imaqdx, self.img, waitForNextBuffer=waitForNextBuffer
+        )
         return self._decode_image_data(self.img)
 
     def grab_multiple(self, n_images, images, waitForNextBuffer=True):
         print(f"Attempting to grab {n_images} images.")
+        self.telemetry.reset(n_images)
         for i in range(n_images):
             while True:
                 if self._abort_acquisition:
                     print("Abort during acquisition.")
                     self._abort_acquisition = False
                     return
+                grab_start_time = perf_counter()
                 try:
-                    images.append(self.grab(waitForNextBuffer))
-                    print(f"Got image {i+1} of {n_images}.")
-                    break
+                    image = self.grab(waitForNextBuffer)
                 except nv.ImaqDxError as e:
                     if e.code == nv.IMAQdxErrorTimeout.value:
-                        print('.', end='')
+                        self.telemetry.timeout()
                         continue
                     raise
+                if self._last_buffer_number < self._first_buffer_number:
+                    # Acquired before the acquisition was flushed:
+                    continue
+                self.telemetry.record(grab_start_time, self._last_buffer_number)
+                images.append(image)
+                break
         print(f"Got {len(images)} of {n_images} images.")
 
     def stop_acquisition(self):
         nv.IMAQdxStopAcquisition(self.imaqdx)
         nv.IMAQdxUnconfigureAcquisition(self.imaqdx)
+        self._continuous = None
+        self._bufferCount = None
 
     def abort_acquisition(self):
         self._abort_acquisition = True
@@ -247,19 +626,561 @@ class IMAQdx_Camera(object):
         nv.IMAQdxCloseCamera(self.imaqdx)
 
 
+class ImageSender(object):
+    """Sends frames to the parent process for display from a separate thread, so that
+    the rate of acquisition does not depend on how fast the GUI can display frames.
+    Only the most recently acquired frame is kept waiting to be sent: if a new frame is
+    given to send() whilst the previous one is still waiting, the previous frame is
+    dropped. Frames may optionally be binned before sending, reducing the amount of
+    data to be transferred and displayed. The number of frames dropped since the
+    previous frame sent is included in the metadata sent with each frame. Frames are sent on a zmq REQ socket connected to the given
+    address, which is replaced with a new connection if sending a frame fails. Other
+    requests may be sent to the parent on the same connection with request()."""
+
+    # Interval in seconds at which a request awaiting its reply checks whether stop()
+    # has been called, so that stopping does not hang if the parent has gone away:
+    poll_interval = 0.1
+
+    def __init__(self, address, binning=1):
+        self.address = address
+        self.socket = self.connect()
+        # Held whilst using the socket, since request() may be called from other
+        # threads than the sender thread:
+        self.socket_lock = threading.Lock()
+        self.binning = binning
+        self.condition = threading.Condition()
+        self.pending = None
+        self.stopping = False
+        # Frames dropped since the last frame sent, and totals:
+        self.n_dropped_since_sent = 0
+        self.n_offered = 0
+        self.n_dropped = 0
+        self.thread = threading.Thread(target=self.mainloop, daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        socket = Context().socket(zmq.REQ)
+        socket.connect(self.address)
+        return socket
+
+    def request(self, metadata, *data):
+        """Send a message consisting of the given metadata as JSON followed by the given
+        bytes-like objects to the parent, and return the parts of its reply. Blocks
+        until the reply is received, or raises RuntimeError if stop() is called in the
+        meantime."""
+        with self.socket_lock:
+            try:
+                self.socket.send_json(metadata, zmq.SNDMORE if data else 0)
+                for i, part in enumerate(data, 1):
+                    flags = zmq.SNDMORE if i < len(data) else 0
+                    self.socket.send(part, flags, copy=False)
+                while not self.socket.poll(int(self.poll_interval * 1000)):
+                    if self.stopping:
+                        raise RuntimeError("ImageSender stopped awaiting reply")
+                return self.socket.recv_multipart()
+            except Exception:
+                # The REQ socket may be left expecting a reply that will never come,
+                # in which case it cannot send again. Start afresh:
+                self.socket.close(linger=0)
+                self.socket = self.connect()
+                raise
+
+    def send(self, image):
+        """Queue an image to be sent to the parent, replacing any image not yet sent.
+        Does not block."""
+        with self.condition:
+            if self.pending is not None:
+                self.n_dropped_since_sent += 1
+                self.n_dropped += 1
+            self.pending = image
+            self.n_offered += 1
+            self.condition.notify()
+
+    @property
+    def drop_rate(self):
+        """Fraction of all frames given to send() that have been dropped"""
+        if not self.n_offered:
+            return 0.0
+        return self.n_dropped / self.n_offered
+
+    def bin_image(self, image):
+        """Return the image binned by averaging blocks of self.binning x
+        self.binning pixels. Rows and columns that do not fill a whole block are
+        discarded"""
+        n = self.binning
+        if n == 1:
+            return image
+        height, width = image.shape[-2] // n, image.shape[-1] // n
+        blocks = image[..., : height * n, : width * n].reshape(
+            image.shape[:-2] + (height, n, width, n)
+        )
+        return blocks.mean(axis=(-3, -1)).astype(image.dtype)
+
+    def mainloop(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                image = self.pending
+                self.pending = None
+                n_dropped = self.n_dropped_since_sent
+                self.n_dropped_since_sent = 0
+            try:
+                data = self.bin_image(image)
+                metadata = dict(
+                    dtype=str(data.dtype), shape=data.shape, n_dropped=n_dropped
+                )
+                response = self.request(metadata, data)
+                assert response == [b'ok'], response
+            except Exception:
+                # Don't let a failure to display a frame kill the thread:
+                if not self.stopping:
+                    import traceback
+
+                    traceback.print_exc()
+
+    def stop(self):
+        """Stop the sender thread, discarding any frame not yet sent, and close the
+        connection to the parent"""
+        with self.condition:
+            self.stopping = True
+            self.pending = None
+            self.condition.notify()
+        self.thread.join()
+        with self.socket_lock:
+            self.socket.close(linger=0)
+
+
+class ImageWriter(object):
+    """Sink for the frames of a buffered shot that writes them to the shot file as they
+    arrive, rather than after the shot. The camera's grab_multiple() method appends
+    frames to this object as if it were a list. Frames are matched up with the expected
+    exposures in order of exposure time, and are written by a writer thread into
+    frame-chunked datasets, one dataset per (name, frametype) pair. The h5 file is only
+    held open whilst a batch of frames is being written, so that other workers may
+    access the shot file in the meantime. Call finalise() after acquisition is complete
+    to wait for all frames to be written and to save the remaining metadata. Datasets
+    are created according to the given image storage policy, and frames are reduced
+    according to the given image reduction settings, overridden by those of individual
+    exposures, if any. See IMAQdxCamera.__init__() for details.
+
+    If the shape and dtype of the frames the camera will produce are given, all
+    datasets are created in advance, so that creating them does not delay writing the
+    first frames. Otherwise, or if a dataset's first frame turns out not to match, the
+    dataset is created when its first frame arrives."""
+
+    def __init__(
+        self,
+        h5_filepath,
+        image_path,
+        device_name,
+        exposures,
+        image_storage=None,
+        image_reduction=None,
+        frame_shape=None,
+        frame_dtype=None,
+    ):
+        self.h5_filepath = h5_filepath
+        self.image_path = image_path
+        self.n_images = len(exposures)
+        self.image_storage = check_image_storage(image_storage)
+
+        # Work out which dataset, and which index within it, each frame will be saved
+        # to. Datasets with a single frame are saved as 2D arrays, those with more than
+        # one as a 3D array of frames:
+        exposures = np.sort(exposures, order='t')
+        keys = [
+            (_ensure_str(exposure['name']), _ensure_str(exposure['frametype']))
+            for exposure in exposures
+        ]
+        self.frames_per_dataset = {key: keys.count(key) for key in keys}
+        self.frame_slots = []
+        n_assigned = {key: 0 for key in self.frames_per_dataset}
+        for key in keys:
+            if self.frames_per_dataset[key] == 1:
+                self.frame_slots.append((key, None))
+            else:
+                self.frame_slots.append((key, n_assigned[key]))
+            n_assigned[key] += 1
+        # How many frames have been written to each dataset so far:
+        self.frames_written = {key: 0 for key in self.frames_per_dataset}
+        # (name, dataset name) of image datasets checked against the frames written:
+        self.datasets_checked = set()
+
+        # The image reduction, if any, for each dataset:
+        self.reductions = {}
+        for exposure, key in zip(exposures, keys):
+            reduction = dict(image_reduction or {})
+            if 'reduction' in exposures.dtype.names and exposure['reduction']:
+                reduction.update(json.loads(exposure['reduction']))
+            self.reductions[key] = check_image_reduction(reduction)
+        # Pairs of datasets (name, frametype, background_frametype) for which
+        # background-subtracted frames are to be saved, and the reduced frames of each
+        # pair received so far, keyed by (name, frametype, index):
+        self.background_pairs = []
+        for (name, frametype), reduction in self.reductions.items():
+            if reduction is None or frametype not in reduction['background']:
+                continue
+            background = reduction['background'][frametype]
+            if (name, background) not in self.frames_per_dataset:
+                msg = f"No '{background}' frames of '{name}' to subtract as background"
+                raise ValueError(msg)
+            n_frames = self.frames_per_dataset[(name, frametype)]
+            if self.frames_per_dataset[(name, background)] != n_frames:
+                msg = f"""Cannot subtract '{background}' frames of '{name}' from
+                    '{frametype}' frames, as their numbers differ"""
+                raise ValueError(dedent(msg))
+            background_reduction = self.reductions[(name, background)]
+            if background_reduction is None:
+                background_geometry = (None, (1, 1))
+            else:
+                background_geometry = (
+                    background_reduction['roi'],
+                    background_reduction['binning'],
+                )
+            if background_geometry != (reduction['roi'], reduction['binning']):
+                msg = f"""'{background}' frames of '{name}' must have the same roi and
+                    binning as '{frametype}' frames in order to subtract them"""
+                raise ValueError(dedent(msg))
+            self.background_pairs.append((name, frametype, background))
+        self.paired_keys = set()
+        for name, frametype, background in self.background_pairs:
+            self.paired_keys.update([(name, frametype), (name, background)])
+        self.paired_frames = {}
+
+        with h5py.File(self.h5_filepath, 'a') as f:
+            image_group = f.require_group(self.image_path)
+            image_group.attrs['camera'] = device_name
+            for name, _ in self.frames_per_dataset:
+                image_group.require_group(name)
+            if frame_shape is not None:
+                self.create_datasets(image_group, tuple(frame_shape), frame_dtype)
+
+        self.n_received = 0
+        self.queue = Queue()
+        self.writer_thread_exception = None
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def append(self, image):
+        """Queue a frame to be written to the shot file. Frames in excess of the number
+        of expected exposures are discarded"""
+        if self.n_received < self.n_images:
+            self.queue.put((self.n_received, image))
+        self.n_received += 1
+
+    def __len__(self):
+        return self.n_received
+
+    def backlog(self):
+        """Return the number of frames queued but not yet written"""
+        return self.queue.qsize()
+
+    def writer_loop(self):
+        finished = False
+        while not finished:
+            frames = [self.queue.get()]
+            # Write all frames that are available in a single opening of the file:
+            while True:
+                try:
+                    frames.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if frames[-1] is None:
+                frames.pop()
+                finished = True
+            if not frames or self.writer_thread_exception is not None:
+                continue
+            try:
+                with h5py.File(self.h5_filepath, 'a') as f:
+                    image_group = f[self.image_path]
+                    for i, image in frames:
+                        self.write_frame(image_group, i, image)
+            except Exception:
+                # Save the exception so that it can be raised in finalise(). Continue
+                # draining the queue so that finalise() does not block:
+                self.writer_thread_exception = sys.exc_info()
+
+    def create_datasets(self, image_group, frame_shape, frame_dtype):
+        """Create the datasets for all frames, given the shape and dtype of the frames
+        the camera will produce"""
+        for key in self.frames_per_dataset:
+            name, frametype = key
+            group = image_group[name]
+            reduction = self.reductions[key]
+            shape, dtype = frame_shape, np.dtype(frame_dtype)
+            if reduction is not None:
+                shape, dtype = reduced_frame_format(shape, dtype, reduction)
+                if reduction['roi_sums']:
+                    self.roi_sums_dataset(group, key)
+            if 0 in shape:
+                # The roi is outside the expected frame. Leave it to write_frame() to
+                # create datasets if the actual frames differ from those expected:
+                continue
+            if reduction is None or reduction['save_frames']:
+                stored_dtype = self.stored_dtype(dtype, frame_dtype)
+                self.create_image_dataset(group, key, frametype, shape, stored_dtype)
+            for pair_name, pair_frametype, background in self.background_pairs:
+                if (pair_name, pair_frametype) == key:
+                    dset_name = f'{frametype}_minus_{background}'
+                    self.create_image_dataset(group, key, dset_name, shape, np.float32)
+
+    def stored_dtype(self, dtype, image_dtype):
+        """The dtype with which to store frames of the given dtype, reduced from images
+        of image_dtype. Images are stored as uint16, unless we're preserving the
+        datatype or reduction changed the datatype"""
+        if self.image_storage['preserve_dtype'] or np.dtype(dtype) != image_dtype:
+            return np.dtype(dtype)
+        return np.dtype('uint16')
+
+    def create_image_dataset(self, group, key, dset_name, frame_shape, dtype):
+        """Create a dataset of the given name for the frames of the given (name,
+        frametype), which are of the given shape and dtype, according to the image
+        storage policy"""
+        n_frames = self.frames_per_dataset[key]
+        kwargs = dataset_kwargs(
+            self.image_storage, frame_shape, None if n_frames == 1 else n_frames
+        )
+        kwargs['dtype'] = dtype
+        dset = group.create_dataset(dset_name, **kwargs)
+        # Specify this dataset should be viewed as an image
+        dset.attrs['CLASS'] = np.string_('IMAGE')
+        dset.attrs['IMAGE_VERSION'] = np.string_('1.2')
+        dset.attrs['IMAGE_SUBCLASS'] = np.string_('IMAGE_GRAYSCALE')
+        dset.attrs['IMAGE_WHITE_IS_ZERO'] = np.uint8(0)
+        reduction = self.reductions[key]
+        if reduction is not None:
+            dset.attrs['image_reduction'] = json.dumps(reduction)
+        return dset
+
+    def image_dataset(self, group, key, dset_name, frame_shape, dtype):
+        """Return the dataset of the given name for the frames of the given (name,
+        frametype), for writing a frame of the given shape to, to be stored with the
+        given dtype. If the dataset was created in advance, it is checked when the
+        first frame is written to it, and replaced if its shape or dtype is not as
+        expected. Otherwise it is created now."""
+        if (key[0], dset_name) in self.datasets_checked:
+            return group[dset_name]
+        n_frames = self.frames_per_dataset[key]
+        shape = frame_shape if n_frames == 1 else (n_frames,) + frame_shape
+        if dset_name in group:
+            dset = group[dset_name]
+            if (dset.shape, dset.dtype) != (shape, dtype):
+                del group[dset_name]
+        if dset_name not in group:
+            self.create_image_dataset(group, key, dset_name, frame_shape, dtype)
+        self.datasets_checked.add((key[0], dset_name))
+        return group[dset_name]
+
+    def roi_sums_dataset(self, group, key):
+        """Return the '<frametype>_roi_sums' dataset for the given (name, frametype),
+        which has one row per frame and one field per ROI, creating it if it does not
+        exist"""
+        dset_name = key[1] + '_roi_sums'
+        if dset_name in group:
+            return group[dset_name]
+        reduction = self.reductions[key]
+        dtype = [(roi_name, np.float64) for roi_name in reduction['roi_sums']]
+        n_frames = self.frames_per_dataset[key]
+        dset = group.create_dataset(
+            dset_name, shape=(n_frames,), maxshape=(n_frames,), dtype=dtype
+        )
+        dset.attrs['image_reduction'] = json.dumps(reduction)
+        return dset
+
+    def write_frame(self, image_group, i, image):
+        key, index = self.frame_slots[i]
+        name, frametype = key
+        group = image_group[name]
+        reduction = self.reductions[key]
+        frame = image
+        if reduction is not None:
+            if reduction['roi_sums']:
+                sums = roi_sums(image, reduction)
+                self.roi_sums_dataset(group, key)[index or 0] = tuple(sums)
+            frame = reduce_frame(image, reduction)
+        if key in self.paired_keys:
+            self.paired_frames[(name, frametype, index)] = frame
+            self.write_background_subtracted(group, name, index)
+        if reduction is None or reduction['save_frames']:
+            dtype = self.stored_dtype(frame.dtype, image.dtype)
+            dset = self.image_dataset(group, key, frametype, frame.shape, dtype)
+            if index is None:
+                dset[...] = frame
+            else:
+                dset[index] = frame
+        self.frames_written[key] += 1
+
+    def write_background_subtracted(self, group, name, index):
+        """For each background subtraction pair involving the given frame, if both
+        frames of the pair have been received, write their difference to the
+        '<frametype>_minus_<background>' dataset as float32"""
+        for pair_name, frametype, background in self.background_pairs:
+            if pair_name != name:
+                continue
+            foreground_key = (name, frametype, index)
+            background_key = (name, background, index)
+            if not (
+                foreground_key in self.paired_frames
+                and background_key in self.paired_frames
+            ):
+                continue
+            difference = self.paired_frames.pop(foreground_key).astype(np.float32)
+            difference -= self.paired_frames.pop(background_key)
+            dset_name = f'{frametype}_minus_{background}'
+            dset = self.image_dataset(
+                group, (name, frametype), dset_name, difference.shape, difference.dtype
+            )
+            if index is None:
+                dset[...] = difference
+            else:
+                dset[index] = difference
+
+    def join(self):
+        """Wait for the writer thread to write all queued frames, and raise any
+        exception that occurred in it"""
+        if self.writer_thread is not None:
+            self.queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+        if self.writer_thread_exception is not None:
+            exc_info = self.writer_thread_exception
+            self.writer_thread_exception = None
+            raise exc_info[1].with_traceback(exc_info[2])
+
+    def finalise(
+        self, attributes_to_save=None, acquisition_statistics=None, telemetry=None
+    ):
+        """Wait for all frames to be written, then save camera attributes, whether
+        the shot failed, any acquisition statistics reported by the camera, and the
+        table of the given FrameTelemetry, if any, to the image group. Datasets that
+        did not receive all their frames are truncated to the number of frames
+        actually acquired, and those that received none are removed."""
+        self.join()
+        print(f"Saved {min(self.n_received, self.n_images)}/{self.n_images} images.")
+        with h5py.File(self.h5_filepath, 'a') as f:
+            image_group = f[self.image_path]
+            # Save camera attributes to the HDF5 file:
+            if attributes_to_save is not None:
+                set_attributes(image_group, attributes_to_save)
+            # Whether we failed to get all the expected exposures:
+            image_group.attrs['failed_shot'] = self.n_received != self.n_images
+            if acquisition_statistics is not None:
+                for name, value in acquisition_statistics.items():
+                    image_group.attrs[name] = value
+            if telemetry is not None:
+                dset = image_group.create_dataset(
+                    'frame_telemetry', data=telemetry.table()
+                )
+                dset.attrs['start_time'] = telemetry.start_walltime
+            # Record the image reduction done for each dataset, if any:
+            if any(r is not None for r in self.reductions.values()):
+                reductions = {
+                    '/'.join(key): reduction
+                    for key, reduction in self.reductions.items()
+                }
+                image_group.attrs['image_reduction'] = json.dumps(reductions)
+            # Datasets may have been created in advance for frames that never arrived:
+            for name, dset_name, n_frames, n_written in self.datasets_written():
+                group = image_group[name]
+                if dset_name not in group:
+                    continue
+                if n_written == 0:
+                    del group[dset_name]
+                elif n_frames > 1 and n_written < n_frames:
+                    self.truncate(group[dset_name], n_written)
+
+    def datasets_written(self):
+        """Yield (name, dataset name, number of frames, number of frames written) for
+        every dataset the shot's frames are saved to"""
+        for key, n_frames in self.frames_per_dataset.items():
+            name, frametype = key
+            n_written = self.frames_written[key]
+            yield name, frametype, n_frames, n_written
+            yield name, frametype + '_roi_sums', n_frames, n_written
+        for name, frametype, background in self.background_pairs:
+            # Differences are written once both frames of a pair have been written:
+            n_frames = self.frames_per_dataset[(name, frametype)]
+            n_written = min(
+                self.frames_written[(name, frametype)],
+                self.frames_written[(name, background)],
+            )
+            yield name, f'{frametype}_minus_{background}', n_frames, n_written
+
+    def truncate(self, dset, n_frames):
+        """Truncate a dataset of frames to the given number of frames"""
+        if dset.chunks is not None:
+            dset.resize(n_frames, axis=0)
+            return
+        # Contiguous datasets cannot be resized, replace with a new dataset:
+        data = dset[:n_frames]
+        attrs = dict(dset.attrs)
+        group, name = dset.parent, dset.name.split('/')[-1]
+        del group[name]
+        dset = group.create_dataset(name, data=data)
+        dset.attrs.update(attrs)
+
+    def abort(self):
+        """Stop the writer thread, discarding any frames not yet written"""
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+        try:
+            self.join()
+        except Exception:
+            pass
+
+
 class IMAQdxCameraWorker(Worker):
     # Subclasses may override this if their interface class takes only the serial number
     # as an instantiation argument, otherwise they may reimplement get_camera():
     interface_class = IMAQdx_Camera
 
+    # zlib compression level for sending images to the BLACS tab in the 'zmq' image
+    # transfer mode. Level 1 is fast whilst still effective for uncompressed images:
+    image_transfer_compression_level = 1
+
+    # Attributes whose values may change as a result of setting the value of another
+    # attribute, keyed by the latter. Used to invalidate the cached attribute snapshot
+    # when attributes are set. Names are matched against the last component of
+    # '::'-separated attribute names, with any 'Abs' or 'Raw' suffix removed.
+    # Additionally, setting any attribute whose name ends in 'Selector' invalidates the
+    # whole snapshot. Setting an attribute with dependants, or whose name ends in
+    # 'Selector' or 'Auto', also invalidates the cached lists of attribute names, since
+    # it may change which attributes are writeable. Subclasses may extend this, and
+    # cameras may provide a get_attribute_dependants(name) method returning further
+    # dependants.
+    attribute_dependants = {
+        'Width': ['PayloadSize'],
+        'Height': ['PayloadSize'],
+        'BinningHorizontal': ['Width', 'WidthMax', 'OffsetX', 'PayloadSize'],
+        'BinningVertical': ['Height', 'HeightMax', 'OffsetY', 'PayloadSize'],
+        'DecimationHorizontal': ['Width', 'WidthMax', 'OffsetX', 'PayloadSize'],
+        'DecimationVertical': ['Height', 'HeightMax', 'OffsetY', 'PayloadSize'],
+        'PixelFormat': ['PixelSize', 'PixelDynamicRangeMax', 'PayloadSize'],
+        'ExposureTime': ['ResultingFrameRate', 'AcquisitionFrameRate'],
+        'ExposureAuto': ['ExposureTime'],
+        'GainAuto': ['Gain'],
+        'AcquisitionFrameRateEnable': ['ResultingFrameRate', 'AcquisitionFrameRate'],
+        'AcquisitionFrameRate': ['ResultingFrameRate'],
+    }
+
     def init(self):
         self.camera = self.get_camera()
         print("Setting attributes...")
         self.smart_cache = {}
+        # Cached attribute names for each visibility level, and attribute values:
+        self.attribute_names = {}
+        self.attribute_snapshot = {}
         self.set_attributes_smart(self.camera_attributes)
         self.set_attributes_smart(self.manual_mode_camera_attributes)
         print("Initialisation complete")
-        self.images = None
+        self.image_writer = None
+        self.telemetry = None
         self.n_images = None
         self.attributes_to_save = None
         self.exposures = None
@@ -270,10 +1191,20 @@ class IMAQdxCameraWorker(Worker):
         self.continuous_stop = threading.Event()
         self.continuous_thread = None
         self.continuous_dt = None
-        self.image_socket = Context().socket(zmq.REQ)
-        self.image_socket.connect(
-            f'tcp://{self.parent_host}:{self.image_receiver_port}'
+        # Whether the camera is currently acquiring, and if so whether the acquisition
+        # was configured for continuous (rather than buffered) acquisition:
+        self.acquisition_running = False
+        self.acquisition_continuous = None
+        # Frames are sent to the parent for display by the image sender's thread, so
+        # that acquisition is not limited by the display rate:
+        self.image_sender = ImageSender(
+            f'tcp://{self.parent_host}:{self.image_receiver_port}',
+            self.live_view_binning,
         )
+        # Unless images are written directly to the shot file, they are written to a
+        # local scratch file during the shot and transferred at the end:
+        self.scratch_filepath = None
+        self.parent_h5_filepath = None
 
     def get_camera(self):
         """Return an instance of the camera interface class. Subclasses may override
@@ -293,19 +1224,73 @@ class IMAQdxCameraWorker(Worker):
             if name not in self.smart_cache or self.smart_cache[name] != value:
                 uncached_attributes[name] = value
                 self.smart_cache[name] = value
+        # Whatever happens, the cached values of these attributes are now stale:
+        self.invalidate_attributes(uncached_attributes)
         self.camera.set_attributes(uncached_attributes)
 
-    def get_attributes_as_dict(self, visibility_level):
+    def invalidate_attributes(self, names):
+        """Remove the given attributes, and any attributes whose values may depend on
+        them, from the attribute snapshot, so that they will be read from the camera
+        the next time get_attributes_as_dict() is called. If any of the attributes may
+        affect whether other attributes are writeable, also discard the cached lists
+        of attribute names"""
+
+        def short_name(name):
+            name = name.split('::')[-1]
+            for suffix in ['Abs', 'Raw']:
+                if name.endswith(suffix):
+                    name = name[: -len(suffix)]
+            return name
+
+        get_dependants = getattr(self.camera, 'get_attribute_dependants', None)
+        stale = set()
+        for name in names:
+            if short_name(name).endswith('Selector'):
+                # Selectors change which feature other attributes refer to:
+                self.attribute_names = {}
+                self.attribute_snapshot = {}
+                return
+            dependants = set(self.attribute_dependants.get(short_name(name), []))
+            if get_dependants is not None:
+                dependants.update(short_name(n) for n in get_dependants(name))
+            if dependants or short_name(name).endswith('Auto'):
+                # May make other attributes read-only or writeable, such as
+                # ExposureAuto making ExposureTime read-only:
+                self.attribute_names = {}
+            stale.add(short_name(name))
+            stale.update(dependants)
+        for name in list(self.attribute_snapshot):
+            if short_name(name) in stale:
+                del self.attribute_snapshot[name]
+
+    def refresh_attributes(self):
+        """Discard the attribute snapshot, so that all attributes will be read from the
+        camera the next time they are requested"""
+        self.attribute_names = {}
+        self.attribute_snapshot = {}
+
+    def get_attributes_as_dict(self, visibility_level, refresh=False):
         """Return a dict of the attributes of the camera for the given visibility
-        level"""
-        names = self.camera.get_attribute_names(visibility_level)
-        attributes_dict = {name: self.camera.get_attribute(name) for name in names}
-        return attributes_dict
+        level. Values are returned from the attribute snapshot where available, and
+        only attributes that have been invalidated since they were last read are read
+        from the camera. If refresh is True, all attributes are read from the camera."""
+        if refresh:
+            self.refresh_attributes()
+        if visibility_level not in self.attribute_names:
+            names = self.camera.get_attribute_names(visibility_level)
+            self.attribute_names[visibility_level] = names
+        names = self.attribute_names[visibility_level]
+        for name in names:
+            if name not in self.attribute_snapshot:
+                self.attribute_snapshot[name] = self.camera.get_attribute(name)
+        return {name: self.attribute_snapshot[name] for name in names}
 
     def get_attributes_as_text(self, visibility_level):
         """Return a string representation of the attributes of the camera for
-        the given visibility level"""
-        attrs = self.get_attributes_as_dict(visibility_level)
+        the given visibility level. Always reads all attributes from the camera, since
+        they may have changed without the worker's knowledge, for example in the case
+        of auto-exposure."""
+        attrs = self.get_attributes_as_dict(visibility_level, refresh=True)
         # Format it nicely:
         lines = [f'    {repr(key)}: {repr(value)},' for key, value in attrs.items()]
         dict_repr = '\n'.join(['{'] + lines + ['}'])
@@ -313,26 +1298,29 @@ class IMAQdxCameraWorker(Worker):
 
     def snap(self):
         """Acquire one frame in manual mode. Send it to the parent via
-        self.image_socket. Wait for a response from the parent."""
+        self.image_sender."""
         image = self.camera.snap()
         self._send_image_to_parent(image)
 
     def _send_image_to_parent(self, image):
-        """Send the image to the GUI to display. This will block if the parent process
-        is lagging behind in displaying frames, in order to avoid a backlog."""
-        metadata = dict(dtype=str(image.dtype), shape=image.shape)
-        self.image_socket.send_json(metadata, zmq.SNDMORE)
-        self.image_socket.send(image, copy=False)
-        response = self.image_socket.recv()
-        assert response == b'ok', response
+        """Send the image to the GUI to display. This does not block: if the parent
+        process is lagging behind in displaying frames, frames not yet sent are dropped
+        in favour of the most recent one."""
+        self.image_sender.send(image)
 
     def continuous_loop(self, dt):
         """Acquire continuously in a loop, with minimum repetition interval dt"""
         while True:
             if dt is not None:
                 t = perf_counter()
-            image = self.camera.grab()
-            self._send_image_to_parent(image)
+            try:
+                image = self.camera.grab()
+            except MockTimeoutError:
+                # No frame this time around. Keep live view running, as
+                # grab_multiple() does during a shot:
+                pass
+            else:
+                self._send_image_to_parent(image)
             if dt is None:
                 timeout = 0
             else:
@@ -341,11 +1329,65 @@ class IMAQdxCameraWorker(Worker):
                 self.continuous_stop.clear()
                 break
 
+    def configure_acquisition(self, continuous, bufferCount=None):
+        """Configure the camera for continuous or buffered acquisition and start it. If
+        the camera is already acquiring, first try to reconfigure the running
+        acquisition in place using the camera's reconfigure_acquisition() method, if
+        it has one, which avoids the cost of stopping and restarting acquisition.
+        Otherwise stop the running acquisition and configure a new one. When reusing
+        the running acquisition for buffered acquisition, frames it has already
+        acquired, such as those in flight from continuous acquisition, are discarded
+        with the camera's flush_acquisition() method, if it has one."""
+        kwargs = {'continuous': continuous}
+        if bufferCount is not None:
+            kwargs['bufferCount'] = bufferCount
+        if self.acquisition_running:
+            reconfigure = getattr(self.camera, 'reconfigure_acquisition', None)
+            if reconfigure is not None and reconfigure(**kwargs):
+                flush = getattr(self.camera, 'flush_acquisition', None)
+                if not continuous and flush is not None:
+                    # Called after the shot's trigger settings have been set, so that
+                    # no more frames are acquired until the shot is triggered:
+                    flush()
+                self.acquisition_continuous = continuous
+                return
+            self.stop_acquisition()
+        self.camera.configure_acquisition(**kwargs)
+        self.acquisition_running = True
+        self.acquisition_continuous = continuous
+
+    def stop_acquisition(self):
+        """Stop the camera acquiring, if it is"""
+        if self.acquisition_running:
+            self.camera.stop_acquisition()
+        self.acquisition_running = False
+        self.acquisition_continuous = None
+
+    def set_attributes_while_acquiring(self, attributes):
+        """Set the given attributes with set_attributes_smart() without stopping any
+        running acquisition, if the camera allows it. If setting the attributes fails,
+        the acquisition is stopped and the attributes are set again. Cameras typically
+        allow attributes such as trigger and exposure settings to be changed during
+        acquisition, but not attributes that change the image size or format."""
+        if not self.acquisition_running:
+            self.set_attributes_smart(attributes)
+            return
+        try:
+            self.set_attributes_smart(attributes)
+        except Exception as e:
+            print(f"Stopping acquisition to set attributes ({e})")
+            # Not all the attributes may have been set, so don't trust the cache:
+            for name in attributes:
+                self.smart_cache.pop(name, None)
+            self.stop_acquisition()
+            self.set_attributes_smart(attributes)
+
     def start_continuous(self, dt):
         """Begin continuous acquisition in a thread with minimum repetition interval
         dt"""
         assert self.continuous_thread is None
-        self.camera.configure_acquisition()
+        if not (self.acquisition_running and self.acquisition_continuous):
+            self.configure_acquisition(continuous=True)
         self.continuous_thread = threading.Thread(
             target=self.continuous_loop, args=(dt,), daemon=True
         )
@@ -353,12 +1395,13 @@ class IMAQdxCameraWorker(Worker):
         self.continuous_dt = dt
 
     def stop_continuous(self, pause=False):
-        """Stop the continuous acquisition thread"""
+        """Stop the continuous acquisition thread. If pause is True, leave the camera
+        acquiring, so that the acquisition may be reused for a buffered shot, or by
+        start_continuous()"""
         assert self.continuous_thread is not None
         self.continuous_stop.set()
         self.continuous_thread.join()
         self.continuous_thread = None
-        self.camera.stop_acquisition()
         # If we're just 'pausing', then do not clear self.continuous_dt. That way
         # continuous acquisition can be resumed with the same interval by calling
         # start(self.continuous_dt), without having to get the interval from the parent
@@ -366,46 +1409,180 @@ class IMAQdxCameraWorker(Worker):
         # that continuous acquisiton is paused and should be resumed after a buffered
         # run is complete:
         if not pause:
+            self.stop_acquisition()
             self.continuous_dt = None
 
+    def get_frame_format(self):
+        """Return the shape and dtype of the frames the camera will produce with its
+        current attributes, or (None, None) if they cannot be determined. Cameras may
+        provide a get_frame_format() method, otherwise the frame format is worked out
+        from the Width, Height and PixelFormat attributes, for monochrome pixel
+        formats"""
+        get_frame_format = getattr(self.camera, 'get_frame_format', None)
+        if get_frame_format is not None:
+            return get_frame_format()
+        try:
+            width = int(self.camera.get_attribute('Width'))
+            height = int(self.camera.get_attribute('Height'))
+            pixel_format = str(self.camera.get_attribute('PixelFormat'))
+        except Exception:
+            return None, None
+        # Bit depth from a name such as 'Mono12' or 'Mono12Packed':
+        bit_depth = ''.join(c for c in pixel_format if c.isdigit())
+        if not pixel_format.startswith('Mono') or not bit_depth:
+            return None, None
+        if int(bit_depth) <= 8:
+            return (height, width), np.dtype(np.uint8)
+        if int(bit_depth) <= 16:
+            return (height, width), np.dtype(np.uint16)
+        return None, None
+
+    def get_image_path(self):
+        """Return the path in the shot file of the group in which images will be saved.
+        Use orientation for image path, device_name if orientation unspecified"""
+        if self.orientation is not None:
+            return 'images/' + self.orientation
+        else:
+            return 'images/' + self.device_name
+
+    def create_scratch_file(self):
+        """Create an empty HDF5 file in the local temporary directory for images to be
+        written to during the shot, and return its path"""
+        fd, scratch_filepath = tempfile.mkstemp(
+            prefix=f'{self.device_name}_', suffix='.h5'
+        )
+        os.close(fd)
+        h5py.File(scratch_filepath, 'w').close()
+        return scratch_filepath
+
+    def remove_scratch_file(self):
+        if self.scratch_filepath is not None:
+            os.unlink(self.scratch_filepath)
+            self.scratch_filepath = None
+
+    def request_from_parent(self, metadata, *data):
+        """Send a request to the BLACS tab on the connection used for sending frames
+        for display, and return the parts of its response, the first of which is
+        decoded from JSON. Raise RuntimeError if the request failed. See
+        handle_shot_request() in utils.py for the requests the tab handles."""
+        response = self.image_sender.request(metadata, *data)
+        result = json.loads(response[0])
+        if 'error' in result:
+            msg = f"Request '{metadata['type']}' failed on the BLACS computer:\n"
+            raise RuntimeError(msg + result['error'])
+        return [result] + response[1:]
+
+    def get_shot_properties(self, h5_filepath):
+        """Return the camera's EXPOSURES table in the shot file and its device
+        properties, or (None, None) if the camera has no exposures in the shot. In the
+        'zmq' image transfer mode these are requested from the BLACS tab, which reads
+        them from the shot file on its own computer."""
+        if self.image_transfer != 'zmq':
+            return read_shot_properties(h5_filepath, self.device_name)
+        metadata = {
+            'type': 'shot_properties',
+            'h5_filepath': self.parent_h5_filepath,
+            'device_name': self.device_name,
+        }
+        _, data = self.request_from_parent(metadata)
+        return pickle.loads(data)
+
+    def transfer_images(self):
+        """Copy the shot's images from the scratch file into the shot file. For the
+        'staged' image transfer mode, they are copied by this process, in one opening
+        of the shot file. For 'zmq', the scratch file is compressed and sent to the
+        BLACS tab, which copies the images into the shot file on its own computer.
+        Return the total time taken and the time spent writing the shot file."""
+        start_time = perf_counter()
+        image_path = self.get_image_path()
+        if self.image_transfer == 'staged':
+            write_time = write_image_file(
+                self.scratch_filepath, self.h5_filepath, image_path
+            )
+        else:
+            with open(self.scratch_filepath, 'rb') as f:
+                data = zlib.compress(f.read(), self.image_transfer_compression_level)
+            metadata = {
+                'type': 'shot_images',
+                'h5_filepath': self.parent_h5_filepath,
+                'image_path': image_path,
+            }
+            result, = self.request_from_parent(metadata, data)
+            write_time = result['write_time']
+        self.remove_scratch_file()
+        total_time = perf_counter() - start_time
+        print(
+            f"Transferred images ({self.image_transfer}) in {total_time:.3f} s, "
+            + f"of which {write_time:.3f} s writing the shot file."
+        )
+        return total_time, write_time
+
     def transition_to_buffered(self, device_name, h5_filepath, initial_values, fresh):
+        # The path to the shot file on the computer running BLACS:
+        self.parent_h5_filepath = h5_filepath
         if getattr(self, 'is_remote', False):
             h5_filepath = path_to_local(h5_filepath)
         if self.continuous_thread is not None:
-            # Pause continuous acquistion during transition_to_buffered:
+            # Pause continuous acquistion during transition_to_buffered. The camera is
+            # left acquiring, so that the acquisition can be reconfigured in place for
+            # the shot if the camera allows it:
             self.stop_continuous(pause=True)
-        with h5py.File(h5_filepath, 'r') as f:
-            group = f['devices'][self.device_name]
-            if not 'EXPOSURES' in group:
-                return {}
-            self.h5_filepath = h5_filepath
-            self.exposures = group['EXPOSURES'][:]
-            self.n_images = len(self.exposures)
-
-            # Get the camera_attributes from the device_properties
-            properties = labscript_utils.properties.get(
-                f, self.device_name, 'device_properties'
-            )
-            camera_attributes = properties['camera_attributes']
-            self.stop_acquisition_timeout = properties['stop_acquisition_timeout']
-            self.exception_on_failed_shot = properties['exception_on_failed_shot']
-            saved_attr_level = properties['saved_attribute_visibility_level']
+        exposures, properties = self.get_shot_properties(h5_filepath)
+        if exposures is None:
+            self.stop_acquisition()
+            return {}
+        self.h5_filepath = h5_filepath
+        self.exposures = exposures
+        self.n_images = len(self.exposures)
+
+        # Get the camera_attributes from the device_properties
+        camera_attributes = properties['camera_attributes']
+        self.stop_acquisition_timeout = properties['stop_acquisition_timeout']
+        self.exception_on_failed_shot = properties['exception_on_failed_shot']
+        saved_attr_level = properties['saved_attribute_visibility_level']
+        # Shot files compiled before image storage policies existed have none:
+        image_storage = check_image_storage(properties.get('image_storage', {}))
+        image_reduction = properties.get('image_reduction', None)
         # Only reprogram attributes that differ from those last programmed in, or all of
         # them if a fresh reprogramming was requested:
         if fresh:
             self.smart_cache = {}
-        self.set_attributes_smart(camera_attributes)
+            self.refresh_attributes()
+        self.set_attributes_while_acquiring(camera_attributes)
         # Get the camera attributes, so that we can save them to the H5 file:
         if saved_attr_level is not None:
             self.attributes_to_save = self.get_attributes_as_dict(saved_attr_level)
         else:
             self.attributes_to_save = None
         print(f"Configuring camera for {self.n_images} images.")
-        self.camera.configure_acquisition(continuous=False, bufferCount=self.n_images)
-        self.images = []
+        self.configure_acquisition(continuous=False, bufferCount=self.n_images)
+        # Frames are written to the shot file (or to the scratch file, to be transferred
+        # to the shot file at the end of the shot) by the image writer as they are
+        # acquired:
+        if self.image_transfer == 'direct':
+            image_filepath = self.h5_filepath
+        else:
+            self.scratch_filepath = self.create_scratch_file()
+            image_filepath = self.scratch_filepath
+        frame_shape, frame_dtype = self.get_frame_format()
+        self.image_writer = ImageWriter(
+            image_filepath,
+            self.get_image_path(),
+            self.device_name,
+            self.exposures,
+            image_storage,
+            image_reduction,
+            frame_shape,
+            frame_dtype,
+        )
+        # Camera classes may record per-frame telemetry, including how far the image
+        # writer is lagging behind acquisition:
+        self.telemetry = getattr(self.camera, 'telemetry', None)
+        if self.telemetry is not None:
+            self.telemetry.backlog = self.image_writer.backlog
         self.acquisition_thread = threading.Thread(
             target=self.camera.grab_multiple,
-            args=(self.n_images, self.images),
+            args=(self.n_images, self.image_writer),
             daemon=True,
         )
         self.acquisition_thread.start()
@@ -429,56 +1606,26 @@ class IMAQdxCameraWorker(Worker):
                 print(dedent(msg), file=sys.stderr)
         self.acquisition_thread = None
 
-        print("Stopping acquisition.")
-        self.camera.stop_acquisition()
-
-        print(f"Saving {len(self.images)}/{len(self.exposures)} images.")
-
-        with h5py.File(self.h5_filepath) as f:
-            # Use orientation for image path, device_name if orientation unspecified
-            if self.orientation is not None:
-                image_path = 'images/' + self.orientation
-            else:
-                image_path = 'images/' + self.device_name
-            image_group = f.require_group(image_path)
-            image_group.attrs['camera'] = self.device_name
-
-            # Save camera attributes to the HDF5 file:
-            if self.attributes_to_save is not None:
-                set_attributes(image_group, self.attributes_to_save)
+        # Camera classes may report statistics such as skipped frames for the shot:
+        acquisition_statistics = None
+        if hasattr(self.camera, 'get_acquisition_statistics'):
+            acquisition_statistics = self.camera.get_acquisition_statistics()
 
-            # Whether we failed to get all the expected exposures:
-            image_group.attrs['failed_shot'] = len(self.images) != len(self.exposures)
-
-            # key the images by name and frametype. Allow for the case of there being
-            # multiple images with the same name and frametype. In this case we will
-            # save an array of images in a single dataset.
-            images = {
-                (exposure['name'], exposure['frametype']): []
-                for exposure in self.exposures
-            }
+        if self.continuous_dt is None:
+            print("Stopping acquisition.")
+            self.stop_acquisition()
 
-            # Iterate over expected exposures, sorted by acquisition time, to match them
-            # up with the acquired images:
-            self.exposures.sort(order='t')
-            for image, exposure in zip(self.images, self.exposures):
-                images[(exposure['name'], exposure['frametype'])].append(image)
-
-            # Save images to the HDF5 file:
-            for (name, frametype), imagelist in images.items():
-                data = imagelist[0] if len(imagelist) == 1 else np.array(imagelist)
-                print(f"Saving frame(s) {name}/{frametype}.")
-                group = image_group.require_group(name)
-                dset = group.create_dataset(
-                    frametype, data=data, dtype='uint16', compression='gzip'
-                )
-                # Specify this dataset should be viewed as an image
-                dset.attrs['CLASS'] = np.string_('IMAGE')
-                dset.attrs['IMAGE_VERSION'] = np.string_('1.2')
-                dset.attrs['IMAGE_SUBCLASS'] = np.string_('IMAGE_GRAYSCALE')
-                dset.attrs['IMAGE_WHITE_IS_ZERO'] = np.uint8(0)
+        # Wait for the remaining frames to be written and save metadata:
+        self.image_writer.finalise(
+            self.attributes_to_save, acquisition_statistics, self.telemetry
+        )
+        if self.scratch_filepath is not None:
+            self.transfer_images()
 
-        self.images = None
+        if self.telemetry is not None:
+            self.telemetry.backlog = None
+        self.telemetry = None
+        self.image_writer = None
         self.n_images = None
         self.attributes_to_save = None
         self.exposures = None
@@ -486,10 +1633,10 @@ class IMAQdxCameraWorker(Worker):
         self.stop_acquisition_timeout = None
         self.exception_on_failed_shot = None
         print("Setting manual mode camera attributes.\n")
-        self.set_attributes_smart(self.manual_mode_camera_attributes)
+        self.set_attributes_while_acquiring(self.manual_mode_camera_attributes)
         if self.continuous_dt is not None:
             # If continuous manual mode acquisition was in progress before the bufferd
-            # run, resume it:
+            # run, resume it, reusing the running acquisition if possible:
             self.start_continuous(self.continuous_dt)
         return True
 
@@ -498,9 +1645,16 @@ class IMAQdxCameraWorker(Worker):
             self.camera.abort_acquisition()
             self.acquisition_thread.join()
             self.acquisition_thread = None
-            self.camera.stop_acquisition()
+        if self.continuous_thread is None:
+            self.stop_acquisition()
+        if self.image_writer is not None:
+            self.image_writer.abort()
+        self.remove_scratch_file()
+        if self.telemetry is not None:
+            self.telemetry.backlog = None
+        self.telemetry = None
         self.camera._abort_acquisition = False
-        self.images = None
+        self.image_writer = None
         self.n_images = None
         self.attributes_to_save = None
         self.exposures = None
@@ -525,4 +1679,8 @@ class IMAQdxCameraWorker(Worker):
     def shutdown(self):
         if self.continuous_thread is not None:
             self.stop_continuous()
+        self.stop_acquisition()
+        self.image_sender.stop()
+        if self.image_sender.n_offered:
+            print(f"Live view drop rate: {100 * self.image_sender.drop_rate:.1f}%")
         self.camera.close()
@@ -11,11 +11,13 @@
 #                                                                   #
 #####################################################################
 import sys
+import json
 from labscript_utils import dedent
 from labscript import TriggerableDevice, set_passed_properties
 import numpy as np
 import labscript_utils.h5_lock
 import h5py
+from .utils import check_image_storage, check_image_reduction, check_image_transfer
 
 
 class IMAQdxCamera(TriggerableDevice):
@@ -28,12 +30,16 @@ class IMAQdxCamera(TriggerableDevice):
                 "orientation",
                 "manual_mode_camera_attributes",
                 "mock",
+                "live_view_binning",
+                "image_transfer",
             ],
             "device_properties": [
                 "camera_attributes",
                 "stop_acquisition_timeout",
                 "exception_on_failed_shot",
-                "saved_attribute_visibility_level"
+                "saved_attribute_visibility_level",
+                "image_storage",
+                "image_reduction",
             ],
         }
     )
@@ -52,7 +58,11 @@ class IMAQdxCamera(TriggerableDevice):
         stop_acquisition_timeout=5.0,
         exception_on_failed_shot=True,
         saved_attribute_visibility_level='intermediate',
+        image_storage=None,
+        image_reduction=None,
         mock=False,
+        live_view_binning=1,
+        image_transfer='direct',
         **kwargs
     ):
         """A camera to be controlled using NI IMAQdx and triggered with a digital edge.
@@ -134,10 +144,79 @@ class IMAQdxCamera(TriggerableDevice):
                 `'simple'`, `'intermediate'`, `'advanced'`, or `None`. If `None`, no
                 attributes will be saved.
 
+            image_storage (dict, optional):
+                How images are to be stored in the shot file. Keys absent from this
+                dictionary take their default values. Allowed keys are:
+
+                * `'compression'`: `None` for no compression, `'lzf'`, `'gzip'`, the
+                  name of a filter provided by the `hdf5plugin` package (such as
+                  `'Bitshuffle'`, `'LZ4'`, `'Zstd'` or `'Blosc'`), or the integer ID
+                  of an HDF5 filter plugin registered on the computer running BLACS.
+                  Frames are compressed as they are acquired, so compression must keep
+                  up with the frame rate: `'gzip'` compresses smaller but is several
+                  times slower than `'lzf'`. Default: `'lzf'`.
+                * `'compression_opts'`: Compression level (0-9) for `'gzip'`, a dict
+                  of keyword arguments for an `hdf5plugin` filter, or a tuple of
+                  filter options for a filter given by ID. Default: `None`.
+                * `'chunks'`: `'frame'` to store each frame in its own chunk, a tuple
+                  giving the chunk shape within a frame, or `None` for contiguous
+                  (unchunked) storage, which requires `'compression'` to be `None`.
+                  Default: `'frame'`.
+                * `'preserve_dtype'`: If True, store images with the datatype returned
+                  by the camera, otherwise convert them to uint16. Default: `False`.
+
+            image_reduction (dict, optional):
+                Reduction to be applied to images in the BLACS worker as they are
+                acquired, so that only the reduced products need be saved to the shot
+                file. If not given, full frames are saved. Can be overridden for
+                individual exposures with the `reduction` argument to `expose()`. Keys
+                absent from this dictionary take their default values. Allowed keys
+                are:
+
+                * `'roi'`: `(x, y, width, height)` region to which frames are cropped
+                  before saving. Default: `None` (no cropping).
+                * `'binning'`: Factor, or `(x_factor, y_factor)` tuple, by which to bin
+                  (cropped) frames by summing blocks of pixels. Binned frames are saved
+                  as uint32. Default: `1` (no binning).
+                * `'roi_sums'`: Dictionary mapping names to `(x, y, width, height)`
+                  regions of the full frame. The sum over each region is saved, one
+                  row per frame, in a `<frametype>_roi_sums` dataset next to the
+                  frames. Default: `{}`.
+                * `'background'`: Dictionary mapping a frametype to the frametype of
+                  the background frames to be subtracted from it. The n-th frame of the
+                  first frametype minus the n-th frame of the second (after cropping
+                  and binning) is saved as a float32 `<frametype>_minus_<background>`
+                  dataset. Default: `{}`.
+                * `'save_frames'`: Whether to save the (cropped and binned) frames
+                  themselves, or only the ROI sums and background-subtracted frames.
+                  Default: `True`.
+
+                Each saved dataset has an `'image_reduction'` attribute recording the
+                reduction applied.
+
             mock (bool, optional), default: False
                 For testing purpses, simulate a camera with fake data instead of
                 communicating with actual hardware.
 
+            live_view_binning (int), default: 1
+                Factor by which to bin images, by averaging blocks of
+                `live_view_binning` x `live_view_binning` pixels, before sending them
+                to the BLACS tab for display. Reduces the amount of data transferred
+                and rendered for large frames, but does not affect saved images.
+
+            image_transfer (str), default: `'direct'`
+                How images get into the shot file. `'direct'`: images are written to
+                the shot file as they are acquired. `'staged'`: images are written to a
+                scratch file on the computer running the BLACS worker, and copied into
+                the shot file in one go at the end of the shot. `'zmq'`: as for
+                `'staged'`, but the scratch file is compressed and sent to the BLACS
+                tab, which writes the images into the shot file on its own computer.
+                The worker also gets its exposures and device properties for the shot
+                from the BLACS tab, so it does not need access to the shot file at
+                all. This uses the same connection as frames sent for live view. The
+                latter two are much faster than `'direct'` for workers running on a
+                remote computer that accesses shot files over a network share.
+
             **kwargs: Further keyword arguments to be passed to the `__init__` method of
                 the parent class (TriggerableDevice).
         """
@@ -166,10 +245,16 @@ class IMAQdxCamera(TriggerableDevice):
             raise ValueError(msg % valid_attr_levels)
         self.camera_attributes = camera_attributes
         self.manual_mode_camera_attributes = manual_mode_camera_attributes
+        self.image_storage = check_image_storage(image_storage)
+        self.image_reduction = check_image_reduction(image_reduction)
+        if not (isinstance(live_view_binning, int) and live_view_binning >= 1):
+            msg = "live_view_binning must be a positive integer, not %s"
+            raise ValueError(msg % str(live_view_binning))
+        check_image_transfer(image_transfer)
         self.exposures = []
         TriggerableDevice.__init__(self, name, parent_device, connection, **kwargs)
 
-    def expose(self, t, name, frametype='frame', trigger_duration=None):
+    def expose(self, t, name, frametype='frame', trigger_duration=None, reduction=None):
         """Request an exposure at the given time. A trigger will be produced by the
         parent trigger object, with duration trigger_duration, or if not specified, of
         self.trigger_duration. The frame should have a `name, and optionally a
@@ -179,7 +264,10 @@ class IMAQdxCamera(TriggerableDevice):
         the type of frame being acquired, for imaging methods that involve multiple
         frames. For example an absorption image of atoms might have three frames:
         'probe', 'atoms' and 'background'. For this one might call expose three times
-        with the same name, but three different frametypes.
+        with the same name, but three different frametypes. `reduction`, if given, is
+        a dictionary of image reduction settings for this exposure, overriding those in
+        the `image_reduction` instantiation argument. All exposures with the same name
+        and frametype must have the same reduction.
         """
         # Backward compatibility with code that calls expose with name as the first
         # argument and t as the second argument:
@@ -199,8 +287,18 @@ class IMAQdxCamera(TriggerableDevice):
         if not trigger_duration > 0:
             msg = "trigger_duration must be > 0, not %s" % str(trigger_duration)
             raise ValueError(msg)
+        if name == 'frame_telemetry':
+            msg = """Exposure name 'frame_telemetry' is reserved for the table of
+                per-frame acquisition timing saved by the worker"""
+            raise ValueError(dedent(msg))
+        if reduction is not None:
+            # Check the reduction is valid once merged with the device-level settings:
+            check_image_reduction(dict(self.image_reduction or {}, **reduction))
+            reduction = json.dumps(reduction, sort_keys=True)
+        else:
+            reduction = ''
         self.trigger(t, trigger_duration)
-        self.exposures.append((t, name, frametype, trigger_duration))
+        self.exposures.append((t, name, frametype, trigger_duration, reduction))
         return trigger_duration
 
     def generate_code(self, hdf5_file):
@@ -211,7 +309,16 @@ class IMAQdxCamera(TriggerableDevice):
             ('name', vlenstr),
             ('frametype', vlenstr),
             ('trigger_duration', float),
+            ('reduction', vlenstr),
         ]
+        reductions = {}
+        for _, name, frametype, _, reduction in self.exposures:
+            if reductions.setdefault((name, frametype), reduction) != reduction:
+                msg = f"""{self.description} {self.name}: exposures with name
+                    '{name}' and frametype '{frametype}' have differing reductions. All
+                    exposures saved to the same dataset must have the same
+                    reduction."""
+                raise ValueError(dedent(msg))
         data = np.array(self.exposures, dtype=table_dtypes)
         group = self.init_device_group(hdf5_file)
         if self.exposures:
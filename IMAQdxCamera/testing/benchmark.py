@@ -0,0 +1,308 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/IMAQdxCamera/testing/benchmark.py              #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Benchmarks of the IMAQdxCamera image saving path using the mock camera. No camera
+hardware is required.
+
+Syntax: python benchmark.py [-n N_FRAMES] [-r FRAME_RATE] [--storage]
+                           [--attributes] [--transitions] [--reduction]"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+import numpy as np
+import h5py
+
+from labscript_devices.IMAQdxCamera.blacs_workers import (
+    IMAQdxCameraWorker,
+    MockCamera,
+    ImageWriter,
+)
+from labscript_devices.IMAQdxCamera.utils import check_image_storage, dataset_kwargs
+
+# Storage policies to compare in benchmark_storage_policies():
+STORAGE_POLICIES = {
+    'lzf (default)': {},
+    'gzip': {'compression': 'gzip'},
+    'gzip, native dtype': {'compression': 'gzip', 'preserve_dtype': True},
+    'gzip level 1, native dtype': {
+        'compression': 'gzip',
+        'compression_opts': 1,
+        'preserve_dtype': True,
+    },
+    'lzf, native dtype': {'compression': 'lzf', 'preserve_dtype': True},
+    'uncompressed, native dtype': {'compression': None, 'preserve_dtype': True},
+    'contiguous, native dtype': {
+        'compression': None,
+        'chunks': None,
+        'preserve_dtype': True,
+    },
+    'Bitshuffle (hdf5plugin), native dtype': {
+        'compression': 'Bitshuffle',
+        'preserve_dtype': True,
+    },
+}
+
+
+# Image reductions to compare in benchmark_image_reductions(), for 640x480 mock frames:
+IMAGE_REDUCTIONS = {
+    'none': None,
+    'roi': {'roi': (160, 120, 320, 240)},
+    'roi, 4x4 binning': {'roi': (160, 120, 320, 240), 'binning': 4},
+    'roi sums only': {
+        'roi_sums': {'centre': (270, 190, 100, 100), 'edge': (0, 0, 100, 100)},
+        'save_frames': False,
+    },
+    'background subtraction only': {
+        'background': {'atoms': 'background'},
+        'save_frames': False,
+    },
+}
+
+
+def mock_frames(n_frames):
+    """Return a list of n_frames frames from the mock camera. Consecutive frames
+    differ, as real ones do, so that compression cannot exploit repetition"""
+    camera = MockCamera()
+    camera.configure_acquisition()
+    return [camera.grab() for _ in range(n_frames)]
+
+
+def make_exposures(n_frames, frametypes=('frame',)):
+    """Return an EXPOSURES table like that produced by IMAQdxCamera.generate_code()
+    with n_frames frames, cycling through the given frametypes"""
+    vlenstr = h5py.special_dtype(vlen=str)
+    table_dtypes = [
+        ('t', float),
+        ('name', vlenstr),
+        ('frametype', vlenstr),
+        ('trigger_duration', float),
+        ('reduction', vlenstr),
+    ]
+    exposures = [
+        (0.01 * i, 'benchmark', frametypes[i % len(frametypes)], 1e-3, '')
+        for i in range(n_frames)
+    ]
+    return np.array(exposures, dtype=table_dtypes)
+
+
+def benchmark_image_writer(n_frames, frame_rate, image_storage=None):
+    """Feed n_frames mock frames into an ImageWriter with the given image storage
+    policy at the given frame rate, and return the time taken by finalise(), which is
+    what transition_to_manual() waits for after the last frame of a shot"""
+    frames = mock_frames(n_frames)
+    exposures = make_exposures(n_frames)
+    with tempfile.TemporaryDirectory() as tempdir:
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        h5py.File(h5_filepath, 'w').close()
+        writer = ImageWriter(
+            h5_filepath, 'images/benchmark', 'camera', exposures, image_storage
+        )
+        for frame in frames:
+            writer.append(frame)
+            time.sleep(1 / frame_rate)
+        start_time = time.perf_counter()
+        writer.finalise()
+        return time.perf_counter() - start_time
+
+
+def benchmark_image_reduction(n_frames, image_reduction):
+    """Feed n_frames mock frames, alternating between 'atoms' and 'background'
+    frametypes, into an ImageWriter with the given image reduction. Return the time
+    taken by finalise() and the size of the resulting shot file in bytes"""
+    frame = MockCamera().snap()
+    exposures = make_exposures(n_frames, frametypes=('atoms', 'background'))
+    with tempfile.TemporaryDirectory() as tempdir:
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        h5py.File(h5_filepath, 'w').close()
+        writer = ImageWriter(
+            h5_filepath,
+            'images/benchmark',
+            'camera',
+            exposures,
+            image_reduction=image_reduction,
+        )
+        for _ in range(n_frames):
+            writer.append(frame)
+        start_time = time.perf_counter()
+        writer.finalise()
+        finalise_time = time.perf_counter() - start_time
+        return finalise_time, os.path.getsize(h5_filepath)
+
+
+def benchmark_write_after_shot(n_frames):
+    """Write n_frames mock frames in one go after the shot, as done prior to the
+    introduction of ImageWriter. Return the time taken"""
+    frames = mock_frames(n_frames)
+    with tempfile.TemporaryDirectory() as tempdir:
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        start_time = time.perf_counter()
+        images = np.array(frames)
+        with h5py.File(h5_filepath, 'w') as f:
+            group = f.require_group('images/benchmark/benchmark')
+            group.create_dataset('frame', data=images, dtype='uint16', compression='gzip')
+        return time.perf_counter() - start_time
+
+
+def benchmark_storage_policy(frames, image_storage):
+    """Write the given 3D array of frames to a dataset according to the given image
+    storage policy. Return the write throughput in MB/s of raw image data, and the
+    compression ratio (raw size / stored size)"""
+    image_storage = check_image_storage(image_storage)
+    with tempfile.TemporaryDirectory() as tempdir:
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        with h5py.File(h5_filepath, 'w') as f:
+            kwargs = dataset_kwargs(image_storage, frames.shape[1:], len(frames))
+            if image_storage['preserve_dtype']:
+                kwargs['dtype'] = frames.dtype
+            else:
+                kwargs['dtype'] = 'uint16'
+            start_time = time.perf_counter()
+            dset = f.create_dataset('frames', **kwargs)
+            for i, frame in enumerate(frames):
+                dset[i] = frame
+            f.flush()
+            write_time = time.perf_counter() - start_time
+            stored_size = dset.id.get_storage_size()
+    return frames.nbytes / write_time / 1e6, frames.nbytes / stored_size
+
+
+def benchmark_storage_policies(n_frames):
+    """Print write throughput and compression ratio for each of STORAGE_POLICIES, for
+    8-bit and 16-bit mock images"""
+    frames_16bit = np.array(mock_frames(n_frames), dtype=np.uint16)
+    frames_8bit = (frames_16bit >> 2).astype(np.uint8)
+    for frames in [frames_8bit, frames_16bit]:
+        print(f"{n_frames} frames of {frames.shape[1:]} {frames.dtype}:")
+        for description, image_storage in STORAGE_POLICIES.items():
+            try:
+                throughput, ratio = benchmark_storage_policy(frames, image_storage)
+            except (RuntimeError, ValueError) as e:
+                print(f"    {description:40s} unavailable: {e}")
+                continue
+            print(f"    {description:40s} {throughput:8.1f} MB/s {ratio:6.2f}x")
+
+
+def benchmark_attribute_snapshot(n_attributes, n_shots, n_changed):
+    """Simulate n_shots shots in which n_changed of n_attributes camera attributes are
+    changed each shot, and the attributes are then read to be saved to the shot file,
+    as in IMAQdxCameraWorker.transition_to_buffered(). Return the mean number of
+    SDK calls per shot made by the mock camera"""
+    # Use the worker's attribute methods without starting a worker process:
+    worker = IMAQdxCameraWorker.__new__(IMAQdxCameraWorker)
+    worker.camera = MockCamera()
+    worker.smart_cache = {}
+    worker.refresh_attributes()
+    attributes = {f'Attribute{i}': 0 for i in range(n_attributes)}
+    worker.set_attributes_smart(attributes)
+    worker.get_attributes_as_dict('intermediate')
+    worker.camera.n_sdk_calls = 0
+    for shot in range(n_shots):
+        for i in range(n_changed):
+            attributes[f'Attribute{i}'] = shot + 1
+        worker.set_attributes_smart(attributes)
+        worker.get_attributes_as_dict('intermediate')
+    return worker.camera.n_sdk_calls / n_shots
+
+
+def benchmark_transitions(n_shots, frame_rate=0.0, start_delay=0.2, stop_delay=0.1):
+    """Simulate n_shots buffered shots interleaved with continuous acquisition, with a
+    mock camera that takes the given times to start and stop acquiring, and that
+    acquires at the given frame rate, or only as frames are grabbed if it is zero.
+    Reconfiguring in place includes waiting for frames to stop arriving before flushing
+    them, which takes longest for a free-running camera. Return the mean time spent
+    per shot switching between continuous and buffered acquisition, with and without
+    reconfiguring the running acquisition in place"""
+    results = {}
+    for reconfigurable in [False, True]:
+        worker = IMAQdxCameraWorker.__new__(IMAQdxCameraWorker)
+        worker.camera = MockCamera()
+        worker.camera.attributes['AcquisitionFrameRate'] = frame_rate
+        worker.camera.acquisition_start_delay = start_delay
+        worker.camera.acquisition_stop_delay = stop_delay
+        worker.camera.reconfigurable = reconfigurable
+        worker.acquisition_running = False
+        worker.acquisition_continuous = None
+        worker.configure_acquisition(continuous=True)
+        start_time = time.perf_counter()
+        for _ in range(n_shots):
+            worker.configure_acquisition(continuous=False, bufferCount=3)
+            worker.configure_acquisition(continuous=True)
+        results[reconfigurable] = (time.perf_counter() - start_time) / n_shots
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-frames', type=int, default=200)
+    parser.add_argument('-r', '--frame-rate', type=float, default=100.0)
+    parser.add_argument(
+        '--storage',
+        action='store_true',
+        help='Benchmark image storage policies instead of incremental writing',
+    )
+    parser.add_argument(
+        '--attributes',
+        action='store_true',
+        help='Count mock camera SDK calls per shot for attribute reading',
+    )
+    parser.add_argument(
+        '--transitions',
+        action='store_true',
+        help='Compare continuous/buffered switching time with and without restarts',
+    )
+    parser.add_argument(
+        '--reduction',
+        action='store_true',
+        help='Compare shot file size and finalise time for image reductions',
+    )
+    args = parser.parse_args()
+
+    if args.reduction:
+        for description, image_reduction in IMAGE_REDUCTIONS.items():
+            t, size = benchmark_image_reduction(args.n_frames, image_reduction)
+            print(f"{description:30s} {size / 1e6:8.2f} MB, finalise {t:.3f} s")
+        sys.exit(0)
+
+    if args.transitions:
+        for frame_rate in [0.0, args.frame_rate]:
+            results = benchmark_transitions(10, frame_rate)
+            print(f"Frame rate {frame_rate:.0f} fps (0: frames only as grabbed):")
+            print(f"  Stopping and restarting acquisition: {results[False]:.3f} s/shot")
+            print(f"  Reconfiguring in place:              {results[True]:.3f} s/shot")
+        sys.exit(0)
+
+    if args.attributes:
+        for n_changed in [0, 1, 10, 100]:
+            calls = benchmark_attribute_snapshot(300, args.n_frames, n_changed)
+            print(f"{n_changed:3d}/300 attributes changed: {calls:6.1f} SDK calls/shot")
+        sys.exit(0)
+
+    if args.storage:
+        benchmark_storage_policies(args.n_frames)
+        sys.exit(0)
+
+    t_after = benchmark_write_after_shot(args.n_frames)
+    print(f"Writing {args.n_frames} frames after the shot (gzip): {t_after:.3f} s")
+    for description, image_storage in [
+        ('lzf, default', None),
+        ('gzip', {'compression': 'gzip'}),
+    ]:
+        t_incremental = benchmark_image_writer(
+            args.n_frames, args.frame_rate, image_storage
+        )
+        print(
+            f"Finalising incremental writes ({description}): {t_incremental:.3f} s"
+        )
@@ -0,0 +1,312 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/IMAQdxCamera/testing/benchmark_pipeline.py     #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""End-to-end benchmark of the IMAQdxCamera worker using the mock camera and a
+temporary shot file. No camera hardware, and no running BLACS, is required, though
+a zlock server must be running as usual. Live view frames are received by a server
+secured according to labconfig, as in BLACS.
+
+For each combination of frame size, frame count and image storage policy, the worker
+is taken through init(), transition_to_buffered(), a simulated shot in which the mock
+camera delivers frames at the given frame rate, transition_to_manual(), and a period
+of continuous acquisition. Frames per second, MB/s of image data written, the duration
+of transition_to_manual() and the peak Python memory use are reported as JSON, so
+that results can be compared between versions to track regressions.
+
+With --transfer DIRECTORY, shot files are instead created in the given directory,
+which may be on a network share, and each image transfer mode ('direct', 'staged' and
+'zmq') is benchmarked, with the time spent transferring images at the end of the shot
+reported for the latter two.
+
+If a configuration does not finish within --timeout seconds, the tracebacks of all
+threads are printed and the benchmark exits.
+
+Syntax: python benchmark_pipeline.py [-r FRAME_RATE] [-o OUTPUT_FILE] [--quick]
+                                     [--transfer DIRECTORY] [--timeout SECONDS]"""
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import tempfile
+import argparse
+import faulthandler
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import h5py
+
+from labscript_utils.properties import set_attributes
+from labscript_utils.ls_zprocess import ZMQServer
+
+from labscript_devices.IMAQdxCamera.blacs_workers import IMAQdxCameraWorker
+from labscript_devices.IMAQdxCamera.utils import (
+    check_image_storage,
+    handle_shot_request,
+    IMAGE_TRANSFER_MODES,
+)
+
+DEVICE_NAME = 'benchmark_camera'
+
+FRAME_SIZES = [(256, 256), (1024, 1024), (2048, 2048)]
+FRAME_COUNTS = [10, 100]
+STORAGE_POLICIES = {
+    'lzf (default)': {},
+    'gzip': {'compression': 'gzip'},
+    'uncompressed': {'compression': None, 'preserve_dtype': True},
+}
+
+# How long to run continuous acquisition for, in seconds:
+CONTINUOUS_DURATION = 2.0
+
+
+class ImageReceiver(ZMQServer):
+    """Minimal stand-in for the BLACS tab's ImageReceiver: a ZMQServer, secured
+    according to labconfig like the tab's, that acknowledges every frame without
+    displaying it, and handles the requests of workers using the 'zmq' image transfer
+    mode as the tab does"""
+
+    def __init__(self):
+        ZMQServer.__init__(self, port=None, dtype='multipart')
+        self.n_received = 0
+
+    def handler(self, data):
+        md = json.loads(data[0])
+        if md.get('type', 'frame') != 'frame':
+            return handle_shot_request(md, data[1:])
+        self.n_received += 1
+        return [b'ok']
+
+
+def make_worker(frame_size, frame_rate, image_receiver_port, image_transfer='direct'):
+    """Return an IMAQdxCameraWorker in mock mode, initialised without starting a
+    worker process"""
+    height, width = frame_size
+    camera_attributes = {
+        'Width': width,
+        'Height': height,
+        'PixelFormat': 'Mono12',
+        'AcquisitionFrameRate': float(frame_rate),
+        'Content': 'cycle',
+    }
+    worker = IMAQdxCameraWorker.__new__(IMAQdxCameraWorker)
+    worker.device_name = DEVICE_NAME
+    worker.serial_number = 0xDEADBEEF
+    worker.orientation = None
+    worker.camera_attributes = camera_attributes
+    worker.manual_mode_camera_attributes = {}
+    worker.mock = True
+    worker.parent_host = '127.0.0.1'
+    worker.image_receiver_port = image_receiver_port
+    worker.live_view_binning = 1
+    worker.image_transfer = image_transfer
+    worker.init()
+    return worker
+
+
+def make_shot_file(h5_filepath, camera_attributes, n_frames, image_storage):
+    """Create a shot file with an EXPOSURES table and device properties like those
+    produced by IMAQdxCamera.generate_code()"""
+    vlenstr = h5py.special_dtype(vlen=str)
+    table_dtypes = [
+        ('t', float),
+        ('name', vlenstr),
+        ('frametype', vlenstr),
+        ('trigger_duration', float),
+        ('reduction', vlenstr),
+    ]
+    exposures = [(0.01 * i, 'benchmark', 'frame', 1e-3, '') for i in range(n_frames)]
+    with h5py.File(h5_filepath, 'w') as f:
+        group = f.create_group('devices/' + DEVICE_NAME)
+        group.create_dataset('EXPOSURES', data=np.array(exposures, dtype=table_dtypes))
+        device_properties = {
+            'camera_attributes': camera_attributes,
+            'stop_acquisition_timeout': 60.0,
+            'exception_on_failed_shot': True,
+            'saved_attribute_visibility_level': 'intermediate',
+            'image_storage': image_storage,
+            'image_reduction': None,
+        }
+        set_attributes(group, device_properties)
+
+
+def run_shot(worker, h5_filepath, n_frames, frame_size):
+    """Run one buffered shot and return a dict of results"""
+    # Record the times taken to transfer images at the end of the shot, if any:
+    transfer_times = []
+    transfer_images = worker.transfer_images
+    worker.transfer_images = lambda: transfer_times.append(transfer_images())
+    start_time = time.perf_counter()
+    worker.transition_to_buffered(DEVICE_NAME, h5_filepath, {}, False)
+    t2b_duration = time.perf_counter() - start_time
+    # Wait for the mock camera to deliver all frames, as it would during the shot:
+    worker.acquisition_thread.join()
+    acquisition_duration = time.perf_counter() - start_time - t2b_duration
+    t2m_start_time = time.perf_counter()
+    worker.transition_to_manual()
+    t2m_duration = time.perf_counter() - t2m_start_time
+    total_duration = time.perf_counter() - start_time
+    image_bytes = n_frames * frame_size[0] * frame_size[1] * 2
+    with h5py.File(h5_filepath, 'r') as f:
+        dset = f['images'][DEVICE_NAME]['benchmark']['frame']
+        stored_bytes = dset.id.get_storage_size()
+        assert len(dset) == n_frames
+    del worker.transfer_images
+    if transfer_times:
+        transfer_s, shot_file_write_s = transfer_times[0]
+    else:
+        transfer_s = shot_file_write_s = None
+    return {
+        'transfer_s': transfer_s,
+        'shot_file_write_s': shot_file_write_s,
+        'transition_to_buffered_s': t2b_duration,
+        'acquisition_s': acquisition_duration,
+        'transition_to_manual_s': t2m_duration,
+        'shot_fps': n_frames / (acquisition_duration + t2m_duration),
+        'write_MBps': image_bytes / 1e6 / (acquisition_duration + t2m_duration),
+        'compression_ratio': image_bytes / stored_bytes,
+        'total_s': total_duration,
+    }
+
+
+def run_continuous(worker, receiver):
+    """Run continuous acquisition for CONTINUOUS_DURATION and return a dict of
+    results"""
+    n_delivered = worker.camera.n_frames_delivered
+    n_received = receiver.n_received
+    worker.start_continuous(0)
+    time.sleep(CONTINUOUS_DURATION)
+    worker.stop_continuous()
+    n_delivered = worker.camera.n_frames_delivered - n_delivered
+    n_received = receiver.n_received - n_received
+    return {
+        'continuous_acquired_fps': n_delivered / CONTINUOUS_DURATION,
+        'continuous_displayed_fps': n_received / CONTINUOUS_DURATION,
+    }
+
+
+def run_benchmark(
+    frame_size,
+    n_frames,
+    storage_name,
+    frame_rate,
+    image_transfer='direct',
+    shot_directory=None,
+):
+    """Run the full benchmark for one configuration and return a dict of results"""
+    image_storage = check_image_storage(STORAGE_POLICIES[storage_name])
+    receiver = ImageReceiver()
+    tracemalloc.start()
+    try:
+        worker = make_worker(frame_size, frame_rate, receiver.port, image_transfer)
+        with tempfile.TemporaryDirectory(dir=shot_directory) as tempdir:
+            h5_filepath = os.path.join(tempdir, 'shot.h5')
+            make_shot_file(h5_filepath, worker.camera_attributes, n_frames, image_storage)
+            results = run_shot(worker, h5_filepath, n_frames, frame_size)
+        results.update(run_continuous(worker, receiver))
+        worker.shutdown()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        receiver.shutdown()
+    results['peak_memory_MB'] = peak_memory / 1e6
+    results.update(
+        {
+            'frame_height': frame_size[0],
+            'frame_width': frame_size[1],
+            'n_frames': n_frames,
+            'storage': storage_name,
+            'frame_rate': frame_rate,
+            'image_transfer': image_transfer,
+        }
+    )
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--frame-rate', type=float, default=100.0)
+    parser.add_argument(
+        '-o', '--output', default=None, help='File to write JSON results to'
+    )
+    parser.add_argument(
+        '--quick', action='store_true', help='Only run the smallest configuration'
+    )
+    parser.add_argument(
+        '--transfer',
+        metavar='DIRECTORY',
+        default=None,
+        help='Benchmark image transfer modes with shot files in the given directory',
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=600.0,
+        help='Seconds after which to dump all threads\' tracebacks and exit if a '
+        + 'configuration has not finished',
+    )
+    args = parser.parse_args()
+
+    frame_sizes = FRAME_SIZES[:1] if args.quick else FRAME_SIZES
+    frame_counts = FRAME_COUNTS[:1] if args.quick else FRAME_COUNTS
+    storage_names = list(STORAGE_POLICIES)[:1] if args.quick else STORAGE_POLICIES
+    if args.transfer is not None:
+        image_transfers = IMAGE_TRANSFER_MODES
+    else:
+        image_transfers = ['direct']
+
+    all_results = []
+    for frame_size in frame_sizes:
+        for n_frames in frame_counts:
+            for storage_name in storage_names:
+                for image_transfer in image_transfers:
+                    # Rather than hanging if, for example, the worker cannot connect:
+                    faulthandler.dump_traceback_later(args.timeout, exit=True)
+                    results = run_benchmark(
+                        frame_size,
+                        n_frames,
+                        storage_name,
+                        args.frame_rate,
+                        image_transfer,
+                        args.transfer,
+                    )
+                    faulthandler.cancel_dump_traceback_later()
+                    message = (
+                        f"{frame_size[0]}x{frame_size[1]} x {n_frames:4d}"
+                        + f" {storage_name:13s} {image_transfer:7s}"
+                        + f" {results['shot_fps']:8.1f} fps"
+                        + f" {results['write_MBps']:8.1f} MB/s"
+                        + f" t2m {results['transition_to_manual_s']:6.3f} s"
+                        + f" peak {results['peak_memory_MB']:8.1f} MB"
+                    )
+                    if results['transfer_s'] is not None:
+                        message += f" transfer {results['transfer_s']:6.3f} s"
+                    print(message, file=sys.stderr)
+                    all_results.append(results)
+
+    report = {
+        'benchmark': 'IMAQdxCamera pipeline',
+        'timestamp': datetime.now().isoformat(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'h5py': h5py.__version__,
+        'results': all_results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
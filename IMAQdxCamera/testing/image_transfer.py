@@ -0,0 +1,92 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/IMAQdxCamera/testing/image_transfer.py         #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Run a shot through the IMAQdxCamera worker with the mock camera in each image
+transfer mode ('direct', 'staged' and 'zmq'), and check that the shot file ends up with
+the frames the mock camera produced and the same image metadata in every mode. The
+worker runs as if on a remote computer. In the 'zmq' mode, its local path to the shot
+file is in a directory that does not exist, so the shot fails if the worker accesses
+the shot file itself rather than via the stand-in for the BLACS tab's ImageReceiver.
+
+As for benchmark_pipeline.py, a zlock server must be running.
+
+Syntax: python image_transfer.py [-n N_FRAMES]"""
+
+import os
+import sys
+import argparse
+import tempfile
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark_pipeline import ImageReceiver, make_worker, make_shot_file, DEVICE_NAME
+
+import labscript_devices.IMAQdxCamera.blacs_workers as blacs_workers
+from labscript_devices.IMAQdxCamera.utils import check_image_storage, IMAGE_TRANSFER_MODES
+
+FRAME_SIZE = (64, 96)
+
+
+def run_shot(receiver, h5_filepath, image_transfer, n_frames):
+    """Run a shot with the given image transfer mode. Return the frames and attributes
+    of the images group saved to the shot file, and the frames the camera produced"""
+    worker = make_worker(FRAME_SIZE, 0, receiver.port, image_transfer)
+    worker.is_remote = True
+    if image_transfer == 'zmq':
+        local_filepath = os.path.join(os.path.dirname(h5_filepath), 'absent', 'shot.h5')
+    else:
+        local_filepath = h5_filepath
+    path_to_local = blacs_workers.path_to_local
+    blacs_workers.path_to_local = lambda path: local_filepath
+    try:
+        make_shot_file(
+            h5_filepath, worker.camera_attributes, n_frames, check_image_storage({})
+        )
+        worker.transition_to_buffered(DEVICE_NAME, h5_filepath, {}, True)
+        worker.acquisition_thread.join()
+        worker.transition_to_manual()
+    finally:
+        blacs_workers.path_to_local = path_to_local
+        worker.shutdown()
+    frames = worker.camera.frames
+    expected = np.array([frames[i % len(frames)] for i in range(n_frames)])
+    with h5py.File(h5_filepath, 'r') as f:
+        group = f['images'][DEVICE_NAME]
+        saved = group['benchmark']['frame'][:]
+        attrs = {name: group.attrs[name] for name in group.attrs}
+    return saved, attrs, expected
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-frames', type=int, default=10)
+    args = parser.parse_args()
+
+    receiver = ImageReceiver()
+    try:
+        with tempfile.TemporaryDirectory() as tempdir:
+            h5_filepath = os.path.join(tempdir, 'shot.h5')
+            attribute_names = None
+            for image_transfer in IMAGE_TRANSFER_MODES:
+                saved, attrs, expected = run_shot(
+                    receiver, h5_filepath, image_transfer, args.n_frames
+                )
+                assert saved.shape == expected.shape, (saved.shape, expected.shape)
+                assert np.array_equal(saved, expected)
+                if attribute_names is None:
+                    attribute_names = sorted(attrs)
+                assert sorted(attrs) == attribute_names, (image_transfer, attrs)
+                print(f"{image_transfer:7s}: {len(saved)} frames saved OK")
+    finally:
+        receiver.shutdown()
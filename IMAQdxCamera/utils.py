@@ -0,0 +1,331 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/IMAQdxCamera/utils.py                          #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+import json
+import zlib
+import pickle
+import traceback
+from time import perf_counter
+import numpy as np
+from labscript_utils import dedent
+
+# Default image storage policy: images cast to uint16, one chunk per frame, as prior to
+# the introduction of configurable storage, but lzf rather than gzip compressed, since
+# frames are now compressed as they are acquired and gzip is too slow to keep up with
+# many cameras' frame rates:
+DEFAULT_IMAGE_STORAGE = {
+    'compression': 'lzf',
+    'compression_opts': None,
+    'chunks': 'frame',
+    'preserve_dtype': False,
+}
+
+
+def check_image_storage(image_storage):
+    """Validate an image storage policy dictionary and return it with default values
+    filled in for any missing keys. Raise ValueError or TypeError if invalid. Whether
+    a plugin filter is actually available is not checked here, since this depends on
+    the computer on which the images are saved."""
+    if image_storage is None:
+        image_storage = {}
+    for key in image_storage:
+        if key not in DEFAULT_IMAGE_STORAGE:
+            msg = "Unknown image_storage key '%s', allowed keys are %s"
+            raise ValueError(msg % (key, list(DEFAULT_IMAGE_STORAGE)))
+    image_storage = dict(DEFAULT_IMAGE_STORAGE, **image_storage)
+    compression = image_storage['compression']
+    if not (compression is None or isinstance(compression, (str, int))):
+        msg = "image_storage['compression'] must be None, a string or an int"
+        raise TypeError(msg)
+    if compression == 'gzip':
+        level = image_storage['compression_opts']
+        if level is not None and level not in range(10):
+            msg = "gzip compression_opts must be an integer 0-9, not %s"
+            raise ValueError(msg % str(level))
+    chunks = image_storage['chunks']
+    if chunks is None:
+        if compression is not None:
+            msg = """image_storage['chunks'] may only be None (contiguous storage) if
+                compression is also None"""
+            raise ValueError(dedent(msg))
+    elif chunks != 'frame':
+        if not (isinstance(chunks, (tuple, list)) and len(chunks) == 2):
+            msg = """image_storage['chunks'] must be 'frame', None, or a 2-tuple giving
+                the chunk shape within a frame, not %s"""
+            raise ValueError(dedent(msg) % str(chunks))
+        image_storage['chunks'] = tuple(chunks)
+    return image_storage
+
+
+def compression_kwargs(image_storage):
+    """Return the keyword arguments for h5py's create_dataset() that implement the
+    compression of the given (validated) image storage policy"""
+    compression = image_storage['compression']
+    opts = image_storage['compression_opts']
+    if compression is None:
+        return {}
+    if compression in ('gzip', 'lzf'):
+        return {'compression': compression, 'compression_opts': opts}
+    if isinstance(compression, int):
+        import h5py
+
+        if not h5py.h5z.filter_avail(compression):
+            msg = f"HDF5 filter with ID {compression} is not available"
+            raise RuntimeError(msg)
+        if opts is not None:
+            opts = tuple(opts)
+        return {'compression': compression, 'compression_opts': opts}
+    # Otherwise it should be the name of a filter provided by hdf5plugin:
+    try:
+        import hdf5plugin
+    except ImportError:
+        msg = f"""Compression '{compression}' requires the hdf5plugin package, which
+            could not be imported"""
+        raise RuntimeError(dedent(msg))
+    filter_class = getattr(hdf5plugin, compression, None)
+    if filter_class is None:
+        msg = f"hdf5plugin does not provide a filter named '{compression}'"
+        raise ValueError(msg)
+    if opts is None:
+        opts = {}
+    return dict(filter_class(**opts))
+
+
+def dataset_kwargs(image_storage, frame_shape, n_frames=None):
+    """Return the keyword arguments for h5py's create_dataset() to create a dataset
+    for storing a single frame of the given shape, or if n_frames is not None, a stack
+    of n_frames such frames, according to the given (validated) image storage policy.
+    Chunked datasets are resizable along the frame axis, so that they may be truncated
+    if fewer frames than expected are acquired."""
+    if n_frames is None:
+        shape = tuple(frame_shape)
+    else:
+        shape = (n_frames,) + tuple(frame_shape)
+    kwargs = {'shape': shape}
+    chunks = image_storage['chunks']
+    if chunks is not None:
+        if chunks == 'frame':
+            chunks = tuple(frame_shape)
+        # Chunk shape cannot exceed the frame shape:
+        chunks = tuple(min(c, n) for c, n in zip(chunks, frame_shape))
+        if n_frames is not None:
+            chunks = (1,) + chunks
+        kwargs['chunks'] = chunks
+        kwargs['maxshape'] = shape
+    kwargs.update(compression_kwargs(image_storage))
+    return kwargs
+
+
+# Default image reduction settings. No reduction is done by default.
+DEFAULT_IMAGE_REDUCTION = {
+    'roi': None,
+    'binning': 1,
+    'roi_sums': {},
+    'background': {},
+    'save_frames': True,
+}
+
+
+def _check_region(region, description):
+    """Validate a region (x, y, width, height) and return it as a tuple of ints"""
+    if not (isinstance(region, (tuple, list)) and len(region) == 4):
+        msg = "%s must be a tuple (x, y, width, height), not %s"
+        raise ValueError(msg % (description, str(region)))
+    x, y, width, height = [int(v) for v in region]
+    if x < 0 or y < 0 or width < 1 or height < 1:
+        msg = "%s must have non-negative x, y and positive width, height, not %s"
+        raise ValueError(msg % (description, str(region)))
+    return (x, y, width, height)
+
+
+def check_image_reduction(image_reduction):
+    """Validate an image reduction dictionary and return it with default values filled
+    in for any missing keys, or None if no reduction is requested. Raise ValueError if
+    invalid."""
+    if not image_reduction:
+        return None
+    for key in image_reduction:
+        if key not in DEFAULT_IMAGE_REDUCTION:
+            msg = "Unknown image_reduction key '%s', allowed keys are %s"
+            raise ValueError(msg % (key, list(DEFAULT_IMAGE_REDUCTION)))
+    image_reduction = dict(DEFAULT_IMAGE_REDUCTION, **image_reduction)
+    if image_reduction['roi'] is not None:
+        image_reduction['roi'] = _check_region(image_reduction['roi'], "roi")
+    binning = image_reduction['binning']
+    if isinstance(binning, int):
+        binning = (binning, binning)
+    if not (
+        isinstance(binning, (tuple, list))
+        and len(binning) == 2
+        and all(isinstance(b, int) and b >= 1 for b in binning)
+    ):
+        msg = "binning must be a positive int or a 2-tuple of them, not %s"
+        raise ValueError(msg % str(image_reduction['binning']))
+    image_reduction['binning'] = tuple(binning)
+    image_reduction['roi_sums'] = {
+        str(name): _check_region(region, f"roi_sums['{name}']")
+        for name, region in image_reduction['roi_sums'].items()
+    }
+    image_reduction['background'] = {
+        str(frametype): str(background)
+        for frametype, background in image_reduction['background'].items()
+    }
+    image_reduction['save_frames'] = bool(image_reduction['save_frames'])
+    if not (
+        image_reduction['save_frames']
+        or image_reduction['roi_sums']
+        or image_reduction['background']
+    ):
+        msg = """image_reduction with save_frames=False must specify roi_sums or
+            background, otherwise nothing would be saved"""
+        raise ValueError(dedent(msg))
+    return image_reduction
+
+
+def reduce_frame(image, image_reduction):
+    """Return the image cropped to the reduction's roi, if any, and binned according to
+    its binning. Binning sums pixels into a uint32 array, so that no information is
+    lost. If neither cropping nor binning is required, the image itself is returned."""
+    if image_reduction['roi'] is not None:
+        x, y, width, height = image_reduction['roi']
+        image = image[y : y + height, x : x + width]
+    bin_x, bin_y = image_reduction['binning']
+    if (bin_x, bin_y) != (1, 1):
+        height, width = image.shape[0] // bin_y, image.shape[1] // bin_x
+        blocks = image[: height * bin_y, : width * bin_x]
+        blocks = blocks.reshape(height, bin_y, width, bin_x)
+        image = blocks.sum(axis=(1, 3), dtype=np.uint32)
+    return image
+
+
+def reduced_frame_format(shape, dtype, image_reduction):
+    """Return the shape and dtype that frames of the given shape and dtype will have
+    once reduced by reduce_frame() according to the given image reduction"""
+    height, width = shape
+    if image_reduction['roi'] is not None:
+        x, y, roi_width, roi_height = image_reduction['roi']
+        # As for slicing, the roi is clipped to the frame:
+        height = len(range(height)[y : y + roi_height])
+        width = len(range(width)[x : x + roi_width])
+    bin_x, bin_y = image_reduction['binning']
+    if (bin_x, bin_y) != (1, 1):
+        return (height // bin_y, width // bin_x), np.dtype(np.uint32)
+    return (height, width), np.dtype(dtype)
+
+
+def roi_sums(image, image_reduction):
+    """Return a list of the sums of the pixels in each of the reduction's roi_sums
+    regions of the (unreduced) image"""
+    sums = []
+    for x, y, width, height in image_reduction['roi_sums'].values():
+        sums.append(image[y : y + height, x : x + width].sum(dtype=np.float64))
+    return sums
+
+
+# How a worker gets images into the shot file: 'direct' writes them into the shot file
+# as they are acquired, 'staged' writes them into a local scratch file and copies them
+# into the shot file at the end of the shot, and 'zmq' sends the scratch file to the
+# BLACS tab at the end of the shot, for it to copy the images into the shot file. In
+# the 'zmq' mode the worker also gets the shot's exposures and device properties from
+# the BLACS tab, so that it does not access the shot file at all. Its requests are sent
+# on the same connection as frames for display, see handle_shot_request().
+IMAGE_TRANSFER_MODES = ('direct', 'staged', 'zmq')
+
+
+def check_image_transfer(image_transfer):
+    """Raise ValueError if image_transfer is not one of IMAGE_TRANSFER_MODES"""
+    if image_transfer not in IMAGE_TRANSFER_MODES:
+        msg = "image_transfer must be one of %s, not %s"
+        raise ValueError(msg % (IMAGE_TRANSFER_MODES, repr(image_transfer)))
+
+
+def copy_group(source, destination):
+    """Recursively copy the attributes, groups and datasets of the HDF5 group source
+    into the group destination, which may be in a different file. Datasets are copied
+    whole with h5py's Group.copy(), which copies their chunks without decompressing and
+    recompressing them."""
+    import h5py
+
+    for name, value in source.attrs.items():
+        destination.attrs[name] = value
+    for name, item in source.items():
+        if isinstance(item, h5py.Group):
+            copy_group(item, destination.require_group(name))
+        else:
+            source.copy(item, destination, name=name)
+
+
+def read_shot_properties(h5_filepath, device_name):
+    """Return the EXPOSURES table of the named camera in the shot file h5_filepath and
+    the camera's device properties, or (None, None) if the camera has no exposures in
+    the shot"""
+    import h5py
+    import labscript_utils.properties
+
+    with h5py.File(h5_filepath, 'r') as f:
+        group = f['devices'][device_name]
+        if not 'EXPOSURES' in group:
+            return None, None
+        exposures = group['EXPOSURES'][:]
+        properties = labscript_utils.properties.get(f, device_name, 'device_properties')
+    return exposures, properties
+
+
+def write_image_file(image_file, h5_filepath, image_path):
+    """Copy the group at image_path in the HDF5 file image_file, which may be a path
+    or the contents of a file as bytes, into the same location in the shot file
+    h5_filepath. Return the time taken in seconds"""
+    import h5py
+
+    start_time = perf_counter()
+    if isinstance(image_file, bytes):
+        # Opened as a file ID, which h5_lock does not lock, since no other process can
+        # access the file:
+        image_file = h5py.h5f.open_file_image(image_file)
+    with h5py.File(image_file, 'r') as source:
+        with h5py.File(h5_filepath, 'a') as f:
+            copy_group(source[image_path], f.require_group(image_path))
+    return perf_counter() - start_time
+
+
+def handle_shot_request(metadata, data):
+    """Carry out a request from a worker using the 'zmq' image transfer mode, given the
+    request's decoded JSON metadata and the remaining parts of the message, and return
+    the parts of the response. The request's 'type' is either:
+
+    * 'shot_properties': read the EXPOSURES table and device properties of the camera
+      'device_name' from the shot file 'h5_filepath'. The response is an empty JSON
+      object followed by the pickled tuple (exposures, properties), as returned by
+      read_shot_properties().
+    * 'shot_images': copy the images at 'image_path' in the zlib-compressed HDF5 file
+      that is the message's second part into the shot file 'h5_filepath'. The response
+      is JSON with the time taken to write the shot file.
+
+    If an exception occurs, the response is JSON with its traceback instead."""
+    try:
+        if metadata['type'] == 'shot_properties':
+            shot_properties = read_shot_properties(
+                metadata['h5_filepath'], metadata['device_name']
+            )
+            # Pickled, since the table's string columns are object arrays and the
+            # properties include numpy scalars. Workers already exchange pickled data
+            # with BLACS:
+            return [json.dumps({}).encode('utf8'), pickle.dumps(shot_properties)]
+        elif metadata['type'] == 'shot_images':
+            write_time = write_image_file(
+                zlib.decompress(data[0]), metadata['h5_filepath'], metadata['image_path']
+            )
+            return [json.dumps({'write_time': write_time}).encode('utf8')]
+        else:
+            raise ValueError(f"Unknown request type {metadata['type']!r}")
+    except Exception:
+        return [json.dumps({'error': traceback.format_exc()}).encode('utf8')]
@@ -672,8 +672,13 @@ class NI_DAQmxWaitMonitorWorker(Worker):
         self.DO_task = None
         self.wait_table = None
         self.semiperiods = None
+        self.resume_latencies = None
         self.wait_monitor_thread = None
 
+        # Preallocated buffers for reading one or two edges from the counter input
+        # task, so that we don't allocate a new array on every read:
+        self.edge_buffers = {1: np.zeros(1), 2: np.zeros(2)}
+
         # Saved error in case one occurs in the thread, we can raise it later in
         # transition_to_manual:
         self.wait_monitor_thread_exception = None
@@ -704,7 +709,9 @@ class NI_DAQmxWaitMonitorWorker(Worker):
 
     def read_edges(self, npts, timeout=None):
         """Wait up to the given timeout in seconds for an edge on the wait monitor and
-        and return the duration since the previous edge. Return None upon timeout."""
+        and return the duration since the previous edge. Return None upon timeout. The
+        returned array is a preallocated buffer that is reused by subsequent calls, so
+        callers must copy out any values they wish to keep before reading again."""
         samples_read = int32()
         # If no timeout, call read repeatedly with a 0.2 second timeout to ensure we
         # don't block indefinitely and can still abort.
@@ -712,7 +719,7 @@ class NI_DAQmxWaitMonitorWorker(Worker):
             read_timeout = 0.2
         else:
             read_timeout = timeout
-        read_array = np.zeros(npts)
+        read_array = self.edge_buffers[npts]
         while True:
             if self.shutting_down:
                 raise RuntimeError('Stopped before expected number of samples acquired')
@@ -750,12 +757,13 @@ class NI_DAQmxWaitMonitorWorker(Worker):
                 current_time = pulse_width = semiperiods[-1]
                 self.semiperiods.append(semiperiods[-1])
                 # Alright, we're now a short way into the experiment.
-                for wait in self.wait_table:
+                for i, wait in enumerate(self.wait_table):
                     # How long until when the next wait should timeout?
                     timeout = wait['time'] + wait['timeout'] - current_time
                     timeout = max(timeout, 0)  # ensure non-negative
                     # Wait that long for the next pulse:
                     self.logger.debug('Waiting for pulse indicating end of wait')
+                    deadline = time.monotonic() + timeout
                     semiperiods = self.read_edges(2, timeout)
                     # Did the wait finish of its own accord, or time out?
                     if semiperiods is None:
@@ -764,7 +772,13 @@ class NI_DAQmxWaitMonitorWorker(Worker):
                             ({} edge)"""
                         msg = dedent(msg).format(pulse_width, self.timeout_trigger_type)
                         self.logger.debug(msg)
-                        self.send_resume_trigger(pulse_width)
+                        trigger_time = self.send_resume_trigger(pulse_width)
+                        # How late did the resume trigger fire compared to the
+                        # requested timeout?
+                        self.resume_latencies[i] = trigger_time - deadline
+                        self.logger.debug(
+                            'Resume trigger latency: %.3e s', self.resume_latencies[i]
+                        )
                         # Wait for it to respond to that:
                         self.logger.debug('Waiting for pulse indicating end of wait')
                         semiperiods = self.read_edges(2, timeout=None)
@@ -784,11 +798,14 @@ class NI_DAQmxWaitMonitorWorker(Worker):
             self.wait_monitor_thread_exception = sys.exc_info()
 
     def send_resume_trigger(self, pulse_width):
+        """Pulse the timeout output to resume the master pseudoclock. Return the
+        time.monotonic() time at which the trigger edge was written."""
         written = int32()
         # Trigger:
         self.DO_task.WriteDigitalLines(
             1, True, 1, DAQmx_Val_GroupByChannel, self.timeout_trigger, written, None
         )
+        trigger_time = time.monotonic()
         # Wait however long we observed the first pulse of the experiment to be. In
         # practice this is likely to be negligible compared to the other software delays
         # here, but in case it is larger we'd better wait:
@@ -797,6 +814,7 @@ class NI_DAQmxWaitMonitorWorker(Worker):
         self.DO_task.WriteDigitalLines(
             1, True, 1, DAQmx_Val_GroupByChannel, self.timeout_rearm, written, None
         )
+        return trigger_time
 
     def stop_tasks(self, abort):
         self.logger.debug('stop_tasks')
@@ -875,6 +893,9 @@ class NI_DAQmxWaitMonitorWorker(Worker):
 
         # An array to store the results of counter acquisition:
         self.semiperiods = []
+        # Latency of each timeout-triggered resume relative to the requested timeout,
+        # NaN for waits that did not time out:
+        self.resume_latencies = np.full(len(self.wait_table), np.nan)
         self.wait_monitor_thread = threading.Thread(target=self.wait_monitor)
         # Not a daemon thread, as it implements wait timeouts - we need it to stay alive
         # if other things die.
@@ -913,6 +934,7 @@ class NI_DAQmxWaitMonitorWorker(Worker):
                 ('timeout', float),
                 ('duration', float),
                 ('timed_out', bool),
+                ('resume_latency', float),
             ]
             data = np.empty(len(self.wait_table), dtype=dtypes)
             data['label'] = self.wait_table['label']
@@ -920,12 +942,14 @@ class NI_DAQmxWaitMonitorWorker(Worker):
             data['timeout'] = self.wait_table['timeout']
             data['duration'] = wait_durations
             data['timed_out'] = waits_timed_out
+            data['resume_latency'] = self.resume_latencies
             with h5py.File(self.h5_file, 'a') as hdf5_file:
                 hdf5_file.create_dataset('/data/waits', data=data)
             self.wait_durations_analysed.post(self.h5_file)
 
         self.h5_file = None
         self.semiperiods = None
+        self.resume_latencies = None
         return True
 
     def abort_buffered(self):
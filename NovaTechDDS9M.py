@@ -36,16 +36,19 @@ class NovaTechDDS9M(IntermediateDevice):
     'update_mode' -- synchronous or asynchronous\
     'baud_rate',  -- operating baud rate
     'default_baud_rate' -- assumed baud rate at startup
+    'pipeline_depth' -- maximum number of commands sent ahead of their
+                        acknowledgement when programming. 1 to send each
+                        command only once the previous one is acknowledged
     """
     description = 'NT-DDS9M'
     allowed_children = [DDS, StaticDDS]
     clock_limit = 9990 # This is a realistic estimate of the max clock rate (100us for TS/pin10 processing to load next value into buffer and 100ns pipeline delay on pin 14 edge to update output values)
 
     @set_passed_properties(
-        property_names = {'connection_table_properties': ['com_port', 'baud_rate', 'default_baud_rate', 'update_mode', 'synchronous_first_line_repeat', 'phase_mode']}
+        property_names = {'connection_table_properties': ['com_port', 'baud_rate', 'default_baud_rate', 'update_mode', 'synchronous_first_line_repeat', 'phase_mode', 'pipeline_depth']}
         )
     def __init__(self, name, parent_device, 
-                 com_port = "", baud_rate=115200, default_baud_rate=None, update_mode='synchronous', synchronous_first_line_repeat=False, phase_mode='default', **kwargs):
+                 com_port = "", baud_rate=115200, default_baud_rate=None, update_mode='synchronous', synchronous_first_line_repeat=False, phase_mode='default', pipeline_depth=8, **kwargs):
 
         IntermediateDevice.__init__(self, name, parent_device, **kwargs)
         self.BLACS_connection = '%s,%s'%(com_port, str(baud_rate))
@@ -62,6 +65,9 @@ class NovaTechDDS9M(IntermediateDevice):
         if not phase_mode in ['default', 'aligned', 'continuous']:
             raise LabscriptError('phase_mode must be \'default\', \'aligned\' or \'continuous\'')
 
+        if not isinstance(pipeline_depth, int) or pipeline_depth < 1:
+            raise LabscriptError('pipeline_depth must be an integer >= 1')
+
         self.update_mode = update_mode
         self.phase_mode = phase_mode 
         self.synchronous_first_line_repeat = synchronous_first_line_repeat
@@ -213,12 +219,135 @@ class NovaTechDDS9M(IntermediateDevice):
 
 
 import time
+from collections import deque
 
 from blacs.tab_base_classes import Worker, define_state
 from blacs.tab_base_classes import MODE_MANUAL, MODE_TRANSITION_TO_BUFFERED, MODE_TRANSITION_TO_MANUAL, MODE_BUFFERED  
 
 from blacs.device_base_class import DeviceTab
 
+# Command programming one table entry, with the channel, address, frequency, phase and
+# amplitude to be filled in as lowercase hexadecimal digits:
+TABLE_COMMAND_TEMPLATE = b't0 0000 00000000,0000,0000,ff\r\n'
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+
+def hex_digits(values, width):
+    """Return an array of shape (len(values), width) containing the ASCII codes of the
+    lowercase hexadecimal representations of values, zero padded to width digits"""
+    shifts = 4 * np.arange(width - 1, -1, -1, dtype=np.uint32)
+    return HEX_DIGITS[(values.astype(np.uint32)[:, np.newaxis] >> shifts) & 0xF]
+
+
+def changed_table_entries(table, old_table):
+    """Return a boolean array of shape (len(table), 2) which is True for each row and
+    channel of table that differs from old_table, or is beyond its end"""
+    n_common = min(len(table), len(old_table))
+    changed = np.ones((len(table), 2), dtype=bool)
+    if not n_common:
+        return changed
+    changed[:n_common] = False
+    for name in ['freq', 'phase', 'amp']:
+        # Compare both channels at once:
+        new = np.column_stack([table[name + '0'][:n_common], table[name + '1'][:n_common]])
+        old = np.column_stack([old_table[name + '0'][:n_common], old_table[name + '1'][:n_common]])
+        changed[:n_common] |= new != old
+    return changed
+
+
+def contiguous_ranges(mask):
+    """Return a list of (start, stop) index pairs of the runs of True in a 1D boolean
+    array"""
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def format_table_commands(table, rows, channels):
+    """Return the commands programming the given rows of table into the given
+    channels, concatenated. rows and channels are arrays of equal length. Each command
+    is len(TABLE_COMMAND_TEMPLATE) bytes long"""
+    commands = np.empty((len(rows), len(TABLE_COMMAND_TEMPLATE)), dtype=np.uint8)
+    commands[:] = np.frombuffer(TABLE_COMMAND_TEMPLATE, dtype=np.uint8)
+    commands[:, 1] = ord('0') + channels
+    commands[:, 3:7] = hex_digits(rows, 4)
+    for name, start, width in [('freq', 8, 8), ('phase', 17, 4), ('amp', 22, 4)]:
+        values = np.where(channels == 0, table[name + '0'][rows], table[name + '1'][rows])
+        commands[:, start:start + width] = hex_digits(values, width)
+    return commands.tobytes()
+
+
+class CommandPipeline(object):
+    """Sends commands to the NovaTech over a serial connection without waiting for
+    each one to be acknowledged before sending the next. Up to `depth` commands may be
+    awaiting acknowledgement at a time, bounding how much the NovaTech must buffer.
+    Acknowledgements are checked in order as they arrive, and flush() waits for all
+    outstanding ones. Since acknowledgements do not say which command they are for,
+    `depth` must be small enough for the commands in flight to fit in the NovaTech's
+    input buffer: a command lost to a buffer overflow would go undetected.
+
+    If any response is not "OK", the responses still due are discarded and all
+    unacknowledged commands are resent one at a time, waiting for each to be
+    acknowledged, before pipelining resumes. Only idempotent commands (those that set
+    a value) may therefore be sent through the pipeline. A command that fails
+    max_retries more times in lock-step raises an exception."""
+    max_retries = 2
+
+    def __init__(self, connection, depth=8, logger=None):
+        self.connection = connection
+        self.depth = depth
+        self.logger = logger
+        self.in_flight = deque()
+        # Number of times we have had to resend commands in lock-step:
+        self.n_fallbacks = 0
+        # Total number of bytes written, including resent commands:
+        self.n_bytes_sent = 0
+
+    def send(self, command):
+        if self.depth <= 1:
+            self.send_lockstep(command)
+            return
+        self.connection.write(command)
+        self.n_bytes_sent += len(command)
+        self.in_flight.append(command)
+        if len(self.in_flight) >= self.depth:
+            self.check_response()
+
+    def send_lockstep(self, command):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # Discard any late response before trying again:
+                self.connection.readlines()
+            self.connection.write(command)
+            self.n_bytes_sent += len(command)
+            if self.connection.readline() == b"OK\r\n":
+                return
+        raise Exception('Error: Failed to execute command: %s' % command.decode('utf8'))
+
+    def check_response(self):
+        """Read and check the response to the oldest command in flight"""
+        response = self.connection.readline()
+        if response == b"OK\r\n":
+            self.in_flight.popleft()
+            return
+        unacknowledged = list(self.in_flight)
+        self.in_flight.clear()
+        self.n_fallbacks += 1
+        if self.logger is not None:
+            msg = ('Got response %r to command %r with %d commands in flight, ' +
+                   'resending them one at a time.')
+            self.logger.warning(msg % (response, unacknowledged[0], len(unacknowledged)))
+        # Discard responses to the remaining commands in flight. This reads until the
+        # serial timeout elapses with nothing received:
+        self.connection.readlines()
+        for command in unacknowledged:
+            self.send_lockstep(command)
+
+    def flush(self):
+        """Wait for all commands in flight to be acknowledged"""
+        while self.in_flight:
+            self.check_response()
+
+
 @BLACS_tab
 class NovatechDDS9MTab(DeviceTab):
     def initialise_GUI(self):        
@@ -257,6 +386,7 @@ class NovatechDDS9MTab(DeviceTab):
         self.baud_rate = connection_table_properties.get('baud_rate', None)
         self.default_baud_rate = connection_table_properties.get('default_baud_rate', None)
         self.update_mode = connection_table_properties.get('update_mode', 'synchronous')
+        self.pipeline_depth = connection_table_properties.get('pipeline_depth', 8)
         
         # Backward compat:
         blacs_connection =  str(connection_object.BLACS_connection)
@@ -277,20 +407,42 @@ class NovatechDDS9MTab(DeviceTab):
                                                               'baud_rate': self.baud_rate,
                                                               'default_baud_rate': self.default_baud_rate,
                                                               'update_mode': self.update_mode,
-                                                              'phase_mode': self.phase_mode})
+                                                              'phase_mode': self.phase_mode,
+                                                              'pipeline_depth': self.pipeline_depth})
         self.primary_worker = "main_worker"
 
         # Set the capabilities of this device
         self.supports_remote_value_check(True)
         self.supports_smart_programming(True) 
 
+        # Read back output values once front panel changes have been programmed:
+        self.statemachine_timeout_add(250, self.readback_if_due)
+
+    @define_state(MODE_MANUAL, True)
+    def readback_if_due(self):
+        due = yield(self.queue_work(self.primary_worker, 'readback_due'))
+        if due:
+            self.check_remote_values()
+
 
 class NovatechDDS9mWorker(Worker):
+    # Rather than reading back the output values after every front panel change, they
+    # are read back once no changes have been made for readback_delay seconds, or at
+    # most every readback_interval seconds whilst changes continue:
+    readback_delay = 0.5
+    readback_interval = 2.0
+
     def init(self):
         global serial; import serial
         global socket; import socket
         global h5py; import labscript_utils.h5_lock, h5py
         self.smart_cache = {'STATIC_DATA': None, 'TABLE_DATA': ''}
+        # The last command sent to program each (channel, subchnl) in manual mode, so
+        # that unchanged values are not reprogrammed:
+        self.manual_commands = {}
+        self.readback_pending = False
+        self.last_program_time = 0
+        self.last_readback_time = 0
         
         if self.default_baud_rate is not None:
             initial_baud_rate = self.default_baud_rate
@@ -350,6 +502,8 @@ class NovatechDDS9mWorker(Worker):
         if self.connection.readline() != b"OK\r\n":
             raise Exception('Error: Failed to execute command: "%s"'%self.phase_mode.decode('utf8'))
         
+        self.pipeline = CommandPipeline(self.connection, self.pipeline_depth, self.logger)
+
         #return self.get_current_values()
         
     def check_connection(self):
@@ -383,19 +537,48 @@ class NovatechDDS9mWorker(Worker):
             results['channel %d'%i]['amp'] = int(amp,16)/1023.0
             # Convert hex fraction of 16384 to degrees:
             results['channel %d'%i]['phase'] = int(phase,16)*360/16384.0
+        self.readback_pending = False
+        self.last_readback_time = time.time()
         return results
+
+    def readback_due(self):
+        """Return whether values have been programmed since the output values were last
+        read back, and it is time to read them back with check_remote_values(). Called
+        periodically by the tab"""
+        if not self.readback_pending:
+            return False
+        now = time.time()
+        return (now - self.last_program_time >= self.readback_delay or
+                now - self.last_readback_time >= self.readback_interval)
         
     def program_manual(self,front_panel_values):
-        # TODO: Optimise this so that only items that have changed are reprogrammed by storing the last programmed values
+        changed = False
         # For each DDS channel,
         for i in range(4):    
             # and for each subchnl in the DDS,
             for subchnl in ['freq','amp','phase']:     
-                # Program the sub channel
-                self.program_static(i,subchnl,front_panel_values['channel %d'%i][subchnl])
-        return self.check_remote_values()
+                # Program the sub channel if it has changed
+                if self.program_static(i,subchnl,front_panel_values['channel %d'%i][subchnl]):
+                    changed = True
+        if changed:
+            self.readback_pending = True
+            self.last_program_time = time.time()
+        # Instead of reading back the output values now, which would take several
+        # serial transactions per front panel change, return the values the device will
+        # have rounded them to. The tab reads them back later, see readback_due():
+        results = {}
+        for i in range(4):
+            values = front_panel_values['channel %d'%i]
+            results['channel %d'%i] = {
+                'freq': round(values['freq']*10)/10.0,
+                'amp': int(values['amp']*1023+0.5)/1023.0,
+                'phase': int(values['phase']*16384/360)*360/16384.0,
+            }
+        return results
 
     def program_static(self,channel,type,value):
+        """Program a value into a channel, unless the same value was the last one
+        programmed. Return whether it was programmed"""
         if type == 'freq':
             command = b'F%d %.7f\r\n'%(channel,value/10.0**6)
         elif type == 'amp':
@@ -404,13 +587,21 @@ class NovatechDDS9mWorker(Worker):
             command = b'P%d %u\r\n'%(channel,value*16384/360)
         else:
             raise TypeError(type)
+        if self.manual_commands.get((channel, type)) == command:
+            return False
+        # Forget the value until we know it has been programmed:
+        self.manual_commands.pop((channel, type), None)
         self.connection.write(command)
         if self.connection.readline() != b"OK\r\n":
             raise Exception('Error: Failed to execute command: %s' % command.decode('utf8'))
+        self.manual_commands[(channel, type)] = command
         # Now that a static update has been done, we'd better invalidate the saved STATIC_DATA:
         self.smart_cache['STATIC_DATA'] = None
+        return True
      
     def transition_to_buffered(self,device_name,h5file,initial_values,fresh):
+        # Values programmed in manual mode will be overwritten by the shot:
+        self.manual_commands = {}
 
         # Pretty please reset your memory pointer to zero:
 
@@ -437,24 +628,24 @@ class NovatechDDS9mWorker(Worker):
             # Now program the buffered outputs:
             if 'TABLE_DATA' in group:
                 table_data = group['TABLE_DATA'][:]
-        
+
+        upload_start_time = time.time()
+        n_bytes_sent = self.pipeline.n_bytes_sent
+        n_rows_changed = 0
+        n_ranges_changed = 0
+        n_entries_changed = 0
         if static_data is not None:
             data = static_data
             if fresh or data != self.smart_cache['STATIC_DATA']:
                 self.logger.debug('Static data has changed, reprogramming.')
                 self.smart_cache['STATIC_DATA'] = data
-                self.connection.write(b'F2 %.7f\r\n'%(data['freq2']/10.0**7))
-                self.connection.readline()
-                self.connection.write(b'V2 %u\r\n'%(data['amp2']))
-                self.connection.readline()
-                self.connection.write(b'P2 %u\r\n'%(data['phase2']))
-                self.connection.readline()
-                self.connection.write(b'F3 %.7f\r\n'%(data['freq3']/10.0**7))
-                self.connection.readline()
-                self.connection.write(b'V3 %u\r\n'%data['amp3'])
-                self.connection.readline()
-                self.connection.write(b'P3 %u\r\n'%data['phase3'])
-                self.connection.readline()
+                self.pipeline.send(b'F2 %.7f\r\n'%(data['freq2']/10.0**7))
+                self.pipeline.send(b'V2 %u\r\n'%(data['amp2']))
+                self.pipeline.send(b'P2 %u\r\n'%(data['phase2']))
+                self.pipeline.send(b'F3 %.7f\r\n'%(data['freq3']/10.0**7))
+                self.pipeline.send(b'V3 %u\r\n'%data['amp3'])
+                self.pipeline.send(b'P3 %u\r\n'%data['phase3'])
+                self.pipeline.flush()
                 
                 # Save these values into final_values so the GUI can
                 # be updated at the end of the run to reflect them:
@@ -470,16 +661,32 @@ class NovatechDDS9mWorker(Worker):
         # Now program the buffered outputs:
         if table_data is not None:
             data = table_data
-            for i, line in enumerate(data):
-                st = time.time()
+            st = time.time()
+            if fresh:
+                oldtable = data[:0]
+            else:
                 oldtable = self.smart_cache['TABLE_DATA']
-                for ddsno in range(2):
-                    if fresh or i >= len(oldtable) or (line['freq%d'%ddsno],line['phase%d'%ddsno],line['amp%d'%ddsno]) != (oldtable[i]['freq%d'%ddsno],oldtable[i]['phase%d'%ddsno],oldtable[i]['amp%d'%ddsno]):
-                        self.connection.write(b't%d %04x %08x,%04x,%04x,ff\r\n'%(ddsno, i,line['freq%d'%ddsno],line['phase%d'%ddsno],line['amp%d'%ddsno]))
-                        self.connection.readline()
-                et = time.time()
-                tt=et-st
-                self.logger.debug('Time spent on line %s: %s'%(i,tt))
+            # Only the rows and channels that differ from the previous table need to be
+            # programmed. Shots in a scan often differ in only a few contiguous ranges
+            # of rows:
+            changed = changed_table_entries(data, oldtable)
+            ranges = contiguous_ranges(changed.any(axis=1))
+            rows, channels = np.nonzero(changed)
+            commands = format_table_commands(data, rows, channels)
+            command_length = len(TABLE_COMMAND_TEMPLATE)
+            try:
+                for i in range(0, len(commands), command_length):
+                    self.pipeline.send(commands[i:i + command_length])
+                self.pipeline.flush()
+            except Exception:
+                # The device's table is no longer known:
+                self.smart_cache['TABLE_DATA'] = ''
+                raise
+            n_rows_changed = sum(stop - start for start, stop in ranges)
+            n_ranges_changed = len(ranges)
+            n_entries_changed = len(rows)
+            et = time.time()
+            self.logger.debug('Time spent programming %d table entries in %d ranges: %s'%(n_entries_changed, n_ranges_changed, et-st))
             # Store the table for future smart programming comparisons:
             try:
                 self.smart_cache['TABLE_DATA'][:len(data)] = data
@@ -513,7 +720,15 @@ class NovatechDDS9mWorker(Worker):
                 pass
             else:
                 raise ValueError('invalid update mode %s'%str(self.update_mode))
-                
+
+        # Save statistics of what was programmed for this shot:
+        with h5py.File(h5file, 'r+') as hdf5_file:
+            group = hdf5_file.require_group('/data/' + device_name)
+            group.attrs['table_rows_changed'] = n_rows_changed
+            group.attrs['table_ranges_changed'] = n_ranges_changed
+            group.attrs['table_entries_changed'] = n_entries_changed
+            group.attrs['bytes_sent'] = self.pipeline.n_bytes_sent - n_bytes_sent
+            group.attrs['upload_time'] = time.time() - upload_start_time
             
         return self.final_values
     
@@ -17,6 +17,7 @@ if PY2:
 
 from labscript import PseudoclockDevice, Pseudoclock, ClockLine, config, LabscriptError, set_passed_properties
 from labscript_devices import runviewer_parser, BLACS_tab
+from labscript_devices.clock_expansion import expand_clock
 
 import numpy as np
 import labscript_utils.h5_lock, h5py
@@ -148,31 +149,21 @@ class RunviewerClass(object):
         with h5py.File(self.path, 'r') as f:
             pulse_program = f['devices/%s/PULSE_PROGRAM'%self.name][:]
             
-        time = []
-        states = []
-        trigger_index = 0
-        t = 0 if clock is None else clock_ticks[trigger_index]+self.trigger_delay
-        trigger_index += 1
+        # The first trigger starts the clock, and the rest resume it after waits:
+        if clock is None:
+            t0, resume_times = 0, None
+        else:
+            t0 = clock_ticks[0]+self.trigger_delay
+            resume_times = clock_ticks[1:]+self.trigger_delay
         
         clock_factor = self.clock_resolution/2.
+        half_periods = pulse_program['period']*clock_factor
         
-        for row in pulse_program:
-            if row['period'] == 0:
-                #special case
-                if row['reps'] == 1: # WAIT
-                    if clock is not None:
-                        t = clock_ticks[trigger_index]+self.trigger_delay
-                        trigger_index += 1
-                    else:
-                        t += self.wait_delay
-            else:    
-                for i in range(row['reps']):
-                    for j in range(1, -1, -1):
-                        time.append(t)
-                        states.append(j)
-                        t += row['period']*clock_factor
-        
-        clock = (np.array(time), np.array(states))
+        # period 0 is a special case: reps 1 is a WAIT, reps 0 is a stop
+        waits = (pulse_program['period'] == 0) & (pulse_program['reps'] == 1)
+        stops = (pulse_program['period'] == 0) & (pulse_program['reps'] == 0)
+        clock = expand_clock(half_periods, half_periods, pulse_program['reps'], waits, stops=stops,
+                             t0=t0, wait_delay=self.wait_delay, resume_times=resume_times)
         
         clocklines_and_triggers = {}
         for pseudoclock_name, pseudoclock in self.device.child_list.items():
@@ -15,17 +15,80 @@
 # Refactored as a BLACS worker by cbillington
 # Ported to Pylon API by dihm
 
+import threading
+from time import perf_counter
+from collections import namedtuple
 import numpy as np
 from labscript_utils import dedent
 
-from labscript_devices.IMAQdxCamera.blacs_workers import IMAQdxCameraWorker
+from labscript_devices.IMAQdxCamera.blacs_workers import (
+    IMAQdxCameraWorker,
+    FrameTelemetry,
+)
 
 # Don't import API yet so as not to throw an error, allow worker to run as a dummy
 # device, or for subclasses to import this module to inherit classes without requiring API
 pylon = None
 genicam = None
 
+# Entry in Pylon_Camera's feature index. visibility is 0, 1 or 2 for Beginner, Expert
+# and Guru features respectively, and prerequisites lists the features that must be
+# set before this one if being set at the same time:
+Feature = namedtuple('Feature', ['node', 'visibility', 'interface', 'prerequisites'])
+
+
+def _make_image_event_handler(camera):
+    """Return a pylon image event handler passing grab results to the given
+    Pylon_Camera. Defined within a function since pypylon is not imported until a
+    Pylon_Camera is instantiated."""
+
+    class ImageEventHandler(pylon.ImageEventHandler):
+        def OnImageGrabbed(self, instant_camera, grab_result):
+            camera._on_image_grabbed(grab_result)
+
+        def OnImagesSkipped(self, instant_camera, n_skipped):
+            camera._on_images_skipped(n_skipped)
+
+    return ImageEventHandler()
+
+
 class Pylon_Camera(object):
+    # Stream grabber statistics to record for each shot, where the transport layer
+    # provides them:
+    stream_statistics = {
+        'buffer_underruns': 'Statistic_Buffer_Underrun_Count',
+        'missed_frames': 'Statistic_Missed_Frame_Count',
+        'failed_buffers': 'Statistic_Failed_Buffer_Count',
+    }
+
+    # Features that must be set before the given features if both are being set,
+    # because they change the meaning or allowed values of the latter:
+    feature_dependencies = {
+        'Width': ['BinningHorizontal', 'DecimationHorizontal'],
+        'OffsetX': ['BinningHorizontal', 'DecimationHorizontal'],
+        'Height': ['BinningVertical', 'DecimationVertical'],
+        'OffsetY': ['BinningVertical', 'DecimationVertical'],
+        'BinningHorizontal': ['BinningHorizontalMode'],
+        'BinningVertical': ['BinningVerticalMode'],
+        'AcquisitionFrameRate': ['AcquisitionFrameRateEnable'],
+        'ExposureTime': ['ExposureMode', 'ExposureAuto'],
+        'Gain': ['GainSelector', 'GainAuto'],
+        'BlackLevel': ['BlackLevelSelector'],
+        'TriggerMode': ['TriggerSelector'],
+        'TriggerSource': ['TriggerSelector'],
+        'TriggerActivation': ['TriggerSelector'],
+        'TriggerDelay': ['TriggerSelector'],
+        'LineMode': ['LineSelector'],
+        'LineSource': ['LineSelector'],
+        'LineInverter': ['LineSelector'],
+        'BalanceRatio': ['BalanceRatioSelector', 'BalanceWhiteAuto'],
+    }
+
+    # Size and offset features of the ROI in each direction, with the maximum size:
+    roi_features = [('Width', 'OffsetX', 'WidthMax'), ('Height', 'OffsetY', 'HeightMax')]
+
+    visibility_levels = {'simple': 0, 'intermediate': 1, 'advanced': 2}
+
     def __init__(self, serial_number):
         
         global pylon
@@ -44,73 +107,150 @@ class Pylon_Camera(object):
                         pylon.RegistrationMode_ReplaceAll, pylon.Cleanup_Delete)
         # Keep a nodeMap reference so we don't have to re-create a lot
         self.nodeMap = self.camera.GetNodeMap()
+        self.feature_index = self._build_feature_index()
         self._abort_acquisition = False
+        # Per-frame timing of buffered acquisition, saved to the shot file by the worker:
+        self.telemetry = FrameTelemetry()
+        # During buffered acquisition, frames are delivered by pylon's grab loop thread
+        # to an image event handler, which appends them to the frame sink given to
+        # grab_multiple() as they arrive:
+        self.image_event_handler = _make_image_event_handler(self)
+        self.camera.RegisterImageEventHandler(
+            self.image_event_handler, pylon.RegistrationMode_Append, pylon.Cleanup_None
+        )
+        self._buffered = False
+        self._sink_lock = threading.Lock()
+        self._sink = None
+        self._pending_images = []
+        self._n_images = None
+        self._n_received = 0
+        self._grab_complete = threading.Event()
+        self._statistics = {}
+        self._initial_stream_statistics = {}
+
+    def _build_feature_index(self):
+        """Walk the node map once, returning a dict of Feature tuples for all features
+        with values, keyed by name. Categories, commands and invisible features are
+        excluded."""
+        visibilities = {genicam.Beginner: 0, genicam.Expert: 1, genicam.Guru: 2}
+        excluded_interfaces = {genicam.intfICategory, genicam.intfICommand}
+        nodes = {}
+        for node in self.nodeMap.GetNodes():
+            node = node.GetNode()
+            if not node.IsFeature() or node.GetVisibility() not in visibilities:
+                continue
+            if node.GetPrincipalInterfaceType() in excluded_interfaces:
+                continue
+            nodes[node.GetName()] = node
+
+        def prerequisites(name, visited=()):
+            # All features name depends on, directly or indirectly, those to be set
+            # first listed first:
+            result = []
+            for dependency in self.feature_dependencies.get(name, []):
+                if dependency in nodes and dependency not in visited:
+                    for prerequisite in prerequisites(dependency, visited + (name,)):
+                        if prerequisite not in result:
+                            result.append(prerequisite)
+                    if dependency not in result:
+                        result.append(dependency)
+            return tuple(result)
+
+        return {
+            name: Feature(
+                node,
+                visibilities[node.GetVisibility()],
+                node.GetPrincipalInterfaceType(),
+                prerequisites(name),
+            )
+            for name, node in nodes.items()
+        }
+
+    def _get_node(self, name):
+        feature = self.feature_index.get(name)
+        if feature is not None:
+            return feature.node
+        return self.nodeMap.GetNode(name)
+
+    def get_attribute_dependants(self, name):
+        """Return the names of features that must be set after the given feature, and
+        whose values may therefore change when it is set"""
+        return [
+            dependant
+            for dependant, feature in self.feature_index.items()
+            if name in feature.prerequisites
+        ]
 
     def set_attributes(self, attributes_dict):
-        """Sets all attribues in attr_dict.
-        Pylon cameras require that ROI settings be done in correct order,
-        so we do them separately."""
-        # make a copy of dict so we can pop off already handled values
-        attr_dict = attributes_dict.copy()
-        ROIx = ['Width','OffsetX']
-        ROIy = ['Height','OffsetY']
-        if set(ROIx).issubset(attr_dict):
-            if attr_dict['OffsetX'] <= (self.camera.WidthMax()-self.camera.Width()):
-                ROIx.reverse()
-            ROIx_settings = [attr_dict.pop(k) for k in ROIx]
-            for k,v in zip(ROIx,ROIx_settings):
-                self.set_attribute(k, v)
-        
-        if set(ROIy).issubset(attr_dict):
-            if attr_dict['OffsetY'] <= (self.camera.HeightMax()-self.camera.Height()):
-                ROIy.reverse()
-            ROIy_settings = [attr_dict.pop(k) for k in ROIy]
-            for k,v in zip(ROIy,ROIy_settings):
-                self.set_attribute(k, v)
-        
-        for k, v in attr_dict.items():
-            self.set_attribute(k, v)
+        """Sets all attribues in attr_dict, in the order given, except that features
+        that others depend on (according to the feature index) are set first. Pylon
+        cameras additionally require that the ROI size and offset in each direction be
+        set in an order that keeps the ROI within the sensor at all times."""
+        extra_prerequisites = {}
+        for size, offset, size_max in self.roi_features:
+            if size in attributes_dict and offset in attributes_dict:
+                current_size = self._get_node(size).GetValue()
+                if attributes_dict[offset] <= (
+                    self._get_node(size_max).GetValue() - current_size
+                ):
+                    # The new offset fits with the current size, set it first:
+                    extra_prerequisites[size] = (offset,)
+                else:
+                    extra_prerequisites[offset] = (size,)
+        ordered_names = {}
+        for name in attributes_dict:
+            prerequisites = extra_prerequisites.get(name, ())
+            if name in self.feature_index:
+                prerequisites = self.feature_index[name].prerequisites + prerequisites
+            for prerequisite in prerequisites:
+                if prerequisite in attributes_dict:
+                    ordered_names.setdefault(prerequisite)
+            ordered_names.setdefault(name)
+        for name in ordered_names:
+            self.set_attribute(name, attributes_dict[name])
 
     def set_attribute(self, name, value):
         """Set the value of the attribute of the given name to the given value"""
         try:
-            self.nodeMap.GetNode(name).SetValue(value)
+            self._get_node(name).SetValue(value)
         except Exception as e:
             # Add some info to the exception:
             msg = f"failed to set attribute {name} to {value}"
             raise Exception(msg) from e
-        
+
+    def get_attribute_names(self, visibility_level, writeable_only=True):
+        """Return a list of all attribute names of readable attributes, for the given
+        visibility level. Optionally return only writeable attributes"""
+        max_visibility = self.visibility_levels[visibility_level.lower()]
+        if writeable_only:
+            modes = (genicam.RW,)
+        else:
+            modes = (genicam.RW, genicam.RO)
+        # Access modes may change with the values of other features, so they are
+        # checked each time rather than stored in the index:
+        return [
+            name
+            for name, feature in self.feature_index.items()
+            if feature.visibility <= max_visibility
+            and feature.node.GetAccessMode() in modes
+        ]
+
     def get_attributes(self, visibility_level, writeable_only=True):
         """Return a dict of all attributes of readable attributes, for the given
         visibility level. Optionally return only writeable attributes.
         """
-        visibilities = {
-            'simple': ['Beginner'],
-            'intermediate': ['Beginner','Expert'],
-            'advanced': ['Beginner','Expert','Guru'],
-        }
-        if writeable_only:
-            modes = ['RW']
-        else:
-            modes = ['RW','RO']
-        visibility_level = visibilities[visibility_level.lower()]
-        attributes = []
-        filters = [lambda n: n.GetNode().IsFeature(),
-                   lambda n:genicam.EVisibilityClass.ToString(n.GetNode().GetVisibility()) in visibility_level,
-                   lambda n:genicam.EAccessModeClass.ToString(n.GetNode().GetAccessMode()) in modes]
-        params = filter(lambda n: all([f(n) for f in filters]), self.nodeMap.GetNodes())
-        attributes = {}
-        for n in params:
-            try:
-                attributes[n.GetNode().GetName()] = n.GetValue()
-            except AttributeError:
-                attributes[n.GetNode().GetName()] = n.ToString()
-        return attributes
+        names = self.get_attribute_names(visibility_level, writeable_only)
+        return {name: self.get_attribute(name) for name in names}
 
     def get_attribute(self, name):
         """Return current value of attribute of the given name"""
         try:
-            return self.nodeMap.GetNode(name).GetValue()
+            node = self._get_node(name)
+            try:
+                return node.GetValue()
+            except AttributeError:
+                # Node types without a value, such as commands:
+                return node.ToString()
         except Exception as e:
             # Add some info to the exception:
             raise Exception(f"Failed to get attribute {name}") from e
@@ -128,13 +268,28 @@ class Pylon_Camera(object):
 
     def configure_acquisition(self, continuous=True, bufferCount=10):
         """Configure acquisition by calling StartGrabbing with appropriate
-        grab strategy: LatestImageOnly for continuous, OneByOne otherwise.
+        grab strategy: LatestImageOnly for continuous, OneByOne otherwise. Continuous
+        acquisition is polled with grab(), whereas for buffered acquisition pylon's
+        own grab loop thread delivers frames to the image event handler.
         """
         self.camera.MaxNumBuffer = bufferCount
         if continuous:
+            self._buffered = False
             self.camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
         else:
-            self.camera.StartGrabbing(pylon.GrabStrategy_OneByOne)
+            with self._sink_lock:
+                self._buffered = True
+                self._sink = None
+                self._pending_images = []
+                self._n_images = None
+                self._n_received = 0
+                self._grab_complete.clear()
+                self._statistics = {'images_skipped': 0, 'failed_grabs': 0}
+                self._initial_stream_statistics = self._get_stream_statistics()
+                self.telemetry.reset()
+            self.camera.StartGrabbing(
+                pylon.GrabStrategy_OneByOne, pylon.GrabLoop_ProvidedByInstantCamera
+            )
 
     def grab(self, continuous=True):
         """Grab single image during pre-configured acquisition."""
@@ -148,44 +303,114 @@ class Pylon_Camera(object):
         else:
             raise('Grab Error:',result.ErrorCode,result.ErrorDescription)
 
+    def _on_image_grabbed(self, result):
+        """Called by the image event handler for each grab result. Grab results
+        retrieved with grab() during continuous acquisition are ignored here"""
+        handler_start_time = perf_counter()
+        with self._sink_lock:
+            if not self._buffered:
+                return
+            if not result.GrabSucceeded():
+                self._statistics['failed_grabs'] += 1
+                print(f"Grab error {result.ErrorCode}: {result.ErrorDescription}")
+                return
+            if self._n_images is not None and self._n_received >= self._n_images:
+                # More frames than expected, or grab_multiple() was aborted:
+                return
+            self._n_received += 1
+            image = result.Array
+            self.telemetry.record(handler_start_time, result.BlockID, result.TimeStamp)
+            if self._sink is None:
+                # grab_multiple() not yet called:
+                self._pending_images.append(image)
+            else:
+                self._sink.append(image)
+            if self._n_received == self._n_images:
+                self._grab_complete.set()
+
+    def _on_images_skipped(self, n_skipped):
+        """Called by the image event handler when frames were skipped"""
+        with self._sink_lock:
+            if self._buffered:
+                self._statistics['images_skipped'] += n_skipped
+
+    def _get_stream_statistics(self):
+        """Return the current values of those stream grabber statistics provided by
+        the transport layer"""
+        node_map = self.camera.GetStreamGrabberNodeMap()
+        values = {}
+        for key, name in self.stream_statistics.items():
+            try:
+                values[key] = node_map.GetNode(name).GetValue()
+            except Exception:
+                # Not provided by this camera's transport layer:
+                continue
+        return values
+
+    def get_acquisition_statistics(self):
+        """Return a dict of statistics about the most recent buffered acquisition:
+        the number of frames skipped, failed grabs, and, where provided by the
+        transport layer, buffer underruns, missed frames and failed buffers"""
+        with self._sink_lock:
+            statistics = dict(self._statistics)
+        for key, value in self._get_stream_statistics().items():
+            initial_value = self._initial_stream_statistics.get(key)
+            if initial_value is not None:
+                statistics[key] = value - initial_value
+        return statistics
+
     def grab_multiple(self, n_images, images):
-        """Grab n_images into images array during buffered acquistion."""
+        """Grab n_images into images array during buffered acquistion. Frames are
+        appended to images by the image event handler as they arrive, this method
+        merely waits until all have arrived or acquisition is aborted."""
         print(f"Attempting to grab {n_images} images.")
-        for i in range(n_images):
-            while True:
-                if self._abort_acquisition:
-                    print("Abort during acquisition.")
-                    self._abort_acquisition = False
-                    return
-                try:
-                    images.append(self.grab(continuous=False))
-                    print(f"Got image {i+1} of {n_images}.")
-                    break
-                except pylon.TimeoutException as e:
-                    print('.', end='')
-                    continue
-        print(f"Got {len(images)} of {n_images} images.")
+        with self._sink_lock:
+            self._n_images = n_images
+            self.telemetry.n_images = n_images
+            # Frames that arrived before we were called:
+            for image in self._pending_images[:n_images]:
+                images.append(image)
+            self._n_received = min(self._n_received, n_images)
+            self._pending_images = []
+            self._sink = images
+            # Return straight away if all frames have already arrived, or if we were
+            # aborted before being called:
+            if self._n_received >= n_images or self._abort_acquisition:
+                self._grab_complete.set()
+        self._grab_complete.wait()
+        with self._sink_lock:
+            # Discard any further frames:
+            self._sink = None
+            self._n_images = 0
+        if self._abort_acquisition:
+            print("Abort during acquisition.")
+            self._abort_acquisition = False
+        print(f"Got {self._n_received} of {n_images} images.")
+        statistics = self.get_acquisition_statistics()
+        if any(statistics.values()):
+            print(f"Acquisition statistics: {statistics}")
 
     def stop_acquisition(self):
         self.camera.StopGrabbing()
+        with self._sink_lock:
+            self._buffered = False
 
     def abort_acquisition(self):
         self._abort_acquisition = True
+        self._grab_complete.set()
 
     def close(self):
+        self.camera.DeregisterImageEventHandler(self.image_event_handler)
         self.camera.Close()
 
 
 class PylonCameraWorker(IMAQdxCameraWorker):
     """Pylon API Camera Worker. 
     
-    Inherits from IMAQdxCameraWorker. Overloads get_attributes_as_dict 
-    to use PylonCamera.get_attributes() method."""
+    Inherits from IMAQdxCameraWorker, including its cached attribute snapshot, which
+    reads attributes via Pylon_Camera.get_attribute_names() and get_attribute().
+    Acquisition statistics for each shot, from Pylon_Camera.get_acquisition_statistics(),
+    are saved as attributes of the shot's image group."""
     interface_class = Pylon_Camera
 
-    def get_attributes_as_dict(self, visibility_level):
-        """Return a dict of the attributes of the camera for the given visibility
-        level"""
-        return self.camera.get_attributes(visibility_level)
-
 
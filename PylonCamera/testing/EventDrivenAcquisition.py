@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  EventDrivenAcquisition.py
+"""Exercise Pylon_Camera's event-driven buffered acquisition using the fake pypylon
+package in this directory, without the Pylon SDK or a camera. Per-frame latency
+(from frame arrival to delivery to the frame sink) and CPU time are compared with
+those of polling RetrieveResult(), and the per-shot acquisition statistics are
+printed. Use --sink-delay and --buffers to provoke buffer underruns, and
+--failure-probability to simulate incompletely grabbed frames. Since a failed grab
+makes Pylon_Camera.grab() raise, polling is not run if frames may fail.
+
+Each shot is checked: the sink must receive the requested number of frames, in order
+of acquisition, each with the content of the frame the camera acquired, and with
+gaps in the sequence of frames only where the camera's statistics report missed or
+failed frames. Aborting acquisition is checked too, both whilst grab_multiple() is
+waiting for frames and before it is called, after which a further shot must
+succeed.
+
+Syntax: python EventDrivenAcquisition.py [-n N_FRAMES] [-r FRAME_RATE]
+            [--sink-delay SECONDS] [--buffers N] [--failure-probability P]"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_pypylon
+
+fake_pypylon.install()
+from pypylon import pylon
+
+from labscript_devices.PylonCamera.blacs_workers import Pylon_Camera
+
+
+class TimedGrabResult(object):
+    """Wrapper around a grab result that has the camera record the result when its
+    image is retrieved"""
+
+    def __init__(self, result, camera):
+        self.result = result
+        self.camera = camera
+
+    def __getattr__(self, name):
+        return getattr(self.result, name)
+
+    @property
+    def Array(self):
+        self.camera.record(self.result)
+        return self.result.Array
+
+
+class TimedPylonCamera(Pylon_Camera):
+    """Pylon_Camera recording the time between the arrival of each frame and the
+    retrieval of its image, and the frame number of each frame retrieved"""
+
+    def __init__(self, serial_number):
+        Pylon_Camera.__init__(self, serial_number)
+        self.latencies = []
+        self.frame_numbers = []
+        retrieve_result = self.camera.RetrieveResult
+        self.camera.RetrieveResult = lambda *args: TimedGrabResult(
+            retrieve_result(*args), self
+        )
+
+    def record(self, result):
+        self.latencies.append((time.perf_counter_ns() - result.TimeStamp) / 1e9)
+        self.frame_numbers.append(result.BlockID)
+
+    def _on_image_grabbed(self, result):
+        Pylon_Camera._on_image_grabbed(self, TimedGrabResult(result, self))
+
+
+class FrameSink(object):
+    """Stand-in for the worker's ImageWriter, taking the given time to accept each
+    frame, and recording the first row of each"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.n_received = 0
+        self.first_rows = []
+
+    def append(self, image):
+        if self.delay:
+            time.sleep(self.delay)
+        self.first_rows.append(image[0].copy())
+        self.n_received += 1
+
+    def __len__(self):
+        return self.n_received
+
+
+def poll_grab_multiple(camera, n_images, images):
+    """Buffered acquisition by polling RetrieveResult(), as done by Pylon_Camera
+    prior to event-driven acquisition"""
+    for _ in range(n_images):
+        while True:
+            try:
+                images.append(camera.grab(continuous=False))
+                break
+            except pylon.TimeoutException:
+                continue
+
+
+def check_frames(camera, sink, n_images, n_lost):
+    """Check that the sink received n_images frames, in order, with the content of
+    the frames the camera acquired, and with n_lost frames missing from the sequence
+    in all"""
+    assert sink.n_received == n_images, (sink.n_received, n_images)
+    frame_numbers = np.array(camera.frame_numbers)
+    assert len(frame_numbers) == n_images, (len(frame_numbers), n_images)
+    assert np.all(np.diff(frame_numbers) > 0), frame_numbers
+    n_gaps = frame_numbers[-1] - frame_numbers[0] + 1 - n_images
+    # Frames may also be lost before the first one retrieved, or after the last:
+    assert n_gaps <= n_lost, (n_gaps, n_lost)
+    frames = camera.camera._make_frames()
+    for frame_number, first_row in zip(frame_numbers, sink.first_rows):
+        expected = frames[frame_number % len(frames)][0]
+        assert np.array_equal(first_row, expected), frame_number
+
+
+def run_shot(camera, n_images, n_buffers, sink_delay, event_driven):
+    """Acquire n_images, check them, and return the latencies, CPU time and
+    statistics"""
+    camera.latencies = []
+    camera.frame_numbers = []
+    sink = FrameSink(sink_delay)
+    initial_statistics = camera._get_stream_statistics()
+    cpu_start_time = time.process_time()
+    if event_driven:
+        camera.configure_acquisition(continuous=False, bufferCount=n_buffers)
+        camera.grab_multiple(n_images, sink)
+        statistics = camera.get_acquisition_statistics()
+    else:
+        camera.camera.MaxNumBuffer = n_buffers
+        camera.camera.StartGrabbing(pylon.GrabStrategy_OneByOne)
+        poll_grab_multiple(camera, n_images, sink)
+        statistics = None
+    cpu_time = time.process_time() - cpu_start_time
+    camera.stop_acquisition()
+    final_statistics = camera._get_stream_statistics()
+    n_lost = sum(
+        final_statistics[key] - initial_statistics[key]
+        for key in ['missed_frames', 'failed_buffers']
+    )
+    check_frames(camera, sink, n_images, n_lost)
+    return np.array(camera.latencies), cpu_time, statistics
+
+
+def check_abort(camera, n_buffers):
+    """Check that aborting stops grab_multiple() waiting for frames, whether it is
+    aborted during the wait or before grab_multiple() is called"""
+    # Many more frames than will arrive before the abort:
+    n_images = 10000
+    for abort_before_grab in [False, True]:
+        sink = FrameSink(0)
+        camera.configure_acquisition(continuous=False, bufferCount=n_buffers)
+        if abort_before_grab:
+            camera.abort_acquisition()
+        else:
+            threading.Timer(0.05, camera.abort_acquisition).start()
+        thread = threading.Thread(target=camera.grab_multiple, args=(n_images, sink))
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive(), "grab_multiple() did not return after abort"
+        assert sink.n_received < n_images, sink.n_received
+        assert not camera._abort_acquisition
+        camera.stop_acquisition()
+        when = 'before grab_multiple()' if abort_before_grab else 'during acquisition'
+        print(f"Abort {when}: returned after {sink.n_received} frames")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-frames', type=int, default=500)
+    parser.add_argument('-r', '--frame-rate', type=float, default=500.0)
+    parser.add_argument('--sink-delay', type=float, default=0.0)
+    parser.add_argument('--buffers', type=int, default=10)
+    parser.add_argument('--failure-probability', type=float, default=0.0)
+    args = parser.parse_args()
+
+    pylon.InstantCamera.failure_probability = args.failure_probability
+    camera = TimedPylonCamera(pylon.FAKE_SERIAL_NUMBER)
+    # Free-run at the given frame rate instead of waiting for software triggers:
+    camera.set_attributes(
+        {'TriggerMode': 'Off', 'AcquisitionFrameRate': args.frame_rate}
+    )
+    modes = [('event-driven', True)]
+    if not args.failure_probability:
+        modes.insert(0, ('polling', False))
+    for description, event_driven in modes:
+        latencies, cpu_time, statistics = run_shot(
+            camera, args.n_frames, args.buffers, args.sink_delay, event_driven
+        )
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1e6
+        print(
+            f"{description:13s} latency p50 {p50:8.1f} us, p99 {p99:8.1f} us, "
+            + f"CPU time {cpu_time:.3f} s"
+        )
+        if statistics is not None:
+            print(f"{'':13s} statistics: {statistics}")
+    check_abort(camera, args.buffers)
+    # Acquisition must work as normal after an abort:
+    run_shot(camera, args.n_frames, args.buffers, args.sink_delay, True)
+    print("Shot after abort OK")
+    camera.close()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  FeatureIndex.py
+"""Compare the cost of listing and reading camera attributes using Pylon_Camera's
+feature index against walking the node map on every call, as done previously. Uses
+the fake pypylon package in this directory, so neither the Pylon SDK nor a camera is
+required. Cost is reported both as wall time and as the number of calls into the
+(fake) SDK. Also checks that interdependent features are set in a working order.
+
+Syntax: python FeatureIndex.py [-n N_FEATURES] [-r REPEATS]"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_pypylon
+
+fake_pypylon.install()
+from pypylon import pylon, genicam
+
+from labscript_devices.PylonCamera.blacs_workers import Pylon_Camera
+
+
+def get_attributes_by_walking_node_map(camera, visibility_level, writeable_only=True):
+    """Pylon_Camera.get_attributes() as it was prior to the feature index"""
+    visibilities = {
+        'simple': ['Beginner'],
+        'intermediate': ['Beginner', 'Expert'],
+        'advanced': ['Beginner', 'Expert', 'Guru'],
+    }
+    if writeable_only:
+        modes = ['RW']
+    else:
+        modes = ['RW', 'RO']
+    visibility_level = visibilities[visibility_level.lower()]
+    filters = [
+        lambda n: n.GetNode().IsFeature(),
+        lambda n: genicam.EVisibilityClass.ToString(n.GetNode().GetVisibility())
+        in visibility_level,
+        lambda n: genicam.EAccessModeClass.ToString(n.GetNode().GetAccessMode())
+        in modes,
+    ]
+    params = filter(lambda n: all([f(n) for f in filters]), camera.nodeMap.GetNodes())
+    names = [n.GetNode().GetName() for n in params]
+    return {name: camera.nodeMap.GetNode(name).GetValue() for name in names}
+
+
+def measure(function, repeats):
+    """Return the mean wall time and number of fake SDK calls per call of
+    function()"""
+    n_calls = genicam.n_calls
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    duration = time.perf_counter() - start_time
+    return duration / repeats, (genicam.n_calls - n_calls) / repeats
+
+
+def check_dependency_order(camera):
+    """Set interdependent features in orders that fail unless reordered"""
+    camera.set_attributes({'Width': 640, 'OffsetX': 0, 'BinningHorizontal': 1})
+    # Moving the ROI right whilst shrinking it requires shrinking first:
+    camera.set_attributes({'OffsetX': 400, 'Width': 200})
+    # Moving it left whilst growing it requires moving first:
+    camera.set_attributes({'Width': 600, 'OffsetX': 0})
+    # The ROI must be set after binning, which changes its allowed range:
+    camera.set_attributes({'Width': 300, 'BinningHorizontal': 2})
+    assert camera.get_attribute('Width') == 300
+    assert camera.get_attribute('WidthMax') == 320
+    print("Interdependent features were set successfully.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-features', type=int, default=300)
+    parser.add_argument('-r', '--repeats', type=int, default=100)
+    args = parser.parse_args()
+
+    pylon.InstantCamera.n_extra_features = args.n_features
+    n_calls = genicam.n_calls
+    start_time = time.perf_counter()
+    camera = Pylon_Camera(pylon.FAKE_SERIAL_NUMBER)
+    print(
+        f"Connecting and indexing {len(camera.feature_index)} features: "
+        + f"{(time.perf_counter() - start_time) * 1e3:.2f} ms, "
+        + f"{genicam.n_calls - n_calls} SDK calls"
+    )
+    for visibility_level in ['simple', 'intermediate', 'advanced']:
+        assert camera.get_attributes(
+            visibility_level
+        ) == get_attributes_by_walking_node_map(camera, visibility_level)
+        for description, function in [
+            (
+                'walking node map',
+                lambda: get_attributes_by_walking_node_map(camera, visibility_level),
+            ),
+            ('feature index', lambda: camera.get_attributes(visibility_level)),
+        ]:
+            duration, calls = measure(function, args.repeats)
+            print(
+                f"{visibility_level:12s} {description:16s} {duration * 1e3:8.3f} ms, "
+                + f"{calls:8.0f} SDK calls"
+            )
+    check_dependency_order(camera)
+    camera.close()
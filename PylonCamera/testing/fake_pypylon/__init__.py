@@ -0,0 +1,30 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/PylonCamera/testing/fake_pypylon/__init__.py   #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""A fake pypylon package simulating a free-running Basler camera, so that
+Pylon_Camera can be exercised without the Pylon SDK or a camera attached.
+
+Call install() before instantiating Pylon_Camera to make `from pypylon import pylon,
+genicam` import this package instead of the real one. Only the subset of the pypylon
+API used by Pylon_Camera is implemented."""
+
+import sys
+
+from . import genicam
+from . import pylon
+
+
+def install():
+    """Make subsequent imports of pypylon import this fake package instead"""
+    sys.modules['pypylon'] = sys.modules[__name__]
+    sys.modules['pypylon.pylon'] = pylon
+    sys.modules['pypylon.genicam'] = genicam
@@ -0,0 +1,221 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/PylonCamera/testing/fake_pypylon/genicam.py    #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Fake pypylon.genicam: exceptions, enumerations and a minimal node map.
+
+Every call to a node method, and to EVisibilityClass/EAccessModeClass.ToString(), is
+counted in `n_calls`, as a proxy for the cost of crossing into the SDK."""
+
+# Number of calls into the fake SDK:
+n_calls = 0
+
+
+class GenericException(Exception):
+    pass
+
+
+class LogicalErrorException(GenericException):
+    pass
+
+
+class AccessException(GenericException):
+    pass
+
+
+class OutOfRangeException(GenericException):
+    pass
+
+
+class TimeoutException(GenericException):
+    pass
+
+
+class RuntimeException(GenericException):
+    pass
+
+
+# Visibilities and access modes, with the string representations used by GenICam:
+Beginner, Expert, Guru, Invisible = range(4)
+NI, NA, WO, RO, RW = range(5)
+
+# Principal interface types of nodes:
+(
+    intfIValue,
+    intfIBase,
+    intfIInteger,
+    intfIBoolean,
+    intfICommand,
+    intfIFloat,
+    intfIString,
+    intfIRegister,
+    intfICategory,
+    intfIEnumeration,
+    intfIEnumEntry,
+    intfIPort,
+) = range(12)
+
+
+class EVisibilityClass(object):
+    names = {Beginner: 'Beginner', Expert: 'Expert', Guru: 'Guru', Invisible: 'Invisible'}
+
+    @classmethod
+    def ToString(cls, visibility):
+        _count_call()
+        return cls.names[visibility]
+
+
+class EAccessModeClass(object):
+    names = {NI: 'NI', NA: 'NA', WO: 'WO', RO: 'RO', RW: 'RW'}
+
+    @classmethod
+    def ToString(cls, access_mode):
+        _count_call()
+        return cls.names[access_mode]
+
+
+def _count_call():
+    global n_calls
+    n_calls += 1
+
+
+class Node(object):
+    """A camera feature with a value. Like pypylon's nodes, GetNode() returns the node
+    itself, and calling the node returns its value. If not given, the interface type
+    is inferred from the type of the value."""
+
+    def __init__(
+        self,
+        name,
+        value,
+        visibility=Beginner,
+        access_mode=RW,
+        feature=True,
+        validator=None,
+        on_change=None,
+        interface=None,
+    ):
+        self.name = name
+        self.value = value
+        self.visibility = visibility
+        self.access_mode = access_mode
+        self.feature = feature
+        # Called with a new value before it is set, may raise OutOfRangeException:
+        self.validator = validator
+        # Called with the node after its value is set:
+        self.on_change = on_change
+        if interface is None:
+            interfaces = {
+                bool: intfIBoolean,
+                int: intfIInteger,
+                float: intfIFloat,
+                str: intfIString,
+            }
+            interface = interfaces[type(value)]
+        self.interface = interface
+
+    def GetName(self):
+        _count_call()
+        return self.name
+
+    def GetNode(self):
+        return self
+
+    def IsFeature(self):
+        _count_call()
+        return self.feature
+
+    def GetVisibility(self):
+        _count_call()
+        return self.visibility
+
+    def GetAccessMode(self):
+        _count_call()
+        return self.access_mode
+
+    def GetPrincipalInterfaceType(self):
+        _count_call()
+        return self.interface
+
+    def GetValue(self):
+        _count_call()
+        if self.access_mode not in (RO, RW) or self.value is None:
+            raise AccessException(f"Node '{self.name}' is not readable")
+        return self.value
+
+    def SetValue(self, value):
+        _count_call()
+        if self.access_mode not in (WO, RW) or self.value is None:
+            raise AccessException(f"Node '{self.name}' is not writable")
+        if not isinstance(value, type(self.value)):
+            # Allow ints for floats, as GenICam does:
+            if not (isinstance(self.value, float) and isinstance(value, int)):
+                msg = f"Node '{self.name}' expects {type(self.value).__name__}"
+                raise LogicalErrorException(msg)
+            value = float(value)
+        if self.validator is not None:
+            self.validator(value)
+        self.value = value
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def Execute(self):
+        _count_call()
+        if self.interface != intfICommand:
+            raise LogicalErrorException(f"Node '{self.name}' is not a command")
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def ToString(self):
+        _count_call()
+        return str(self.value)
+
+    @property
+    def Value(self):
+        return self.GetValue()
+
+    @Value.setter
+    def Value(self, value):
+        self.SetValue(value)
+
+    def __call__(self):
+        return self.GetValue()
+
+
+def Category(name, visibility=Beginner):
+    """Return a category node, which groups features and has no value"""
+    return Node(name, None, visibility, RO, interface=intfICategory)
+
+
+def Command(name, on_execute=None, visibility=Beginner):
+    """Return a command node, which calls on_execute with the node when executed"""
+    return Node(name, None, visibility, WO, on_change=on_execute, interface=intfICommand)
+
+
+class NodeMap(object):
+    def __init__(self, nodes=()):
+        self.nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        self.nodes[node.GetName()] = node
+
+    def GetNode(self, name):
+        _count_call()
+        try:
+            return self.nodes[name]
+        except KeyError:
+            raise LogicalErrorException(f"Node not existing: '{name}'") from None
+
+    def GetNodes(self):
+        _count_call()
+        return list(self.nodes.values())
@@ -0,0 +1,556 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/PylonCamera/testing/fake_pypylon/pylon.py      #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Fake pypylon.pylon: a simulated InstantCamera.
+
+With TriggerMode 'Off', or with a hardware TriggerSource, the simulated camera
+produces frames at AcquisitionFrameRate whilst grabbing, as if triggered externally.
+With TriggerMode 'On' and TriggerSource 'Software', it produces a frame for each call
+to ExecuteSoftwareTrigger(). Frames are queued in up to MaxNumBuffer buffers, and
+frames arriving when all buffers are full are lost and counted as buffer underruns in
+the stream grabber statistics, as with a real camera whose host cannot keep up."""
+
+import time
+import random
+import threading
+from collections import deque
+
+import numpy as np
+
+from .genicam import (
+    Node,
+    NodeMap,
+    Category,
+    Command,
+    OutOfRangeException,
+    intfIEnumeration,
+    RuntimeException,
+    TimeoutException,
+    Beginner,
+    Expert,
+    Guru,
+    Invisible,
+    RO,
+    RW,
+)
+
+GrabStrategy_OneByOne = 0
+GrabStrategy_LatestImageOnly = 1
+GrabStrategy_LatestImages = 2
+GrabStrategy_UpcomingImage = 3
+
+GrabLoop_ProvidedByInstantCamera = 0
+GrabLoop_ProvidedByUser = 1
+
+TimeoutHandling_Return = 0
+TimeoutHandling_ThrowException = 1
+
+RegistrationMode_Append = 0
+RegistrationMode_ReplaceAll = 1
+
+Cleanup_None = 0
+Cleanup_Delete = 1
+
+FAKE_SERIAL_NUMBER = '12345678'
+FAKE_MODEL_NAME = 'acA640-750um (fake)'
+SENSOR_WIDTH = 640
+SENSOR_HEIGHT = 480
+
+
+class CDeviceInfo(object):
+    def __init__(self):
+        self.serial_number = FAKE_SERIAL_NUMBER
+
+    def SetSerialNumber(self, serial_number):
+        self.serial_number = serial_number
+
+    def GetSerialNumber(self):
+        return self.serial_number
+
+    def GetModelName(self):
+        return FAKE_MODEL_NAME
+
+    def GetFriendlyName(self):
+        return f"{FAKE_MODEL_NAME} ({self.serial_number})"
+
+
+class TlFactory(object):
+    _instance = None
+
+    @classmethod
+    def GetInstance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def EnumerateDevices(self):
+        return [CDeviceInfo()]
+
+    def CreateDevice(self, device_info):
+        return device_info
+
+
+class ConfigurationEventHandler(object):
+    def OnOpened(self, camera):
+        pass
+
+
+class SoftwareTriggerConfiguration(ConfigurationEventHandler):
+    def OnOpened(self, camera):
+        node_map = camera.GetNodeMap()
+        node_map.GetNode('TriggerSelector').SetValue('FrameStart')
+        node_map.GetNode('TriggerMode').SetValue('On')
+        node_map.GetNode('TriggerSource').SetValue('Software')
+
+
+class ImageEventHandler(object):
+    def OnImageEventHandlerRegistered(self, camera):
+        pass
+
+    def OnImageEventHandlerDeregistered(self, camera):
+        pass
+
+    def OnImagesSkipped(self, camera, countOfSkippedImages):
+        pass
+
+    def OnImageGrabbed(self, camera, grabResult):
+        pass
+
+
+class GrabResult(object):
+    def __init__(
+        self,
+        array=None,
+        image_number=0,
+        succeeded=True,
+        error_code=0,
+        error_description='',
+    ):
+        self.array = array
+        self.ImageNumber = image_number
+        self.BlockID = image_number
+        self.TimeStamp = time.perf_counter_ns()
+        self.succeeded = succeeded
+        self.ErrorCode = error_code
+        self.ErrorDescription = error_description
+        self.released = False
+
+    def IsValid(self):
+        return self.array is not None
+
+    def GrabSucceeded(self):
+        return self.IsValid() and self.succeeded
+
+    @property
+    def Array(self):
+        return self.array.copy()
+
+    def GetArray(self):
+        return self.Array
+
+    @property
+    def Width(self):
+        return self.array.shape[1]
+
+    @property
+    def Height(self):
+        return self.array.shape[0]
+
+    def Release(self):
+        self.released = True
+
+
+def _make_node_map(camera, n_extra_features=0):
+    """Return the node map of a simulated camera, with n_extra_features additional
+    features named FakeFeature<n> of various visibilities and access modes, to
+    approximate the size of the node map of a real camera"""
+    nodes = {}
+
+    def check_range(name, minimum, maximum):
+        def validator(value):
+            if not minimum <= value <= maximum():
+                msg = f"Value {value} for '{name}' must be in [{minimum}, {maximum()}]"
+                raise OutOfRangeException(msg)
+
+        return validator
+
+    def check_enum(name, allowed):
+        def validator(value):
+            if value not in allowed:
+                msg = f"Value '{value}' for '{name}' must be one of {allowed}"
+                raise OutOfRangeException(msg)
+
+        return validator
+
+    def binning_changed(size, offset, size_max, sensor_size):
+        # Binning scales the ROI and its maximum size, as on a real camera:
+        def on_change(node):
+            old_size_max = nodes[size_max].value
+            nodes[size_max].value = sensor_size // node.value
+            scale = nodes[size_max].value / old_size_max
+            nodes[size].value = max(1, int(nodes[size].value * scale))
+            nodes[offset].value = int(nodes[offset].value * scale)
+
+        return on_change
+
+    node_list = [
+        Category('Root'),
+        Category('DeviceControl'),
+        Node('DeviceModelName', FAKE_MODEL_NAME, access_mode=RO),
+        Node('DeviceSerialNumber', FAKE_SERIAL_NUMBER, access_mode=RO),
+        Category('ImageFormatControl'),
+        Node('SensorWidth', SENSOR_WIDTH, Expert, RO),
+        Node('SensorHeight', SENSOR_HEIGHT, Expert, RO),
+        Node('WidthMax', SENSOR_WIDTH, Expert, RO),
+        Node('HeightMax', SENSOR_HEIGHT, Expert, RO),
+        # The ROI must remain within the sensor:
+        Node(
+            'Width',
+            SENSOR_WIDTH,
+            validator=check_range(
+                'Width', 1, lambda: nodes['WidthMax'].value - nodes['OffsetX'].value
+            ),
+        ),
+        Node(
+            'Height',
+            SENSOR_HEIGHT,
+            validator=check_range(
+                'Height', 1, lambda: nodes['HeightMax'].value - nodes['OffsetY'].value
+            ),
+        ),
+        Node(
+            'OffsetX',
+            0,
+            validator=check_range(
+                'OffsetX', 0, lambda: nodes['WidthMax'].value - nodes['Width'].value
+            ),
+        ),
+        Node(
+            'OffsetY',
+            0,
+            validator=check_range(
+                'OffsetY', 0, lambda: nodes['HeightMax'].value - nodes['Height'].value
+            ),
+        ),
+        Node(
+            'BinningHorizontal',
+            1,
+            Expert,
+            validator=check_range('BinningHorizontal', 1, lambda: 4),
+            on_change=binning_changed('Width', 'OffsetX', 'WidthMax', SENSOR_WIDTH),
+        ),
+        Node(
+            'BinningVertical',
+            1,
+            Expert,
+            validator=check_range('BinningVertical', 1, lambda: 4),
+            on_change=binning_changed('Height', 'OffsetY', 'HeightMax', SENSOR_HEIGHT),
+        ),
+        Node(
+            'PixelFormat',
+            'Mono8',
+            validator=check_enum('PixelFormat', ['Mono8', 'Mono12', 'Mono16']),
+            interface=intfIEnumeration,
+        ),
+        Node('PayloadSize', SENSOR_WIDTH * SENSOR_HEIGHT, Guru, RO),
+        Category('AcquisitionControl'),
+        Node(
+            'ExposureTime',
+            1000.0,
+            validator=check_range('ExposureTime', 10.0, lambda: 1e7),
+        ),
+        Node('Gain', 0.0, validator=check_range('Gain', 0.0, lambda: 24.0)),
+        Node('AcquisitionMode', 'Continuous', Expert, interface=intfIEnumeration),
+        Node('AcquisitionFrameRateEnable', False, Expert),
+        Node(
+            'AcquisitionFrameRate',
+            100.0,
+            validator=check_range('AcquisitionFrameRate', 0.1, lambda: 10000.0),
+        ),
+        Node('TriggerSelector', 'FrameStart', Expert, interface=intfIEnumeration),
+        Node(
+            'TriggerMode',
+            'Off',
+            validator=check_enum('TriggerMode', ['On', 'Off']),
+            interface=intfIEnumeration,
+        ),
+        Node(
+            'TriggerSource',
+            'Line1',
+            validator=check_enum('TriggerSource', ['Line1', 'Line3', 'Software']),
+            interface=intfIEnumeration,
+        ),
+        Node('TriggerActivation', 'RisingEdge', Expert, interface=intfIEnumeration),
+        Node('TriggerDelay', 0.0, Guru),
+        Command('TriggerSoftware', lambda node: camera.ExecuteSoftwareTrigger()),
+        # Internal nodes, which are not features:
+        Node('SensorReadoutTimeRaw', 1000, Invisible, RO, feature=False),
+    ]
+    visibilities = [Beginner, Expert, Guru, Invisible]
+    for i in range(n_extra_features):
+        node_list.append(
+            Node(
+                f'FakeFeature{i}',
+                i,
+                visibilities[i % len(visibilities)],
+                RO if i % 3 == 0 else RW,
+            )
+        )
+    for node in node_list:
+        nodes[node.name] = node
+    return NodeMap(node_list)
+
+
+def _make_stream_grabber_node_map():
+    """Return the stream grabber node map of a simulated camera, holding statistics"""
+    return NodeMap(
+        Node(name, 0, Expert, RO, feature=False)
+        for name in [
+            'Statistic_Total_Buffer_Count',
+            'Statistic_Failed_Buffer_Count',
+            'Statistic_Buffer_Underrun_Count',
+            'Statistic_Missed_Frame_Count',
+        ]
+    )
+
+
+class InstantCamera(object):
+    # Probability that a simulated frame is incompletely grabbed:
+    failure_probability = 0.0
+    # Number of additional features in the node map of newly created cameras:
+    n_extra_features = 0
+
+    def __init__(self, device=None):
+        self.device_info = device if device is not None else CDeviceInfo()
+        self.node_map = _make_node_map(self, self.n_extra_features)
+        self.stream_grabber_node_map = _make_stream_grabber_node_map()
+        self.MaxNumBuffer = 10
+        self.is_open = False
+        self.configurations = []
+        self.image_event_handlers = []
+        self.condition = threading.Condition()
+        # Grab results of acquired frames not yet retrieved:
+        self.output_queue = deque()
+        self.n_skipped = 0
+        self.n_software_triggers = 0
+        self.grabbing = False
+        self.strategy = None
+        self.acquisition_thread = None
+        self.grab_loop_thread = None
+
+    def __getattr__(self, name):
+        # Camera features are available as attributes, as in pypylon:
+        node_map = self.__dict__.get('node_map')
+        if node_map is not None and name in node_map.nodes:
+            return node_map.nodes[name]
+        raise AttributeError(name)
+
+    def GetDeviceInfo(self):
+        return self.device_info
+
+    def Open(self):
+        self.is_open = True
+        for configuration in self.configurations:
+            configuration.OnOpened(self)
+
+    def IsOpen(self):
+        return self.is_open
+
+    def Close(self):
+        self.StopGrabbing()
+        self.is_open = False
+
+    def RegisterConfiguration(self, configuration, registration_mode, cleanup):
+        if registration_mode == RegistrationMode_ReplaceAll:
+            self.configurations = []
+        self.configurations.append(configuration)
+        if self.is_open:
+            configuration.OnOpened(self)
+
+    def RegisterImageEventHandler(self, handler, registration_mode, cleanup):
+        if registration_mode == RegistrationMode_ReplaceAll:
+            self.image_event_handlers = []
+        self.image_event_handlers.append(handler)
+        handler.OnImageEventHandlerRegistered(self)
+
+    def DeregisterImageEventHandler(self, handler):
+        self.image_event_handlers.remove(handler)
+        handler.OnImageEventHandlerDeregistered(self)
+
+    def GetNodeMap(self):
+        return self.node_map
+
+    def GetStreamGrabberNodeMap(self):
+        return self.stream_grabber_node_map
+
+    def _increment_statistic(self, name):
+        self.stream_grabber_node_map.nodes[name].value += 1
+
+    def _software_triggered(self):
+        return self.TriggerMode.value == 'On' and self.TriggerSource.value == 'Software'
+
+    def _make_frames(self):
+        """Return a few frames of noise with the configured size and pixel format"""
+        shape = (self.Height.value, self.Width.value)
+        if self.PixelFormat.value == 'Mono8':
+            dtype, max_value = np.uint8, 255
+        elif self.PixelFormat.value == 'Mono12':
+            dtype, max_value = np.uint16, 4095
+        else:
+            dtype, max_value = np.uint16, 65535
+        rng = np.random.default_rng(0)
+        return [
+            rng.integers(0, max_value, shape, dtype=dtype, endpoint=True)
+            for _ in range(4)
+        ]
+
+    def StartGrabbing(
+        self, strategy=GrabStrategy_OneByOne, grab_loop=GrabLoop_ProvidedByUser
+    ):
+        if not self.is_open:
+            raise RuntimeException("Camera is not open")
+        if self.grabbing:
+            raise RuntimeException("Grabbing is already started")
+        self.strategy = strategy
+        self.output_queue.clear()
+        self.n_skipped = 0
+        self.n_software_triggers = 0
+        self.grabbing = True
+        self.acquisition_thread = threading.Thread(
+            target=self._acquisition_loop, args=(self._make_frames(),), daemon=True
+        )
+        self.acquisition_thread.start()
+        if grab_loop == GrabLoop_ProvidedByInstantCamera:
+            self.grab_loop_thread = threading.Thread(target=self._grab_loop, daemon=True)
+            self.grab_loop_thread.start()
+
+    def IsGrabbing(self):
+        return self.grabbing
+
+    def StopGrabbing(self):
+        with self.condition:
+            if not self.grabbing:
+                return
+            self.grabbing = False
+            self.condition.notify_all()
+        self.acquisition_thread.join()
+        self.acquisition_thread = None
+        if self.grab_loop_thread is not None:
+            if self.grab_loop_thread is not threading.current_thread():
+                self.grab_loop_thread.join()
+            self.grab_loop_thread = None
+        self.output_queue.clear()
+
+    def ExecuteSoftwareTrigger(self):
+        with self.condition:
+            self.n_software_triggers += 1
+            self.condition.notify_all()
+
+    def WaitForFrameTriggerReady(self, timeout, timeout_handling):
+        return True
+
+    def _acquisition_loop(self, frames):
+        frame_number = 0
+        next_frame_time = time.perf_counter()
+        while True:
+            if self._software_triggered():
+                with self.condition:
+                    while self.grabbing and not self.n_software_triggers:
+                        self.condition.wait()
+                    if not self.grabbing:
+                        return
+                    self.n_software_triggers -= 1
+            else:
+                next_frame_time += 1 / self.AcquisitionFrameRate.value
+                delay = next_frame_time - time.perf_counter()
+                if delay > 0:
+                    with self.condition:
+                        self.condition.wait_for(lambda: not self.grabbing, delay)
+                else:
+                    # Fell behind, don't try to catch up:
+                    next_frame_time = time.perf_counter()
+                if not self.grabbing:
+                    return
+            frame_number += 1
+            self._frame_arrived(frames[frame_number % len(frames)], frame_number)
+
+    def _frame_arrived(self, frame, frame_number):
+        with self.condition:
+            self._increment_statistic('Statistic_Total_Buffer_Count')
+            if self.strategy == GrabStrategy_LatestImageOnly:
+                # Older unretrieved frames are skipped in favour of the new one:
+                self.n_skipped += len(self.output_queue)
+                self.output_queue.clear()
+            elif len(self.output_queue) >= self.MaxNumBuffer:
+                # No free buffer for the frame:
+                self._increment_statistic('Statistic_Buffer_Underrun_Count')
+                self._increment_statistic('Statistic_Missed_Frame_Count')
+                return
+            if random.random() < self.failure_probability:
+                result = GrabResult(
+                    frame,
+                    frame_number,
+                    succeeded=False,
+                    error_code=0xE1000014,
+                    error_description="The buffer was incompletely grabbed.",
+                )
+                self._increment_statistic('Statistic_Failed_Buffer_Count')
+            else:
+                result = GrabResult(frame, frame_number)
+            self.output_queue.append(result)
+            self.condition.notify_all()
+
+    def _pop_result(self):
+        """Pop the next grab result, returning it and the number of frames skipped
+        before it. Must be called with self.condition held"""
+        result = self.output_queue.popleft()
+        n_skipped, self.n_skipped = self.n_skipped, 0
+        return result, n_skipped
+
+    def _call_handlers(self, result, n_skipped):
+        for handler in self.image_event_handlers:
+            if n_skipped:
+                handler.OnImagesSkipped(self, n_skipped)
+            handler.OnImageGrabbed(self, result)
+
+    def _grab_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.output_queue or not self.grabbing)
+                if not self.grabbing:
+                    return
+                result, n_skipped = self._pop_result()
+            self._call_handlers(result, n_skipped)
+            result.Release()
+
+    def RetrieveResult(self, timeout, timeout_handling=TimeoutHandling_ThrowException):
+        if self.grab_loop_thread is not None:
+            raise RuntimeException("The grab loop is provided by the InstantCamera")
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: self.output_queue or not self.grabbing, timeout / 1000
+            ) or not self.output_queue:
+                if timeout_handling == TimeoutHandling_ThrowException:
+                    raise TimeoutException(f"Grab timed out after {timeout} ms")
+                return GrabResult()
+            result, n_skipped = self._pop_result()
+        self._call_handlers(result, n_skipped)
+        return result
+
+    def GrabOne(self, timeout, timeout_handling=TimeoutHandling_ThrowException):
+        self.StartGrabbing(GrabStrategy_OneByOne)
+        try:
+            if self._software_triggered():
+                self.ExecuteSoftwareTrigger()
+            return self.RetrieveResult(timeout, timeout_handling)
+        finally:
+            self.StopGrabbing()
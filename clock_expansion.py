@@ -0,0 +1,88 @@
+#####################################################################
+#                                                                   #
+# /clock_expansion.py                                               #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of the module labscript_devices, in the         #
+# labscript suite (see http://labscriptsuite.org), and is           #
+# licensed under the Simplified BSD License. See the license.txt    #
+# file in the root of the project for the full license.             #
+#                                                                   #
+#####################################################################
+"""Helpers for runviewer parsers of pseudoclocks whose instructions are repeated clock
+periods, such as (period, reps) or (on_period, off_period, reps), to reconstruct the
+clock output without looping in Python over every clock tick.
+
+clock_runs() works out the start time of each instruction, taking into account waits
+and stop instructions, and returns the clock as a run-length representation: one run of
+identical clock periods per instruction. expand_clock_runs() expands runs into the
+times and states of every edge, as passed to runviewer's add_trace(), and
+expand_clock() does both."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import numpy as np
+
+
+def clock_runs(on_periods, off_periods, reps, waits, stops=None, t0=0, wait_delay=0,
+               resume_times=None):
+    """Return the runs of clock ticks of a pseudoclock's instructions, as a tuple of
+    arrays (start_times, on_periods, off_periods, reps), with one element per
+    instruction that produces ticks. Each tick is high for the on period, then low for
+    the off period.
+
+    on_periods, off_periods and reps are arrays with an element per instruction, with
+    periods in seconds. waits and stops are boolean arrays, True for instructions that
+    are waits, and for instructions that end the program. The clock starts at t0. If
+    resume_times is given, it is the time at which each wait in turn resumes, such as
+    the time of the trigger that resumes it, plus the trigger delay. Otherwise, waits
+    resume wait_delay after they begin."""
+    on_periods = np.asarray(on_periods, dtype=float)
+    off_periods = np.asarray(off_periods, dtype=float)
+    reps = np.asarray(reps, dtype=np.int64)
+    waits = np.asarray(waits, dtype=bool)
+    if stops is not None:
+        # Ignore everything from the first stop instruction onward:
+        stop_indices = np.flatnonzero(stops)
+        if len(stop_indices):
+            n = stop_indices[0]
+            on_periods, off_periods, reps, waits = (on_periods[:n], off_periods[:n],
+                                                    reps[:n], waits[:n])
+    ticks = ~waits & (reps > 0)
+    durations = np.where(ticks, reps*(on_periods + off_periods), 0)
+    if resume_times is None:
+        durations[waits] = wait_delay
+        start_times = t0 + np.cumsum(durations) - durations
+    else:
+        # Each wait starts a new segment of the program, starting at its resume time.
+        # Time within each segment is accumulated from the start of the segment:
+        segment = np.cumsum(waits)
+        n_waits = segment[-1] if len(segment) else 0
+        segment_start_times = np.concatenate([[t0], np.asarray(resume_times)[:n_waits]])
+        elapsed = np.cumsum(durations) - durations
+        segment_elapsed = np.concatenate([[0], elapsed[waits]])
+        start_times = segment_start_times[segment] + (elapsed - segment_elapsed[segment])
+    return start_times[ticks], on_periods[ticks], off_periods[ticks], reps[ticks]
+
+
+def expand_clock_runs(start_times, on_periods, off_periods, reps):
+    """Return the times and states (1 for high, 0 for low) of every edge of the given
+    runs of clock ticks, as returned by clock_runs()"""
+    reps = np.asarray(reps, dtype=np.int64)
+    # The run of, and index within the run of, every tick:
+    run = np.repeat(np.arange(len(reps)), reps)
+    index = np.arange(len(run)) - np.repeat(np.cumsum(reps) - reps, reps)
+    times = np.empty((len(run), 2))
+    times[:, 0] = np.asarray(start_times)[run] + index*(np.asarray(on_periods) + np.asarray(off_periods))[run]
+    times[:, 1] = times[:, 0] + np.asarray(on_periods)[run]
+    states = np.empty((len(run), 2), dtype=int)
+    states[:, 0] = 1
+    states[:, 1] = 0
+    return times.ravel(), states.ravel()
+
+
+def expand_clock(*args, **kwargs):
+    """Return the times and states of every edge of a pseudoclock's instructions. Takes
+    the same arguments as clock_runs()"""
+    return expand_clock_runs(*clock_runs(*args, **kwargs))
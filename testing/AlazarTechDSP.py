@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  AlazarTechDSP.py
+"""Measure the throughput of the AlazarTechBoard worker's DSP stages with different
+numbers of threads, using simulated samples from fake_atsapi.py, so that neither the
+ATS-SDK nor a board is required. Buffers are dispatched to the stages as fast as
+possible, as if acquired at an unlimited rate, so the throughput printed is the highest
+sample rate (per channel) that the stages can keep up with. This should be compared
+with the sample rate of the acquisition.
+
+The products are checked against the simulated waveforms: channel A is a sine wave and
+channel B a cosine, of period fake_atsapi.Board.period samples.
+
+Syntax: python AlazarTechDSP.py [-n N_SAMPLES] [-r RATE] [--samples-per-buffer N]
+            [--threads N [N ...]] [--stages {ddc,boxcar,fft} [...]]"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_atsapi
+
+ats = fake_atsapi.install()
+from labscript_devices.AlazarTechBoard import GuilessWorker, dsp_stage_types
+
+DEVICE_NAME = 'alazar'
+INPUT_RANGE = 4000
+
+
+def stage_parameters(rate):
+    """Parameters of each stage type, resolving the simulated waveforms"""
+    period = fake_atsapi.Board.period
+    return {
+        'ddc': {'type': 'ddc', 'frequency': rate / period, 'decimation': 10 * period},
+        'boxcar': {'type': 'boxcar', 'length': 10 * period},
+        'fft': {'type': 'fft', 'segment_length': 4 * period, 'window': 'hann'},
+    }
+
+
+def make_worker(args, scratch_directory):
+    """Return a GuilessWorker in the state it is in during an acquisition of both
+    channels, with a scratch file of simulated samples and the given DSP stages, without
+    initialising a board"""
+    worker = GuilessWorker.__new__(GuilessWorker)
+    worker.device_name = DEVICE_NAME
+    worker.scratch_directory = scratch_directory
+    worker.bitsPerSample = 16
+    worker.channels = ats.CHANNEL_A | ats.CHANNEL_B
+    worker.channelCount = 2
+    worker.channel_names = ['A', 'B']
+    worker.columnCount = 2
+    worker.sample_dtype = np.uint16
+    worker.samplesPerAcquisition = args.n_samples
+    worker.samplesPerBuffer = args.samples_per_buffer
+    worker.atsparam = {'store_raw': False}
+    worker.create_scratch_file()
+    board = fake_atsapi.Board()
+    samples = worker.scratch.reshape(args.n_samples, 2)
+    samples[:, 0] = board.expected_samples(ats.CHANNEL_A, 0, args.n_samples)
+    samples[:, 1] = board.expected_samples(ats.CHANNEL_B, 0, args.n_samples)
+    return worker
+
+
+def set_up_stages(worker, args):
+    channels = [('A', INPUT_RANGE, 16), ('B', INPUT_RANGE, 16)]
+    parameters = stage_parameters(args.rate)
+    worker.dsp_stages = [
+        dsp_stage_types[name](parameters[name], args.rate, channels, args.n_samples)
+        for name in args.stages
+    ]
+    worker.dsp_dispatched = [0] * len(worker.dsp_stages)
+    worker.dsp_results = []
+
+
+def run_stages(worker):
+    """Dispatch each buffer as if it had just been acquired, then wait for the stages
+    to finish. Return the time taken"""
+    start_time = time.perf_counter()
+    for start in range(0, worker.samplesPerAcquisition, worker.samplesPerBuffer):
+        worker.dispatch_dsp(min(start + worker.samplesPerBuffer, worker.samplesPerAcquisition))
+    worker.wait_dsp_complete()
+    return time.perf_counter() - start_time
+
+
+def check_products(h5_filepath, args):
+    """Check the saved products against the simulated waveforms"""
+    period = fake_atsapi.Board.period
+    amplitude = 30000 / 32768 * INPUT_RANGE * 1e-3
+    with h5py.File(h5_filepath, 'r') as f:
+        group = f['data/traces/' + DEVICE_NAME]
+        assert 'rawsamplesA' not in group
+        if 'ddc' in args.stages:
+            for name, phase in [('A', -np.pi / 2), ('B', 0.0)]:
+                assert np.allclose(group['ddc_amplitude' + name][:], amplitude, rtol=1e-3)
+                assert np.allclose(group['ddc_phase' + name][:], phase, atol=1e-3)
+        if 'boxcar' in args.stages:
+            for name in 'AB':
+                assert np.allclose(group['boxcar' + name][:], 0, atol=1e-3)
+        if 'fft' in args.stages:
+            segment_length = stage_parameters(args.rate)['fft']['segment_length']
+            for name in 'AB':
+                magnitudes = group['fft_magnitude' + name][:]
+                assert (magnitudes.argmax(axis=1) == segment_length // period).all()
+                assert np.allclose(magnitudes.max(axis=1), amplitude, rtol=1e-3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-samples', type=int, default=20000000)
+    parser.add_argument('-r', '--rate', type=float, default=180e6)
+    parser.add_argument('--samples-per-buffer', type=int, default=204800)
+    parser.add_argument(
+        '--threads', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()]
+    )
+    parser.add_argument(
+        '--stages',
+        nargs='+',
+        choices=sorted(dsp_stage_types),
+        default=sorted(dsp_stage_types),
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        worker = make_worker(args, tempdir)
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        for n_threads in args.threads:
+            worker.dsp_pool = ThreadPool(n_threads)
+            set_up_stages(worker, args)
+            duration = run_stages(worker)
+            worker.dsp_pool.terminate()
+            with h5py.File(h5_filepath, 'w') as hdf5_file:
+                worker.save_traces(hdf5_file)
+            check_products(h5_filepath, args)
+            print(
+                f"{' + '.join(args.stages)}, {n_threads:2d} threads: "
+                + f"{args.n_samples / duration / 1e6:7.1f} MS/s per channel"
+            )
+        worker.remove_scratch_file()
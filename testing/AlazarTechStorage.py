@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  AlazarTechStorage.py
+"""Compare the time taken and file size of saving an AlazarTechBoard acquisition to the
+shot file, for: deinterleaving and converting each DMA buffer separately and saving both
+volts and raw samples, as done previously; GuilessWorker.save_traces() with the
+store_volts property True; and save_traces() saving raw samples only. Simulated samples
+from fake_atsapi.py are used, so neither the ATS-SDK nor a board is required. The volts
+read back with get_volts() are checked against those saved by the previous method.
+
+Syntax: python AlazarTechStorage.py [-n N_SAMPLES] [--samples-per-buffer N]
+            [--channels {A,B,AB}]"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_atsapi
+
+ats = fake_atsapi.install()
+from labscript_devices.AlazarTechBoard import GuilessWorker, get_volts
+
+DEVICE_NAME = 'alazar'
+
+
+def make_worker(args, scratch_directory):
+    """Return a GuilessWorker in the state it is in after an acquisition, with a scratch
+    file of simulated samples, without initialising a board"""
+    worker = GuilessWorker.__new__(GuilessWorker)
+    worker.device_name = DEVICE_NAME
+    worker.scratch_directory = scratch_directory
+    worker.bitsPerSample = 16
+    worker.channels = 0
+    for name, channel in [('A', ats.CHANNEL_A), ('B', ats.CHANNEL_B)]:
+        if name in args.channels:
+            worker.channels |= channel
+    worker.channelCount = len(args.channels)
+    worker.channel_names = list(args.channels)
+    worker.columnCount = worker.channelCount
+    worker.sample_dtype = np.uint16
+    worker.samplesPerAcquisition = args.n_samples
+    worker.samplesPerBuffer = args.samples_per_buffer
+    worker.atsparam = {'chA_input_range': 4000, 'chB_input_range': 400}
+    worker.dsp_stages = []
+    worker.create_scratch_file()
+    board = fake_atsapi.Board()
+    samples = worker.scratch.reshape(args.n_samples, worker.columnCount)
+    for column, channel in enumerate(c for c in ats.channels if c & worker.channels):
+        samples[:, column] = board.expected_samples(channel, 0, args.n_samples)
+    return worker
+
+
+def save_traces_per_buffer(worker, hdf5_file):
+    """GuilessWorker.transition_to_manual() as it was prior to save_traces()"""
+    grp = hdf5_file.create_group('/data/traces/' + worker.device_name)
+    datasets = []
+    for name, channel in [('A', ats.CHANNEL_A), ('B', ats.CHANNEL_B)]:
+        if worker.channels & channel:
+            datasets.append(
+                (
+                    worker.atsparam['ch%s_input_range' % name],
+                    grp.create_dataset(
+                        'channel' + name, (worker.samplesPerAcquisition,), dtype='float32'
+                    ),
+                    grp.create_dataset(
+                        'rawsamples' + name,
+                        (worker.samplesPerAcquisition,),
+                        dtype='uint16',
+                    ),
+                )
+            )
+    n_data = worker.samplesPerBuffer * worker.channelCount
+    for start in range(0, worker.samplesPerAcquisition, worker.samplesPerBuffer):
+        bufferData = worker.scratch[start * worker.channelCount :][:n_data]
+        end = start + len(bufferData) // worker.channelCount
+        for i, (input_range, dset, dset_raw) in enumerate(datasets):
+            dset_raw[start:end] = bufferData[i :: worker.channelCount]
+            dset[start:end] = worker.to_volts(
+                input_range, bufferData[i :: worker.channelCount]
+            )
+
+
+def check_volts(reference_filepath, h5_filepath, channels):
+    """Check the volts read with get_volts() against those saved in the reference
+    file, in full and for a slice"""
+    with h5py.File(reference_filepath, 'r') as reference, h5py.File(
+        h5_filepath, 'r'
+    ) as f:
+        for name in channels:
+            expected = reference['data/traces/%s/channel%s' % (DEVICE_NAME, name)]
+            volts = get_volts(f, DEVICE_NAME, name)
+            assert volts.shape == expected.shape
+            assert np.array_equal(volts[:], expected[:]), name
+            assert np.array_equal(volts[100:2000:7], expected[100:2000:7]), name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-samples', type=int, default=50000000)
+    parser.add_argument('--samples-per-buffer', type=int, default=204800)
+    parser.add_argument('--channels', choices=['A', 'B', 'AB'], default='AB')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        worker = make_worker(args, tempdir)
+        methods = [
+            ('per buffer, volts and raw', save_traces_per_buffer, True),
+            ('save_traces, volts and raw', GuilessWorker.save_traces, True),
+            ('save_traces, raw only', GuilessWorker.save_traces, False),
+        ]
+        for i, (description, save, store_volts) in enumerate(methods):
+            worker.atsparam['store_volts'] = store_volts
+            h5_filepath = os.path.join(tempdir, 'shot%d.h5' % i)
+            start_time = time.perf_counter()
+            with h5py.File(h5_filepath, 'w') as hdf5_file:
+                save(worker, hdf5_file)
+            duration = time.perf_counter() - start_time
+            size = os.path.getsize(h5_filepath)
+            print(f"{description:28s} {duration:7.3f} s, {size / 2**20:8.1f} MB")
+            check_volts(os.path.join(tempdir, 'shot0.h5'), h5_filepath, args.channels)
+        worker.remove_scratch_file()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  AlazarTechStreaming.py
+"""Run shots through the AlazarTechBoard worker's streaming acquisition, using the
+simulated board in fake_atsapi.py instead of the ATS-SDK and a real board. For each
+shot, the time taken by transition_to_buffered, the capture, and transition_to_manual
+is printed, along with the process's anonymous memory use (excluding pages of the
+memory-mapped scratch file) at the end of the capture. The samples saved to the shot
+file are checked against those generated by the simulated board. Linux only.
+
+Any of the models simulated by fake_atsapi.py can be used, and slave boards can be
+added, which are acquired from synchronously with the master.
+
+Acquisitions much longer than the ring of DMA buffers can be made without the memory
+use growing with the acquisition length. Use --consumer-delay to slow down saving of
+each buffer, which should cause a buffer overflow once it is slower than acquisition.
+
+Syntax: python AlazarTechStreaming.py [-d DURATION] [-r RATE] [-n N_SHOTS]
+            [--buffer-count N] [--samples-per-buffer N] [--channels CHANNELS]
+            [--model MODEL] [--slaves N_SLAVES] [--consumer-delay SECONDS]"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_atsapi
+
+ats = fake_atsapi.install()
+import labscript_utils.properties
+from labscript_devices.AlazarTechBoard import GuilessWorker, atsBoardCapabilities
+
+DEVICE_NAME = 'alazar'
+
+
+def make_shot_file(h5_filepath, args):
+    """Create a shot file with the device properties the worker reads, as saved by
+    AlazarTechBoard with its default arguments, except for using the model's largest
+    input range"""
+    channels = 0
+    for name in args.channels:
+        channels |= getattr(ats, 'CHANNEL_' + name)
+    input_range = max(atsBoardCapabilities[args.model]['input_ranges'])
+    properties = {
+        'requested_acquisition_rate': args.rate,
+        'acquisition_duration': args.duration,
+        'clock_source_id': ats.INTERNAL_CLOCK,
+        'sample_rate_id': ats.SAMPLE_RATE_180MSPS,
+        'clock_edge_id': ats.CLOCK_EDGE_RISING,
+        'decimation': 0,
+        'trig_operation': ats.TRIG_ENGINE_OP_J,
+        'trig_engine_id1': ats.TRIG_ENGINE_J,
+        'trig_source_id1': ats.TRIG_EXTERNAL,
+        'trig_slope_id1': ats.TRIGGER_SLOPE_POSITIVE,
+        'trig_level_id1': 150,
+        'trig_engine_id2': ats.TRIG_ENGINE_K,
+        'trig_source_id2': ats.TRIG_DISABLE,
+        'trig_slope_id2': ats.TRIGGER_SLOPE_POSITIVE,
+        'trig_level_id2': 150,
+        'exttrig_coupling_id': ats.DC_COUPLING,
+        'exttrig_range_id': ats.ETR_5V,
+        'trig_delay_samples': 0,
+        'trig_timeout_10usecs': 0,
+        'channels': channels,
+    }
+    for name in 'ABCD':
+        properties['ch%s_coupling_id' % name] = ats.AC_COUPLING
+        properties['ch%s_input_range' % name] = input_range
+        properties['ch%s_impedance_id' % name] = ats.IMPEDANCE_1M_OHM
+        properties['ch%s_bw_limit' % name] = 0
+    with h5py.File(h5_filepath, 'w') as f:
+        group = f.create_group('devices/' + DEVICE_NAME)
+        labscript_utils.properties.set_attributes(group, properties)
+
+
+def make_worker(args):
+    """Return a GuilessWorker initialised without starting a worker process, with the
+    simulated boards as given by the arguments"""
+    fake_atsapi.boards = {(1, board_id): args.model for board_id in range(1, args.slaves + 2)}
+    worker = GuilessWorker.__new__(GuilessWorker)
+    worker.ats_system_id = 1
+    worker.ats_board_id = 1
+    worker.slave_board_ids = list(range(2, args.slaves + 2))
+    worker.buffer_count = args.buffer_count
+    worker.samples_per_buffer = args.samples_per_buffer
+    worker.scratch_directory = None
+    worker.dsp_threads = None
+    worker.init()
+    if args.consumer_delay:
+        # Slow down the consumer thread by delaying each buffer it is given:
+        get = worker.completed_buffers.get
+
+        def slow_get():
+            index = get()
+            time.sleep(args.consumer_delay)
+            return index
+
+        worker.completed_buffers.get = slow_get
+    return worker
+
+
+def check_shot_file(h5_filepath, worker):
+    """Check the saved samples against those the simulated boards generated, and return
+    the number of samples per channel"""
+    channels_per_board = len(worker.channel_names) // len(worker.boards)
+    with h5py.File(h5_filepath, 'r') as f:
+        group = f['data/traces/' + DEVICE_NAME]
+        for i, name in enumerate(worker.channel_names):
+            board = worker.boards[i // channels_per_board]
+            channel = getattr(ats, 'CHANNEL_' + name[0])
+            raw = group['rawsamples' + name]
+            for start in range(0, len(raw), 2 ** 22):
+                stop = min(start + 2 ** 22, len(raw))
+                expected = board.expected_samples(channel, start, stop)
+                assert (raw[start:stop] == expected).all(), (name, start)
+        return len(raw)
+
+
+def anonymous_memory_MB():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) / 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', '--duration', type=float, default=2.0)
+    parser.add_argument('-r', '--rate', type=float, default=10e6)
+    parser.add_argument('-n', '--n-shots', type=int, default=3)
+    parser.add_argument('--buffer-count', type=int, default=16)
+    parser.add_argument('--samples-per-buffer', type=int, default=204800)
+    parser.add_argument('--channels', default='AB')
+    parser.add_argument(
+        '--model', choices=sorted(fake_atsapi.models), default='ATS9462'
+    )
+    parser.add_argument('--slaves', type=int, default=0)
+    parser.add_argument('--consumer-delay', type=float, default=0.0)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    worker = make_worker(args)
+    print(f"init: {time.perf_counter() - start_time:.3f} s")
+    print(f"Memory after init: {anonymous_memory_MB():.0f} MB")
+    with tempfile.TemporaryDirectory() as tempdir:
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        for shot in range(args.n_shots):
+            make_shot_file(h5_filepath, args)
+            start_time = time.perf_counter()
+            worker.transition_to_buffered(DEVICE_NAME, h5_filepath, {}, True)
+            buffered_time = time.perf_counter()
+            if not worker.acquisition_done.wait(args.duration + 10):
+                raise RuntimeError("Acquisition did not complete")
+            captured_time = time.perf_counter()
+            memory = anonymous_memory_MB()
+            worker.transition_to_manual()
+            manual_time = time.perf_counter()
+            n_samples = check_shot_file(h5_filepath, worker)
+            print(
+                f"Shot {shot}: {n_samples} samples per channel "
+                + f"of {len(worker.channel_names)}, "
+                + f"transition_to_buffered {buffered_time - start_time:.3f} s, "
+                + f"capture {captured_time - buffered_time:.3f} s, "
+                + f"transition_to_manual {manual_time - captured_time:.3f} s, "
+                + f"memory {memory:.0f} MB"
+            )
+    worker.shutdown()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  CiceroOpalKellyUpload.py
+"""Measure how long it takes to pack CiceroOpalKellyXEM3001 pulse programs of different
+sizes into the data written to the FPGA, comparing pulse_program_to_bytearray() with
+calling add_instruction_to_bytearray() for each instruction as was done previously, and
+checking that the results are identical.
+
+Then run repeated shots through CiceroOpalKellyXEM3001Worker.transition_to_buffered(),
+using the simulated FPGA in fake_ok.py, to measure its duration when the pulse program
+is unchanged from the previous shot and so is not written again, when it has changed,
+and when a fresh program is requested. The program held by the simulated FPGA is checked
+against the shot file after each shot.
+
+Syntax: python CiceroOpalKellyUpload.py [--sizes N [N ...]] [--repeats N]
+            [--latency SECONDS] [--pipe-rate BYTES_PER_SECOND]"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_ok
+
+fake_ok.install()
+import labscript_utils.properties
+from labscript_devices.CiceroOpalKellyXEM3001 import (
+    CiceroOpalKellyXEM3001Worker,
+    add_instruction_to_bytearray,
+    pulse_program_to_bytearray,
+)
+
+DEVICE_NAME = 'cicero'
+
+
+def make_pulse_program(n_instructions, seed=0):
+    """Return a random PULSE_PROGRAM table like those produced by
+    CiceroOpalKellyXEM3001.generate_code(), with a wait instruction that times out
+    immediately partway through, and a stop instruction at the end"""
+    rng = np.random.RandomState(seed)
+    dtypes = [('on_period', np.int64), ('off_period', np.int64), ('reps', np.int64)]
+    pulse_program = np.zeros(n_instructions, dtype=dtypes)
+    pulse_program['on_period'] = rng.randint(1, 2 ** 47, n_instructions)
+    pulse_program['off_period'] = rng.randint(1, 2 ** 47, n_instructions)
+    pulse_program['reps'] = rng.randint(1, 2 ** 32, n_instructions)
+    for i in [n_instructions // 2, n_instructions - 1]:
+        pulse_program[i] = (-1 if i < n_instructions - 1 else 0, 3, 0)
+    return pulse_program
+
+
+def pack_per_instruction(pulse_program):
+    """The data written to the FPGA, as prior to pulse_program_to_bytearray()"""
+    data = bytearray(len(pulse_program) * 16)
+    for i, instruction in enumerate(pulse_program):
+        add_instruction_to_bytearray(
+            data,
+            i,
+            instruction['on_period'],
+            instruction['off_period'],
+            instruction['reps'],
+        )
+    return data
+
+
+def make_shot_file(h5_filepath, pulse_program):
+    """Create a shot file with the pulse program and the properties the worker reads,
+    and no waits"""
+    with h5py.File(h5_filepath, 'w') as f:
+        group = f.create_group('devices/' + DEVICE_NAME)
+        group.create_dataset('PULSE_PROGRAM', data=pulse_program)
+        labscript_utils.properties.set_attributes(
+            group, {'is_master_pseudoclock': True, 'stop_time': 1.0}
+        )
+        connection_table_properties = {
+            'reference_clock': 'internal',
+            'clock_frequency': 100e6,
+            'trigger_debounce_clock_ticks': 10,
+        }
+        connection_table = np.array(
+            [
+                (
+                    DEVICE_NAME,
+                    labscript_utils.properties.serialise(connection_table_properties),
+                )
+            ],
+            dtype=[('name', 'S256'), ('properties', 'S2048')],
+        )
+        f.create_dataset('connection table', data=connection_table)
+        waits = f.create_dataset(
+            'waits',
+            data=np.zeros(0, dtype=[('label', 'S256'), ('time', float), ('timeout', float)]),
+        )
+        waits.attrs['wait_monitor_acquisition_device'] = ''
+        waits.attrs['wait_monitor_timeout_device'] = ''
+
+
+def make_worker():
+    """Return a CiceroOpalKellyXEM3001Worker initialised without starting a worker
+    process"""
+    worker = CiceroOpalKellyXEM3001Worker.__new__(CiceroOpalKellyXEM3001Worker)
+    worker.logger = logging.getLogger(DEVICE_NAME)
+    worker.serial = fake_ok.okCFrontPanel.serials[0]
+    worker.reference_clock = 'internal'
+    worker.init()
+    return worker
+
+
+def run_shot(worker, h5_filepath, pulse_program, fresh):
+    """Run transition_to_buffered(), check the program held by the FPGA, and return the
+    time taken and the number of pipe writes"""
+    n_pipe_writes = worker.dev.n_pipe_writes
+    start_time = time.perf_counter()
+    worker.transition_to_buffered(DEVICE_NAME, h5_filepath, {}, fresh)
+    duration = time.perf_counter() - start_time
+    held = worker.dev.pulse_program(len(pulse_program))
+    # The FPGA holds periods of -1 as 48 bit unsigned integers:
+    expected = pulse_program.copy()
+    expected['on_period'] &= 2 ** 48 - 1
+    assert (held == expected).all()
+    return duration, worker.dev.n_pipe_writes - n_pipe_writes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 256, 2048])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=1e-3)
+    parser.add_argument('--pipe-rate', type=float, default=30e6)
+    args = parser.parse_args()
+
+    for n_instructions in args.sizes:
+        pulse_program = make_pulse_program(n_instructions)
+        start_time = time.perf_counter()
+        expected = pack_per_instruction(pulse_program)
+        per_instruction_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        data = pulse_program_to_bytearray(pulse_program)
+        vectorized_time = time.perf_counter() - start_time
+        assert data == expected
+        print(
+            f"{n_instructions:5d} instructions: packing per instruction "
+            + f"{per_instruction_time * 1e3:7.2f} ms, "
+            + f"vectorized {vectorized_time * 1e3:6.3f} ms"
+        )
+
+    fake_ok.okCFrontPanel.latency = args.latency
+    fake_ok.okCFrontPanel.pipe_rate = args.pipe_rate
+    worker = make_worker()
+    with tempfile.TemporaryDirectory() as tempdir:
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        n_instructions = max(args.sizes)
+        for description, seed, fresh in [
+            ('first shot', 0, False),
+            ('unchanged', 0, False),
+            ('changed', 1, False),
+            ('unchanged, fresh', 1, True),
+        ]:
+            pulse_program = make_pulse_program(n_instructions, seed)
+            make_shot_file(h5_filepath, pulse_program)
+            results = [
+                run_shot(worker, h5_filepath, pulse_program, fresh)
+                for _ in range(1 if description in ['first shot', 'changed'] else args.repeats)
+            ]
+            durations, n_pipe_writes = zip(*results)
+            print(
+                f"transition_to_buffered, {description:16s} {np.mean(durations) * 1e3:7.2f} ms, "
+                + f"{np.mean(n_pipe_writes):.0f} pipe writes"
+            )
+    worker.shutdown()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  CiceroOpalKellyWaits.py
+"""Run shots with waits through CiceroOpalKellyXEM3001Worker acting as the wait
+monitor, using the simulated FPGA in fake_ok.py, for different wait monitor poll
+intervals. The status is polled every 100 ms as the BLACS tab does, whilst the worker's
+wait monitor thread detects waits. For each poll interval, the latency from the end of
+each wait to its wait_completed event is printed, and the wait durations saved to the
+shot file are checked against those simulated. Waits closer together than the poll
+interval cannot be measured individually, and so the shot fails.
+
+Syntax: python CiceroOpalKellyWaits.py [-n N_WAITS] [--spacing SECONDS]
+            [--wait-durations MIN MAX] [--poll-intervals SECONDS [SECONDS ...]]"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_ok
+
+fake_ok.install()
+import labscript_utils.properties
+from labscript_devices.CiceroOpalKellyXEM3001 import CiceroOpalKellyXEM3001Worker
+
+DEVICE_NAME = 'cicero'
+CLOCK_FREQUENCY = 100e6
+WAIT_TIMEOUT = 1.0
+# Half the period of the clock output between waits, in reference clock samples:
+HALF_PERIOD = 50
+
+
+def make_shot_file(h5_filepath, n_waits, spacing):
+    """Create a shot file with a pulse program with n_waits waits, spacing seconds
+    apart, with this device as the wait monitor"""
+    reps = int(round(spacing * CLOCK_FREQUENCY / (2 * HALF_PERIOD)))
+    run = (HALF_PERIOD, HALF_PERIOD, reps)
+    wait = (int(round(WAIT_TIMEOUT * CLOCK_FREQUENCY)) - 1, 3, 0)
+    instructions = [run] + [wait, run] * n_waits
+    dtypes = [('on_period', np.int64), ('off_period', np.int64), ('reps', np.int64)]
+    pulse_program = np.array(instructions, dtype=dtypes)
+    wait_table = np.zeros(
+        n_waits, dtype=[('label', 'S256'), ('time', float), ('timeout', float)]
+    )
+    wait_table['label'] = ['wait%d' % i for i in range(n_waits)]
+    wait_table['time'] = np.arange(1, n_waits + 1) * reps * 2 * HALF_PERIOD / CLOCK_FREQUENCY
+    wait_table['timeout'] = WAIT_TIMEOUT
+    with h5py.File(h5_filepath, 'w') as f:
+        group = f.create_group('devices/' + DEVICE_NAME)
+        group.create_dataset('PULSE_PROGRAM', data=pulse_program)
+        labscript_utils.properties.set_attributes(
+            group, {'is_master_pseudoclock': True, 'stop_time': spacing * (n_waits + 1)}
+        )
+        connection_table_properties = {
+            'reference_clock': 'internal',
+            'clock_frequency': CLOCK_FREQUENCY,
+            'trigger_debounce_clock_ticks': 10,
+        }
+        connection_table = np.array(
+            [
+                (
+                    DEVICE_NAME,
+                    labscript_utils.properties.serialise(connection_table_properties),
+                )
+            ],
+            dtype=[('name', 'S256'), ('properties', 'S2048')],
+        )
+        f.create_dataset('connection table', data=connection_table)
+        waits = f.create_dataset('waits', data=wait_table)
+        waits.attrs['wait_monitor_acquisition_device'] = (
+            '%s_internal_wait_monitor_outputs' % DEVICE_NAME
+        )
+        waits.attrs['wait_monitor_timeout_device'] = (
+            '%s_internal_wait_monitor_outputs' % DEVICE_NAME
+        )
+
+
+class EventRecorder(object):
+    """In place of a zprocess.Event, records the time each event is posted"""
+
+    def __init__(self):
+        self.times = []
+
+    def post(self, id, data=None):
+        self.times.append(time.perf_counter())
+
+
+def make_worker(poll_interval):
+    """Return a CiceroOpalKellyXEM3001Worker initialised without starting a worker
+    process, recording the events it posts"""
+    worker = CiceroOpalKellyXEM3001Worker.__new__(CiceroOpalKellyXEM3001Worker)
+    worker.logger = logging.getLogger(DEVICE_NAME)
+    worker.serial = fake_ok.okCFrontPanel.serials[0]
+    worker.reference_clock = 'internal'
+    worker.wait_monitor_poll_interval = poll_interval
+    worker.init()
+    worker.wait_completed = EventRecorder()
+    worker.all_waits_finished = EventRecorder()
+    worker.wait_durations_analysed = EventRecorder()
+    return worker
+
+
+def run_shot(worker, h5_filepath):
+    """Run a shot, polling the status as the BLACS tab does, and return the latency of
+    each wait_completed event"""
+    worker.transition_to_buffered(DEVICE_NAME, h5_filepath, {}, True)
+    worker.wait_completed.times = []
+    worker.start_run()
+    while not worker.status_monitor():
+        time.sleep(0.1)
+    worker.transition_to_manual()
+    end_times, wait_samples = worker.dev.wait_results()
+    with h5py.File(h5_filepath, 'r') as f:
+        durations = f['data/waits']['duration']
+        assert np.allclose(durations, wait_samples / CLOCK_FREQUENCY)
+    assert len(worker.all_waits_finished.times) == 1
+    return np.array(worker.wait_completed.times) - end_times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-waits', type=int, default=20)
+    parser.add_argument('--spacing', type=float, default=0.02)
+    parser.add_argument(
+        '--wait-durations', type=float, nargs=2, default=[0.001, 0.05]
+    )
+    parser.add_argument(
+        '--poll-intervals', type=float, nargs='+', default=[0.001, 0.01, 0.1]
+    )
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    fake_ok.okCFrontPanel.clock_frequency = CLOCK_FREQUENCY
+    with tempfile.TemporaryDirectory() as tempdir:
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        for poll_interval in args.poll_intervals:
+            fake_ok.okCFrontPanel.wait_durations = list(
+                rng.uniform(*args.wait_durations, size=args.n_waits)
+            )
+            make_shot_file(h5_filepath, args.n_waits, args.spacing)
+            worker = make_worker(poll_interval)
+            try:
+                latencies = run_shot(worker, h5_filepath)
+            except AssertionError as e:
+                print(f"poll interval {poll_interval * 1e3:6.1f} ms: failed: {e}")
+            else:
+                print(
+                    f"poll interval {poll_interval * 1e3:6.1f} ms: "
+                    + f"{len(latencies)} waits measured, latency "
+                    + f"p50 {np.median(latencies) * 1e3:6.2f} ms, "
+                    + f"max {latencies.max() * 1e3:6.2f} ms"
+                )
+            worker.shutdown()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  NI_DAQmxWaitMonitor.py
+"""Run shots with two waits through NI_DAQmxWaitMonitorWorker, using the simulated
+counter input and digital output tasks in fake_daqmx.py. The first wait is retriggered
+before its timeout, whilst the second is not, so that the worker must time it out and
+fire the timeout trigger to resume the experiment. Shots are run for devices with and
+without incomplete sample detection.
+
+The waits saved to /data/waits in the shot file are checked: the durations against
+those simulated, timed_out, and resume_latency, which must be NaN for the retriggered
+wait and non-negative for the timed out one. The latency with which the timeout trigger
+fired after each timeout is printed.
+
+Syntax: python NI_DAQmxWaitMonitor.py [-n N_SHOTS] [--timeout SECONDS]
+            [--retrigger-delay SECONDS]"""
+
+import os
+import sys
+import logging
+import argparse
+import tempfile
+import threading
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_daqmx
+
+fake_daqmx.install()
+import labscript_devices.NI_DAQmx.blacs_workers as blacs_workers
+from labscript_devices.NI_DAQmx.blacs_workers import NI_DAQmxWaitMonitorWorker
+
+DEVICE_NAME = 'wait_monitor_daq'
+WAIT_TIMES = [0.05, 0.1]
+PULSE_WIDTH = 1e-3
+
+# The worker determines this by measuring a pulse with the device:
+blacs_workers.incomplete_sample_detection = fake_daqmx.incomplete_sample_detection
+
+
+def make_shot_file(h5_filepath, timeout):
+    """Create a shot file with the given waits, each with the given timeout"""
+    wait_table = np.zeros(
+        len(WAIT_TIMES), dtype=[('label', 'S256'), ('time', float), ('timeout', float)]
+    )
+    wait_table['label'] = ['wait%d' % i for i in range(len(WAIT_TIMES))]
+    wait_table['time'] = WAIT_TIMES
+    wait_table['timeout'] = timeout
+    with h5py.File(h5_filepath, 'w') as f:
+        f.create_dataset('waits', data=wait_table)
+
+
+class EventRecorder(object):
+    """In place of a zprocess.Event, records the data of each event posted"""
+
+    def __init__(self):
+        self.posted = []
+
+    def post(self, id, data=None):
+        self.posted.append(data)
+
+
+def make_worker():
+    """Return an NI_DAQmxWaitMonitorWorker initialised without starting a worker
+    process, recording the events it posts"""
+    worker = NI_DAQmxWaitMonitorWorker.__new__(NI_DAQmxWaitMonitorWorker)
+    worker.logger = logging.getLogger(DEVICE_NAME)
+    worker.kill_lock = threading.Lock()
+    worker.MAX_name = 'Dev1'
+    worker.wait_acq_connection = 'ctr0'
+    worker.wait_timeout_connection = 'port0/line0'
+    worker.timeout_trigger_type = fake_daqmx.wait_monitor.timeout_trigger_type
+    worker.min_semiperiod_measurement = 1e-7
+    worker.init()
+    worker.wait_completed = EventRecorder()
+    worker.all_waits_finished = EventRecorder()
+    worker.wait_durations_analysed = EventRecorder()
+    return worker
+
+
+def run_shot(worker, h5_filepath, timeout):
+    """Run a shot and check the waits saved to the shot file. Return the resume
+    latency of the wait that timed out"""
+    for event in [
+        worker.wait_completed,
+        worker.all_waits_finished,
+        worker.wait_durations_analysed,
+    ]:
+        event.posted = []
+    worker.transition_to_buffered(DEVICE_NAME, h5_filepath, {}, True)
+    fake_daqmx.wait_monitor.start()
+    worker.transition_to_manual()
+    wait_results = fake_daqmx.wait_monitor.wait_results()
+    simulated_durations = [end - start for start, end in wait_results]
+    with h5py.File(h5_filepath, 'r') as f:
+        waits = f['data/waits'][:]
+    assert len(wait_results) == len(WAIT_TIMES), wait_results
+    assert np.allclose(waits['duration'], simulated_durations, rtol=0, atol=1e-9), (
+        waits['duration'],
+        simulated_durations,
+    )
+    assert list(waits['timed_out']) == [False, True], waits['timed_out']
+    resume_latency = waits['resume_latency']
+    assert np.isnan(resume_latency[0]), resume_latency
+    assert resume_latency[1] >= 0, resume_latency
+    # The trigger fires after the timeout, by the latency plus however long after the
+    # start of the wait the worker began waiting for its end:
+    assert waits['duration'][1] >= timeout + resume_latency[1], waits
+    assert worker.wait_completed.posted == ['wait0', 'wait1']
+    assert len(worker.all_waits_finished.posted) == 1
+    assert len(worker.wait_durations_analysed.posted) == 1
+    return resume_latency[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-shots', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=0.1)
+    parser.add_argument('--retrigger-delay', type=float, default=0.02)
+    args = parser.parse_args()
+
+    fake_daqmx.wait_monitor.pulse_width = PULSE_WIDTH
+    fake_daqmx.wait_monitor.wait_times = WAIT_TIMES
+    fake_daqmx.wait_monitor.retrigger_delays = [args.retrigger_delay, None]
+    with tempfile.TemporaryDirectory() as tempdir:
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        for incomplete_sample_detection in [False, True]:
+            fake_daqmx.wait_monitor.incomplete_sample_detection = (
+                incomplete_sample_detection
+            )
+            worker = make_worker()
+            latencies = []
+            for _ in range(args.n_shots):
+                make_shot_file(h5_filepath, args.timeout)
+                latencies.append(run_shot(worker, h5_filepath, args.timeout))
+            worker.shutdown()
+            latencies = np.array(latencies)
+            print(
+                f"incomplete sample detection {str(incomplete_sample_detection):5s}: "
+                + f"{args.n_shots} shots OK, resume latency "
+                + f"p50 {np.median(latencies) * 1e3:6.3f} ms, "
+                + f"max {latencies.max() * 1e3:6.3f} ms"
+            )
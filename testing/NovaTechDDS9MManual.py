@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  NovaTechDDS9MManual.py
+"""Measure the latency and number of serial commands of NovatechDDS9mWorker's manual
+mode programming during a simulated spinbox drag, using the simulated DDS9m in
+fake_dds9m.py instead of a real device. This is compared with programming every value
+and reading all of them back after every change, as was done previously. After the
+drag, the tab's periodic readback check is simulated, and the time from the last change
+until the values are read back is reported. The values read back are checked against
+those returned by program_manual().
+
+Syntax: python NovaTechDDS9MManual.py [-n N_CHANGES] [-r CHANGE_RATE] [--baud BAUD]
+            [--latency SECONDS] [--poll-interval SECONDS]"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_dds9m import FakeDDS9m
+from NovaTechDDS9MUpload import make_worker
+
+
+def front_panel_values(freq0):
+    """Return front panel values with the given frequency for channel 0"""
+    values = {}
+    for i in range(4):
+        values['channel %d' % i] = {'freq': 10e6 * (i + 1), 'amp': 0.5, 'phase': 90.0}
+    values['channel 0']['freq'] = freq0
+    return values
+
+
+def program_all_and_read_back(worker, values):
+    """Manual mode programming as done prior to smart programming"""
+    worker.manual_commands.clear()
+    worker.program_manual(values)
+    return worker.check_remote_values()
+
+
+def drag(worker, device, args, program):
+    """Call program(worker, values) for a sequence of frequencies of channel 0 at the
+    given rate, and return the latencies, the number of commands sent to the device,
+    and the values returned by the last call"""
+    latencies = []
+    n_commands = device.n_commands
+    for i in range(args.n_changes):
+        start_time = time.perf_counter()
+        results = program(worker, front_panel_values(20e6 + 1e3 * i))
+        latencies.append(time.perf_counter() - start_time)
+        time.sleep(max(1 / args.change_rate - latencies[-1], 0))
+    return np.array(latencies), device.n_commands - n_commands, results
+
+
+def wait_for_readback(worker, poll_interval):
+    """Poll readback_due() as the tab does, and read back the values when it returns
+    True. Return the values and the time waited"""
+    start_time = time.perf_counter()
+    while not worker.readback_due():
+        time.sleep(poll_interval)
+    results = worker.check_remote_values()
+    return results, time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-changes', type=int, default=50)
+    parser.add_argument('-r', '--change-rate', type=float, default=30.0)
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--latency', type=float, default=1e-3)
+    parser.add_argument('--poll-interval', type=float, default=0.25)
+    args = parser.parse_args()
+
+    device = FakeDDS9m(baud_rate=args.baud, latency=args.latency)
+    worker = make_worker(device.port, args.baud, pipeline_depth=8)
+    try:
+        # Program the initial values:
+        worker.program_manual(front_panel_values(20e6))
+        for description, program in [
+            ('program all, read back', program_all_and_read_back),
+            ('changed only, deferred', lambda w, v: w.program_manual(v)),
+        ]:
+            latencies, n_commands, results = drag(worker, device, args, program)
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+            print(
+                f"{description:24s} latency p50 {p50:6.2f} ms, p99 {p99:6.2f} ms, "
+                + f"{n_commands / args.n_changes:5.1f} commands per change"
+            )
+        readback, waited = wait_for_readback(worker, args.poll_interval)
+        assert readback == results, (readback, results)
+        print(f"Values read back {waited:.2f} s after the last change, as expected")
+    finally:
+        worker.shutdown()
+        device.close()
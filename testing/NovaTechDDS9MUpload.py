@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  NovaTechDDS9MUpload.py
+"""Measure how long NovatechDDS9mWorker takes to program tables of different sizes at
+different baud rates and pipeline depths, using the simulated DDS9m in fake_dds9m.py
+instead of a real device. After each upload, the table and static values held by the
+simulated device are checked against the shot file. Use --error-probability and
+--input-buffer-size to check that uploads still succeed when commands are rejected or
+lost and the worker has to fall back to sending commands one at a time.
+
+Each table is then modified in a contiguous range of --changed-rows rows and uploaded
+again, as in a scan, to measure smart programming of only the changed rows. The
+statistics the worker saves to the shot file are printed for each upload.
+
+Syntax: python NovaTechDDS9MUpload.py [--sizes N [N ...]] [--bauds BAUD [BAUD ...]]
+            [--depths DEPTH [DEPTH ...]] [--latency SECONDS]
+            [--error-probability P] [--input-buffer-size N_BYTES]
+            [--changed-rows N]"""
+
+import os
+import sys
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_dds9m import FakeDDS9m
+
+from labscript_devices.NovaTechDDS9M import NovatechDDS9mWorker
+
+DEVICE_NAME = 'novatech'
+
+
+def make_shot_file(h5_filepath, n_lines, seed=0, changed_rows=None):
+    """Create a shot file with random TABLE_DATA and STATIC_DATA like those produced by
+    NovaTechDDS9M.generate_code(), and return them. If changed_rows is given as a
+    (start, stop) tuple, the table is the same as for changed_rows=None except for
+    those rows"""
+    rng = np.random.RandomState(seed)
+    dtypes = (
+        [('freq%d' % i, np.uint32) for i in range(2)]
+        + [('phase%d' % i, np.uint16) for i in range(2)]
+        + [('amp%d' % i, np.uint16) for i in range(2)]
+    )
+    static_dtypes = (
+        [('freq%d' % i, np.uint32) for i in range(2, 4)]
+        + [('phase%d' % i, np.uint16) for i in range(2, 4)]
+        + [('amp%d' % i, np.uint16) for i in range(2, 4)]
+    )
+    table = np.zeros(n_lines, dtype=dtypes)
+    static_table = np.zeros(1, dtype=static_dtypes)
+    for data, channels in [(table, range(2)), (static_table, range(2, 4))]:
+        for i in channels:
+            data['freq%d' % i] = rng.randint(1, 1710000000, len(data))
+            data['phase%d' % i] = rng.randint(0, 16384, len(data))
+            data['amp%d' % i] = rng.randint(0, 1024, len(data))
+    if changed_rows is not None:
+        start, stop = changed_rows
+        table['freq0'][start:stop] += 1
+    with h5py.File(h5_filepath, 'w') as f:
+        group = f.create_group('devices/' + DEVICE_NAME)
+        group.create_dataset('TABLE_DATA', data=table)
+        group.create_dataset('STATIC_DATA', data=static_table)
+    return table, static_table[0]
+
+
+def make_worker(port, baud_rate, pipeline_depth):
+    """Return a NovatechDDS9mWorker connected to the given port, initialised without
+    starting a worker process"""
+    worker = NovatechDDS9mWorker.__new__(NovatechDDS9mWorker)
+    worker.logger = logging.getLogger(DEVICE_NAME)
+    worker.com_port = port
+    worker.baud_rate = baud_rate
+    worker.default_baud_rate = None
+    worker.update_mode = 'synchronous'
+    worker.phase_mode = 'default'
+    worker.pipeline_depth = pipeline_depth
+    worker.init()
+    return worker
+
+
+def check_device(device, table, static_data):
+    """Check that the simulated device holds the given table and static values"""
+    for i in range(2):
+        for name in ['freq', 'phase', 'amp']:
+            programmed = device.table[i, : len(table)][name]
+            assert np.array_equal(programmed, table['%s%d' % (name, i)]), (name, i)
+    for i in range(2, 4):
+        assert device.static[i]['amp'] == static_data['amp%d' % i]
+        assert device.static[i]['phase'] == static_data['phase%d' % i]
+        freq = int(round(device.static[i]['freq'] * 1e7))
+        assert freq == static_data['freq%d' % i], (freq, static_data['freq%d' % i])
+
+
+def get_upload_statistics(h5_filepath):
+    with h5py.File(h5_filepath, 'r') as f:
+        return dict(f['data/' + DEVICE_NAME].attrs)
+
+
+def run_upload(args, n_lines, baud_rate, pipeline_depth, h5_filepath):
+    """Program a table of n_lines into a fresh simulated device, then a table differing
+    from it in args.changed_rows rows, checking the device after each. Return the
+    statistics saved to the shot file for each upload, and the number of times the
+    worker fell back to lock-step. Raises AssertionError if the device was not
+    programmed correctly"""
+    start = n_lines // 2
+    changed_rows = (start, min(start + args.changed_rows, n_lines))
+    device = FakeDDS9m(
+        baud_rate=baud_rate,
+        latency=args.latency,
+        input_buffer_size=args.input_buffer_size,
+        error_probability=args.error_probability,
+        seed=0,
+    )
+    try:
+        worker = make_worker(device.port, baud_rate, pipeline_depth)
+        try:
+            statistics = []
+            for fresh, rows in [(True, None), (False, changed_rows)]:
+                table, static_data = make_shot_file(h5_filepath, n_lines, 0, rows)
+                worker.transition_to_buffered(DEVICE_NAME, h5_filepath, {}, fresh)
+                check_device(device, table, static_data)
+                statistics.append(get_upload_statistics(h5_filepath))
+            return statistics, worker.pipeline.n_fallbacks
+        finally:
+            worker.shutdown()
+    finally:
+        device.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 2048])
+    parser.add_argument('--bauds', type=int, nargs='+', default=[19200, 115200])
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--latency', type=float, default=1e-3)
+    parser.add_argument('--error-probability', type=float, default=0.0)
+    parser.add_argument('--input-buffer-size', type=int, default=None)
+    parser.add_argument('--changed-rows', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        for n_lines in args.sizes:
+            for baud_rate in args.bauds:
+                for pipeline_depth in args.depths:
+                    description = (
+                        f"{n_lines:6d} lines, {baud_rate:6d} baud, depth "
+                        + f"{pipeline_depth:3d}:"
+                    )
+                    try:
+                        statistics, n_fallbacks = run_upload(
+                            args, n_lines, baud_rate, pipeline_depth, h5_filepath
+                        )
+                    except Exception as e:
+                        print(f"{description} FAILED: {e!r}")
+                        continue
+                    for upload, stats in zip(['full', 'partial'], statistics):
+                        print(
+                            f"{description} {upload:7s} upload "
+                            + f"{stats['upload_time']:8.3f} s, "
+                            + f"{stats['table_rows_changed']:5d} rows in "
+                            + f"{stats['table_ranges_changed']} ranges, "
+                            + f"{stats['bytes_sent']:7d} bytes"
+                        )
+                    print(f"{description} {n_fallbacks} fallbacks to lock-step")
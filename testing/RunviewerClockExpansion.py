@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  RunviewerClockExpansion.py
+"""Measure how long the PineBlaster and CiceroOpalKellyXEM3001 runviewer parsers take to
+reconstruct the clock output of pulse programs with different numbers of clock ticks,
+comparing them with looping over every tick as they did prior to using
+clock_expansion.py, and checking that the traces agree. Random pulse programs with
+waits are used, both without a parent clock, when waits last the device's wait delay,
+and with a parent clock whose rising edges trigger the device.
+
+The time taken by clock_runs() to produce the run-length representation of the largest
+programs is also printed.
+
+Syntax: python RunviewerClockExpansion.py [--ticks N [N ...]] [--instructions N]
+            [--waits N]"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import h5py
+
+import labscript_utils.properties
+from labscript_devices.clock_expansion import clock_runs
+from labscript_devices.PineBlaster import RunviewerClass as PineBlasterParser
+from labscript_devices.CiceroOpalKellyXEM3001 import RunviewerClass as CiceroParser
+
+DEVICE_NAME = 'pseudoclock'
+CICERO_CLOCK_FREQUENCY = 100e6
+CICERO_TRIGGER_DELAY = 150e-9
+CICERO_WAIT_DELAY = 10e-9
+
+
+class Connection(object):
+    """The parts of a runviewer connection table entry the parsers use"""
+
+    def __init__(self, name, parent_port='', children=()):
+        self.name = name
+        self.parent_port = parent_port
+        self.child_list = {child.name: child for child in children}
+
+
+def make_device(port):
+    """A device with a pseudoclock with a single clockline on the given port"""
+    clock_line = Connection(DEVICE_NAME + '_clock_line', port)
+    pseudoclock = Connection(DEVICE_NAME + '_pseudoclock', 'clock', [clock_line])
+    return Connection(DEVICE_NAME, children=[pseudoclock])
+
+
+def random_program(rng, n_ticks, n_instructions, n_waits):
+    """Return periods and reps of random instructions with n_ticks ticks in total, and
+    the indices at which waits are to be inserted"""
+    periods = rng.randint(4, 1000, n_instructions)
+    reps = rng.multinomial(n_ticks - n_instructions, np.ones(n_instructions) / n_instructions) + 1
+    wait_indices = np.sort(rng.choice(np.arange(1, n_instructions), n_waits, replace=False))
+    return periods, reps, wait_indices
+
+
+def make_pineblaster_shot(h5_filepath, periods, reps, wait_indices):
+    """Create a shot file with a PineBlaster pulse program, with waits and a stop, and
+    return the pulse program"""
+    pulse_program = np.zeros(len(periods), dtype=[('period', int), ('reps', int)])
+    pulse_program['period'] = periods
+    pulse_program['reps'] = reps
+    pulse_program = np.insert(pulse_program, wait_indices, (0, 1))
+    pulse_program = np.append(pulse_program, np.array((0, 0), dtype=pulse_program.dtype))
+    with h5py.File(h5_filepath, 'w') as f:
+        f.create_dataset('devices/%s/PULSE_PROGRAM' % DEVICE_NAME, data=pulse_program)
+    return pulse_program
+
+
+def make_cicero_shot(h5_filepath, periods, reps, wait_indices):
+    """Create a shot file with a CiceroOpalKellyXEM3001 pulse program with waits, and
+    return the pulse program"""
+    dtypes = [('on_period', np.int64), ('off_period', np.int64), ('reps', np.int64)]
+    pulse_program = np.zeros(len(periods), dtype=dtypes)
+    pulse_program['on_period'] = periods // 2
+    pulse_program['off_period'] = periods - periods // 2
+    pulse_program['reps'] = reps
+    pulse_program = np.insert(pulse_program, wait_indices, (99, 3, 0))
+    with h5py.File(h5_filepath, 'w') as f:
+        group = f.create_group('devices/' + DEVICE_NAME)
+        group.create_dataset('PULSE_PROGRAM', data=pulse_program)
+        labscript_utils.properties.set_attributes(
+            group,
+            {'trigger_delay': CICERO_TRIGGER_DELAY, 'wait_delay': CICERO_WAIT_DELAY},
+        )
+        connection_table = np.array(
+            [
+                (
+                    DEVICE_NAME,
+                    labscript_utils.properties.serialise(
+                        {'clock_frequency': CICERO_CLOCK_FREQUENCY}
+                    ),
+                )
+            ],
+            dtype=[('name', 'S256'), ('properties', 'S2048')],
+        )
+        f.create_dataset('connection table', data=connection_table)
+    return pulse_program
+
+
+def clock_ticks(clock):
+    """The times of the rising edges of a clock trace, as the parsers find them"""
+    times, clock_value = clock
+    clock_indices = np.where((clock_value[1:] - clock_value[:-1]) == 1)[0] + 1
+    if clock_value[0] == 1:
+        clock_indices = np.insert(clock_indices, 0, 0)
+    return times[clock_indices]
+
+
+def pineblaster_per_tick(pulse_program, clock=None):
+    """PineBlaster's RunviewerClass.get_traces() clock, as prior to clock_expansion"""
+    parser = PineBlasterParser
+    if clock is not None:
+        ticks = clock_ticks(clock)
+    time = []
+    states = []
+    trigger_index = 0
+    t = 0 if clock is None else ticks[trigger_index] + parser.trigger_delay
+    trigger_index += 1
+    clock_factor = parser.clock_resolution / 2.0
+    for row in pulse_program:
+        if row['period'] == 0:
+            if row['reps'] == 1:
+                if clock is not None:
+                    t = ticks[trigger_index] + parser.trigger_delay
+                    trigger_index += 1
+                else:
+                    t += parser.wait_delay
+        else:
+            for i in range(row['reps']):
+                for j in range(1, -1, -1):
+                    time.append(t)
+                    states.append(j)
+                    t += row['period'] * clock_factor
+    return np.array(time), np.array(states)
+
+
+def cicero_per_tick(pulse_program, clock=None):
+    """CiceroOpalKellyXEM3001's RunviewerClass.get_traces() clock, as prior to
+    clock_expansion"""
+    if clock is not None:
+        ticks = clock_ticks(clock)
+    time = []
+    states = []
+    trigger_index = 0
+    t = 0
+    for row in pulse_program:
+        if row['reps'] == 0:
+            if clock is not None:
+                t = ticks[trigger_index] + CICERO_TRIGGER_DELAY
+                trigger_index += 1
+            else:
+                t += CICERO_WAIT_DELAY
+        else:
+            for i in range(row['reps']):
+                time.append(t)
+                states.append(1)
+                t += row['on_period'] / CICERO_CLOCK_FREQUENCY
+                time.append(t)
+                states.append(0)
+                t += row['off_period'] / CICERO_CLOCK_FREQUENCY
+    return np.array(time), np.array(states)
+
+
+def parent_clock(n_triggers, duration):
+    """A parent clock trace with n_triggers rising edges spread over duration"""
+    trigger_times = np.linspace(0, duration, n_triggers)
+    times = np.repeat(trigger_times, 2) + np.tile([0, 1e-6], n_triggers)
+    states = np.tile([1, 0], n_triggers)
+    return times, states
+
+
+def compare(description, parser_class, port, h5_filepath, per_tick, pulse_program, clock):
+    """Time the parser and the per-tick reference and check the traces agree"""
+    parser = parser_class(h5_filepath, make_device(port))
+    traces = {}
+    start_time = time.perf_counter()
+    parser.get_traces(lambda name, trace, *args: traces.update({name: trace}), clock)
+    parser_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    expected_times, expected_states = per_tick(pulse_program, clock)
+    per_tick_time = time.perf_counter() - start_time
+    (times, states), = traces.values()
+    assert np.array_equal(states, expected_states)
+    # The per-tick loop accumulates rounding error with every tick, so the traces agree
+    # only to within a small fraction of the time since the start:
+    assert np.allclose(times, expected_times, rtol=1e-11, atol=1e-12)
+    print(
+        f"{description:36s} {len(times) // 2:9d} ticks: "
+        + f"per tick {per_tick_time:8.3f} s, "
+        + f"parser {parser_time:7.3f} s ({per_tick_time / parser_time:6.1f}x)"
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ticks', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--instructions', type=int, default=1000)
+    parser.add_argument('--waits', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as tempdir:
+        h5_filepath = os.path.join(tempdir, 'shot.h5')
+        for n_ticks in args.ticks:
+            periods, reps, wait_indices = random_program(
+                rng, n_ticks, args.instructions, args.waits
+            )
+            # A parent clock that triggers the start and each wait, well after the
+            # program would otherwise have resumed:
+            clock = parent_clock(args.waits + 1, 10.0 * n_ticks * 1e-5)
+
+            pulse_program = make_pineblaster_shot(h5_filepath, periods, reps, wait_indices)
+            for suffix, parent in [('', None), (', parent clock', clock)]:
+                compare(
+                    'PineBlaster' + suffix,
+                    PineBlasterParser,
+                    'internal',
+                    h5_filepath,
+                    pineblaster_per_tick,
+                    pulse_program,
+                    parent,
+                )
+
+            pulse_program = make_cicero_shot(h5_filepath, periods, reps, wait_indices)
+            for suffix, parent in [('', None), (', parent clock', clock)]:
+                compare(
+                    'CiceroOpalKellyXEM3001' + suffix,
+                    CiceroParser,
+                    'Clock Out',
+                    h5_filepath,
+                    cicero_per_tick,
+                    pulse_program,
+                    parent,
+                )
+
+        start_time = time.perf_counter()
+        runs = clock_runs(
+            pulse_program['on_period'] / CICERO_CLOCK_FREQUENCY,
+            pulse_program['off_period'] / CICERO_CLOCK_FREQUENCY,
+            pulse_program['reps'],
+            pulse_program['reps'] == 0,
+            wait_delay=CICERO_WAIT_DELAY,
+        )
+        run_length_time = time.perf_counter() - start_time
+        print(
+            f"clock_runs() run-length representation of {runs[3].sum()} ticks "
+            + f"in {len(runs[0])} runs: {run_length_time * 1e3:.3f} ms"
+        )
@@ -0,0 +1,394 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/testing/fake_atsapi.py                         #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Simulated AlazarTech boards in place of labscript_devices.atsapi, so that the
+AlazarTechBoard worker can be exercised and benchmarked without the ATS-SDK or a board.
+
+Call install() before importing labscript_devices.AlazarTechBoard. The constants are
+those of the real atsapi.py, whilst the functions, DMABuffer and Board are replaced.
+
+The boards present are listed in `boards`, mapping (systemId, boardId) to a model in
+`models`. By default there is a single ATS9462. Boards in the same system are connected
+by a SyncBoard: board 1 is the master, and calling startCapture() on it starts the
+acquisition of every board of the system that is ready for one, using the master's
+sample rate. Calling startCapture() on a slave does nothing, as with the real SyncBoard.
+
+Once started, the boards are triggered after trigger_delay seconds and fill posted
+buffers, in the order they were posted, at the sample rate set with setCaptureClock().
+waitAsyncBufferComplete() blocks until the buffer would be full. Each channel is a
+sinusoid of period `period` samples, channel A being a sine wave and each following
+channel a quarter of a period later, with slave boards shifted by a further eighth of a
+period per board. Samples are left justified in the board's bytes per sample, as by the
+real boards; the expected samples can be obtained from Board.expected_samples(). If a
+buffer is not posted by the time the board's FIFO of fifo_samples samples per channel
+would fill up waiting for it, the acquisition fails with ApiBufferOverflow, as does the
+real board."""
+
+import os
+import sys
+import time
+import types
+import ctypes
+import threading
+from collections import deque
+
+import numpy as np
+
+ATSAPI_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'atsapi.py'
+)
+
+ApiSuccess = 512
+ApiFailed = 513
+ApiBufferNotReady = 573
+ApiWaitTimeout = 579
+ApiBufferOverflow = 582
+
+RETURN_CODE_NAMES = {
+    ApiSuccess: 'ApiSuccess',
+    ApiFailed: 'ApiFailed',
+    ApiBufferNotReady: 'ApiBufferNotReady',
+    ApiWaitTimeout: 'ApiWaitTimeout',
+    ApiBufferOverflow: 'ApiBufferOverflow',
+}
+
+
+def load_constants():
+    """Return a dict of the constants defined in atsapi.py, without loading the
+    ATS-SDK library"""
+    with open(ATSAPI_PATH) as f:
+        source = f.read()
+    source = source[: source.index('# Load libraries')]
+    namespace = {'__name__': 'atsapi_constants'}
+    exec(compile(source, ATSAPI_PATH, 'exec'), namespace)
+    return namespace
+
+
+class AlazarException(RuntimeError):
+    pass
+
+
+def raise_error(funcname, arguments, code):
+    """Raise an AlazarException with the same args as atsapi.returnCodeCheck()"""
+    text = RETURN_CODE_NAMES[code]
+    raise AlazarException(
+        "Error calling function %s with arguments %s : %s"
+        % (funcname, str(arguments), text),
+        funcname,
+        arguments,
+        code,
+        text,
+    )
+
+
+class DMABuffer(object):
+    """Buffer with the same interface as atsapi.DMABuffer, allocated as a ctypes
+    array"""
+
+    sample_types = {
+        ctypes.c_uint8: np.uint8,
+        ctypes.c_uint16: np.uint16,
+        ctypes.c_uint32: np.uint32,
+        ctypes.c_int32: np.int32,
+        ctypes.c_float: np.float32,
+    }
+
+    # Buffers that have not been freed, by address, so that the board can find them:
+    allocated = {}
+
+    def __init__(self, c_sample_type, size_bytes):
+        self.size_bytes = size_bytes
+        n_samples = size_bytes // ctypes.sizeof(c_sample_type)
+        self.ctypes_buffer = (c_sample_type * n_samples)()
+        self.addr = ctypes.addressof(self.ctypes_buffer)
+        self.buffer = np.frombuffer(
+            self.ctypes_buffer, dtype=self.sample_types[c_sample_type]
+        )
+        self.allocated[self.addr] = self
+
+    def __exit__(self):
+        del self.allocated[self.addr]
+
+
+# Specifications of the simulated models, as reported by the real boards:
+models = {
+    'ATS9462': {'num_channels': 2, 'bits_per_sample': 16, 'memorysize_samples': 2 ** 28},
+    'ATS9440': {'num_channels': 4, 'bits_per_sample': 14, 'memorysize_samples': 2 ** 27},
+    'ATS9360': {'num_channels': 2, 'bits_per_sample': 12, 'memorysize_samples': 2 ** 31},
+    'ATS9870': {'num_channels': 2, 'bits_per_sample': 8, 'memorysize_samples': 2 ** 28},
+}
+
+# The boards present, as {(systemId, boardId): model}. Modify before creating boards:
+boards = {(1, 1): 'ATS9462'}
+
+# Board objects that have been created, by (systemId, boardId), so that a master can
+# start the acquisition of its slaves:
+opened = {}
+
+
+def getSDKVersion():
+    return (7, 2, 3)
+
+
+def getDriverVersion():
+    return (7, 2, 3)
+
+
+def numOfSystems():
+    return len(set(system_id for system_id, board_id in boards))
+
+
+def boardsInSystemBySystemID(sid):
+    return len([system_id for system_id, board_id in boards if system_id == sid])
+
+
+class Board(object):
+    """Simulated AlazarTech board, of the model given by `boards`"""
+
+    # Class attributes so that they can be set before the worker creates the board:
+    trigger_delay = 0.0
+    period = 1000
+    fifo_samples = 2 ** 20
+
+    def __init__(self, systemId=1, boardId=1):
+        if (systemId, boardId) not in boards:
+            raise Exception("Board %d.%d not found" % (systemId, boardId))
+        self.systemId = systemId
+        self.boardId = boardId
+        self.model = boards[systemId, boardId]
+        spec = models[self.model]
+        self.type = constants[self.model]
+        self.revision = (1, 5)
+        self.revision_string = '{:d}.{:d}'.format(*self.revision)
+        self.cpld_version = (25, 4)
+        self.cpld_version_string = '{:d}.{:d}'.format(*self.cpld_version)
+        self.num_channels = spec['num_channels']
+        self.memorysize_samples = spec['memorysize_samples']
+        self.bits_per_sample = spec['bits_per_sample']
+        self.bytes_per_sample = (self.bits_per_sample + 7) // 8
+        self.dtype = {1: np.uint8, 2: np.uint16}[self.bytes_per_sample]
+        self.serial_number = 940000 + 100 * systemId + boardId
+        self.pcie_link_speed = 0
+        self.pcie_link_width = 0
+        self.parameters = {}
+
+        self.sample_rate = 180e6
+        self.samples_per_record = 0
+        self.channels = []
+        self.armed = False
+        self.posted = deque()
+        self.trigger_time = None
+        self.buffers_posted = 0
+        self.buffers_completed = 0
+        self.aborted = threading.Event()
+
+        # Internal sample rates are given by ID:
+        self.internal_sample_rates = {}
+        for name, value in constants.items():
+            for units, multiplier in [('KSPS', 1e3), ('MSPS', 1e6)]:
+                if name.startswith('SAMPLE_RATE_') and name.endswith(units):
+                    rate = float(name[len('SAMPLE_RATE_') : -len(units)])
+                    self.internal_sample_rates[value] = rate * multiplier
+        opened[systemId, boardId] = self
+
+    def getBoardRevision(self):
+        return self.revision
+
+    def getCPLDVersion(self):
+        return self.cpld_version
+
+    def getChannelsPerBoard(self):
+        return self.num_channels
+
+    def getChannelInfo(self):
+        return self.memorysize_samples, self.bits_per_sample
+
+    def getPCIeStats(self):
+        return self.pcie_link_speed, self.pcie_link_width
+
+    def queryCapability(self, request):
+        capabilities = {
+            constants['GET_SERIAL_NUMBER']: self.serial_number,
+            constants['GET_LATEST_CAL_DATE']: 10119,
+            constants['GET_PCIE_LINK_SPEED']: self.pcie_link_speed,
+            constants['GET_PCIE_LINK_WIDTH']: self.pcie_link_width,
+        }
+        if request not in capabilities:
+            raise_error('AlazarQueryCapability', (self, request, 0), ApiFailed)
+        return capabilities[request]
+
+    def getParameter(self, channel, request):
+        if request == constants['GET_CHANNELS_PER_BOARD']:
+            return self.num_channels
+        return self.parameters.get((channel, request), 0)
+
+    def setParameter(self, channelId, parameterId, value):
+        self.parameters[channelId, parameterId] = value
+
+    setParameterUL = setParameter
+
+    def setCaptureClock(self, source, rate, edge, decimation):
+        if source == constants['INTERNAL_CLOCK']:
+            self.sample_rate = self.internal_sample_rates[rate]
+        elif source == constants['EXTERNAL_CLOCK_10MHz_REF']:
+            self.sample_rate = rate / (decimation + 1)
+        else:
+            raise NotImplementedError(source)
+
+    def beforeAsyncRead(
+        self,
+        channels,
+        transferOffset,
+        samplesPerRecord,
+        recordsPerBuffer,
+        recordsPerAcquisition,
+        flags,
+    ):
+        self.channels = [c for c in constants['channels'][: self.num_channels] if c & channels]
+        if len(self.channels) != bin(channels).count('1'):
+            raise_error(
+                'AlazarBeforeAsyncRead',
+                (self, channels, transferOffset, samplesPerRecord, recordsPerBuffer,
+                 recordsPerAcquisition, flags),
+                ApiFailed,
+            )
+        self.samples_per_record = samplesPerRecord * recordsPerBuffer
+        self.posted.clear()
+        self.trigger_time = None
+        self.buffers_posted = 0
+        self.buffers_completed = 0
+        self.aborted.clear()
+        self.armed = True
+
+    def postAsyncBuffer(self, buffer, bufferLength):
+        post_time = time.perf_counter()
+        if self.trigger_time is not None:
+            # The board can buffer fifo_samples before a buffer must be available:
+            deadline = self.trigger_time + (
+                self.buffers_posted * self.samples_per_record + self.fifo_samples
+            ) / self.sample_rate
+            if post_time > deadline:
+                raise_error('AlazarPostAsyncBuffer', (buffer, bufferLength), ApiBufferOverflow)
+        self.posted.append((buffer, bufferLength))
+        self.buffers_posted += 1
+
+    def startCapture(self):
+        if self.boardId != 1:
+            # Slaves are started by the master
+            return
+        trigger_time = time.perf_counter() + self.trigger_delay
+        for (system_id, board_id), board in opened.items():
+            if system_id == self.systemId and board.armed:
+                board.sample_rate = self.sample_rate
+                board.trigger_time = trigger_time
+                board.armed = False
+
+    def busy(self):
+        return self.trigger_time is not None
+
+    def triggered(self):
+        return self.trigger_time is not None and time.perf_counter() > self.trigger_time
+
+    def forceTrigger(self):
+        if self.trigger_time is not None:
+            self.trigger_time = min(self.trigger_time, time.perf_counter())
+
+    def completion_time(self, index):
+        return self.trigger_time + (index + 1) * self.samples_per_record / self.sample_rate
+
+    def expected_samples(self, channel, start, stop):
+        """The samples of the given channel (CHANNEL_A, CHANNEL_B, etc) that the board
+        acquires, from sample index start to stop"""
+        # One period of the waveform, repeated, as this is much faster than evaluating
+        # it at every sample:
+        index = constants['channels'].index(channel)
+        phase = 2 * np.pi * np.arange(self.period) / self.period
+        phase += index * np.pi / 2 + (self.boardId - 1) * np.pi / 4
+        half_scale = 2 ** (self.bits_per_sample - 1)
+        waveform = (half_scale + 30000 / 32768 * half_scale * np.sin(phase)).astype(self.dtype)
+        waveform <<= 8 * self.bytes_per_sample - self.bits_per_sample
+        return np.resize(np.roll(waveform, -(start % self.period)), stop - start)
+
+    def waitAsyncBufferComplete(self, buffer, timeout_ms):
+        arguments = (buffer, timeout_ms)
+        if not self.posted or self.posted[0][0] != buffer or self.trigger_time is None:
+            raise_error('AlazarWaitAsyncBufferComplete', arguments, ApiBufferNotReady)
+        delay = self.completion_time(self.buffers_completed) - time.perf_counter()
+        if delay > timeout_ms / 1000.0:
+            self.aborted.wait(timeout_ms / 1000.0)
+            raise_error('AlazarWaitAsyncBufferComplete', arguments, ApiWaitTimeout)
+        if delay > 0 and self.aborted.wait(delay):
+            raise_error('AlazarWaitAsyncBufferComplete', arguments, ApiBufferNotReady)
+        self.posted.popleft()
+        self.fill(DMABuffer.allocated[buffer])
+        self.buffers_completed += 1
+
+    def waitNextAsyncBufferComplete(self, buffer, bytes_to_copy, timeout_ms):
+        self.waitAsyncBufferComplete(buffer, timeout_ms)
+
+    def fill(self, dma_buffer):
+        """Fill a buffer with the next record, channels interleaved"""
+        start = self.buffers_completed * self.samples_per_record
+        stop = start + self.samples_per_record
+        data = dma_buffer.buffer.view(self.dtype)[: self.samples_per_record * len(self.channels)]
+        data = data.reshape(self.samples_per_record, len(self.channels))
+        for i, channel in enumerate(self.channels):
+            data[:, i] = self.expected_samples(channel, start, stop)
+
+    def abortAsyncRead(self):
+        self.aborted.set()
+        self.posted.clear()
+        self.trigger_time = None
+        self.armed = False
+
+    def abortCapture(self):
+        self.abortAsyncRead()
+
+    def _ignore(self, *args):
+        pass
+
+    setExternalTrigger = _ignore
+    setExternalClockLevel = _ignore
+    setTriggerOperation = _ignore
+    setTriggerDelay = _ignore
+    setTriggerTimeOut = _ignore
+    configureAuxIO = _ignore
+    inputControl = _ignore
+    inputControlEx = _ignore
+    setBWLimit = _ignore
+    setLED = _ignore
+    setRecordSize = _ignore
+    setRecordCount = _ignore
+    resetTimeStamp = _ignore
+
+
+constants = load_constants()
+
+
+def install():
+    """Make this module importable as labscript_devices.atsapi"""
+    module = types.ModuleType('labscript_devices.atsapi')
+    for name, value in constants.items():
+        if not name.startswith('__'):
+            setattr(module, name, value)
+    for name in [
+        'AlazarException',
+        'DMABuffer',
+        'Board',
+        'getSDKVersion',
+        'getDriverVersion',
+        'numOfSystems',
+        'boardsInSystemBySystemID',
+    ]:
+        setattr(module, name, globals()[name])
+    sys.modules['labscript_devices.atsapi'] = module
+    return module
@@ -0,0 +1,220 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/testing/fake_daqmx.py                          #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""A simulated wait monitor, in place of PyDAQmx, so that NI_DAQmxWaitMonitorWorker can
+be exercised without a DAQmx device.
+
+Call install() before importing labscript_devices.NI_DAQmx.blacs_workers. Only the
+Task methods used by the wait monitor worker are implemented: a counter input task with
+a semiperiod channel reads the wait monitor signal, and writes to a digital output task
+are the timeout trigger. Since the worker determines whether a device has incomplete
+sample detection by measuring a pulse, use incomplete_sample_detection() from this
+module in place of the one in daqmx_utils.py.
+
+The wait monitor signal is that of a master pseudoclock running the experiment
+configured in `wait_monitor`. Once started, it outputs a pulse of pulse_width seconds
+at the start of the experiment and at the end of each wait. The waits are at the
+labscript times in wait_times, and end retrigger_delays seconds after they begin, or,
+where the delay is None, when the timeout trigger fires with an edge of polarity
+timeout_trigger_type. The times at which waits begin and end are given by
+wait_results(). Times are those of time.monotonic()."""
+
+import sys
+import time
+import types
+import ctypes
+
+__version__ = '1.4.6'
+
+DAQmx_Val_Seconds = 10364
+DAQmx_Val_ContSamps = 10123
+DAQmx_Val_ChanForAllLines = 1
+DAQmx_Val_GroupByChannel = 0
+DAQmxErrorSamplesNotYetAvailable = -200284
+
+int32 = ctypes.c_int32
+uInt32 = ctypes.c_uint32
+bool32 = ctypes.c_uint32
+
+
+class DAQError(Exception):
+    def __init__(self, error, mess, fname):
+        Exception.__init__(self, '%s in function %s' % (mess, fname))
+        self.error = error
+        self.mess = mess
+        self.fname = fname
+
+
+class SamplesNotYetAvailableError(DAQError):
+    pass
+
+
+class WaitMonitor(object):
+    """The simulated experiment producing the wait monitor signal"""
+
+    def __init__(self):
+        self.pulse_width = 1e-3
+        self.wait_times = []
+        self.retrigger_delays = []
+        self.timeout_trigger_type = 'rising'
+        self.incomplete_sample_detection = False
+        self.start_time = None
+        self.trigger_times = []
+
+    def start(self):
+        """Start the experiment now"""
+        self.trigger_times = []
+        self.start_time = time.monotonic()
+
+    def timeline(self):
+        """The times at which each wait begins and ends, as far as they are known"""
+        wait_starts = []
+        wait_ends = []
+        if self.start_time is None:
+            return wait_starts, wait_ends
+        resume_time = self.start_time
+        previous_wait_time = 0
+        for wait_time, delay in zip(self.wait_times, self.retrigger_delays):
+            wait_start = resume_time + wait_time - previous_wait_time
+            # Only trigger edges during the wait can end it:
+            candidates = [t for t in self.trigger_times if t >= wait_start]
+            if delay is not None:
+                candidates.append(wait_start + delay)
+            if not candidates:
+                # The wait has not yet ended, and it is not yet known when it will:
+                break
+            resume_time = min(candidates)
+            wait_starts.append(wait_start)
+            wait_ends.append(resume_time)
+            previous_wait_time = wait_time
+        return wait_starts, wait_ends
+
+    def wait_results(self):
+        """The times at which each completed wait began and ended"""
+        now = time.monotonic()
+        return [(start, end) for start, end in zip(*self.timeline()) if end <= now]
+
+    def edges(self, until):
+        """The times of the edges of the wait monitor signal up to the given time"""
+        if self.start_time is None:
+            return []
+        _, wait_ends = self.timeline()
+        edges = []
+        for pulse_time in [self.start_time] + wait_ends:
+            edges.extend([pulse_time, pulse_time + self.pulse_width])
+        return [t for t in edges if t <= until]
+
+
+wait_monitor = WaitMonitor()
+
+
+def incomplete_sample_detection(device_name):
+    return wait_monitor.incomplete_sample_detection
+
+
+class Task(object):
+    """A simulated counter input or digital output task"""
+
+    # Interval at which reads poll for samples:
+    poll_interval = 1e-4
+
+    def __init__(self):
+        self.channel_type = None
+        self.start_time = None
+        self.n_read = 0
+        self.level = None
+
+    def CreateCISemiPeriodChan(self, counter, *args):
+        self.channel_type = 'CI'
+
+    def CfgImplicitTiming(self, sampleMode, sampsPerChan):
+        pass
+
+    def StartTask(self):
+        self.start_time = time.monotonic()
+
+    def StopTask(self):
+        self.start_time = None
+
+    def ClearTask(self):
+        pass
+
+    def semiperiods(self, until):
+        """The semiperiods measured up to the given time, including the incomplete
+        sample from the start of the task to the first edge unless the device has
+        incomplete sample detection"""
+        # Only edges since the task started are counted:
+        edges = [t for t in wait_monitor.edges(until) if t >= self.start_time]
+        if not wait_monitor.incomplete_sample_detection:
+            edges = [self.start_time] + edges
+        return [t2 - t1 for t1, t2 in zip(edges[:-1], edges[1:])]
+
+    def ReadCounterF64(
+        self,
+        numSampsPerChan,
+        timeout,
+        readArray,
+        arraySizeInSamps,
+        sampsPerChanRead,
+        reserved,
+    ):
+        deadline = time.monotonic() + timeout if timeout >= 0 else float('inf')
+        while True:
+            semiperiods = self.semiperiods(time.monotonic())
+            if len(semiperiods) >= self.n_read + numSampsPerChan:
+                break
+            if time.monotonic() >= deadline:
+                msg = 'Some or all of the samples requested have not yet been acquired'
+                raise SamplesNotYetAvailableError(
+                    DAQmxErrorSamplesNotYetAvailable, msg, 'DAQmxReadCounterF64'
+                )
+            time.sleep(self.poll_interval)
+        readArray[:numSampsPerChan] = semiperiods[
+            self.n_read : self.n_read + numSampsPerChan
+        ]
+        self.n_read += numSampsPerChan
+        sampsPerChanRead.value = numSampsPerChan
+
+    def CreateDOChan(self, lines, nameToAssignToLines, lineGrouping):
+        self.channel_type = 'DO'
+
+    def WriteDigitalLines(
+        self,
+        numSampsPerChan,
+        autoStart,
+        timeout,
+        dataLayout,
+        writeArray,
+        sampsPerChanWritten,
+        reserved,
+    ):
+        level = int(writeArray[numSampsPerChan - 1])
+        trigger_level = 1 if wait_monitor.timeout_trigger_type == 'rising' else 0
+        if self.level is not None and level != self.level and level == trigger_level:
+            wait_monitor.trigger_times.append(time.monotonic())
+        self.level = level
+        sampsPerChanWritten.value = numSampsPerChan
+
+
+def install():
+    """Make this module importable as PyDAQmx and its submodules"""
+    module = types.ModuleType('PyDAQmx')
+    for name, value in globals().items():
+        if name.startswith('DAQmx') or name in ['int32', 'uInt32', 'bool32']:
+            setattr(module, name, value)
+    for name in ['__version__', 'Task', 'DAQError', 'SamplesNotYetAvailableError']:
+        setattr(module, name, globals()[name])
+    sys.modules['PyDAQmx'] = module
+    for submodule in ['DAQmxConstants', 'DAQmxTypes', 'DAQmxCallBack']:
+        sys.modules['PyDAQmx.' + submodule] = module
+        setattr(module, submodule, module)
+    return module
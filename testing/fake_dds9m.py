@@ -0,0 +1,266 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/testing/fake_dds9m.py                          #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""A simulated NovaTech DDS9m on a pseudoterminal, so that NovatechDDS9mWorker can be
+exercised without the device. Linux and macOS only.
+
+The serial port to connect to is FakeDDS9m.port. Only the subset of the DDS9m command
+set used by NovatechDDS9mWorker is implemented. Commands are processed one at a time,
+each taking the time to receive it at the current baud rate plus command_time. Each
+response is delivered `latency` seconds after it has been transmitted, modelling the
+round trip through a USB serial adapter. If input_buffer_size is given,
+commands arriving whilst more than that many bytes are waiting to be processed are
+lost, as in a real device whose input buffer overflows. With error_probability > 0,
+commands are randomly rejected with an error response instead of being executed, as if
+corrupted in transmission.
+
+The static values of each channel are in `static`, and the table in `table`, for
+comparison with what was programmed."""
+
+import os
+import pty
+import tty
+import time
+import select
+import threading
+from collections import deque
+
+import numpy as np
+
+# Number of table entries per channel:
+TABLE_SIZE = 16384
+
+# Bits per byte transmitted, including start and stop bits:
+BITS_PER_BYTE = 10
+
+ERROR_UNRECOGNISED_COMMAND = b'?0'
+ERROR_BAD_FREQUENCY = b'?1'
+ERROR_BAD_PHASE = b'?4'
+ERROR_BAD_TIME = b'?5'
+ERROR_BAD_MODE = b'?6'
+ERROR_BAD_AMPLITUDE = b'?7'
+
+
+class CommandError(Exception):
+    """Raised by command handlers to send an error response"""
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class FakeDDS9m(object):
+    table_dtype = [('freq', np.uint32), ('phase', np.uint16), ('amp', np.uint16)]
+
+    def __init__(
+        self,
+        baud_rate=19200,
+        latency=1e-3,
+        command_time=50e-6,
+        input_buffer_size=None,
+        error_probability=0.0,
+        seed=None,
+    ):
+        self.baud_rate = baud_rate
+        self.latency = latency
+        self.command_time = command_time
+        self.input_buffer_size = input_buffer_size
+        self.error_probability = error_probability
+        self.random = np.random.RandomState(seed)
+
+        self.echo = True
+        self.mode = b'm 0'
+        self.update_mode = b'I a'
+        self.static = [{'freq': 0.0, 'phase': 0, 'amp': 0} for _ in range(4)]
+        self.table = np.zeros((2, TABLE_SIZE), dtype=self.table_dtype)
+
+        self.n_commands = 0
+        self.n_errors_injected = 0
+        self.n_overruns = 0
+
+        # Time at which the device will have finished processing all commands
+        # received so far:
+        self.busy_until = 0.0
+        # Responses not yet delivered, as (due_time, data) tuples in order:
+        self.responses = deque()
+        self.responses_condition = threading.Condition()
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.stopping = False
+        self.reader = threading.Thread(target=self.reader_loop, daemon=True)
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self.reader.start()
+        self.writer.start()
+
+    def transmission_time(self, n_bytes):
+        return n_bytes * BITS_PER_BYTE / self.baud_rate
+
+    def reader_loop(self):
+        buffer = b''
+        while not self.stopping:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                buffer += os.read(self.master, 4096)
+            except OSError:
+                return
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                # Commands are terminated by CR, optionally followed by LF:
+                if buffer.startswith(b'\n'):
+                    buffer = buffer[1:]
+                self.receive(line)
+
+    def receive(self, line):
+        now = time.perf_counter()
+        if self.input_buffer_size is not None:
+            n_waiting = max(self.busy_until - now, 0) * self.baud_rate / BITS_PER_BYTE
+            if n_waiting + len(line) + 2 > self.input_buffer_size:
+                self.n_overruns += 1
+                return
+        self.n_commands += 1
+        echo = self.echo
+        response = self.execute(line)
+        if echo:
+            response = line + b'\r\n' + response
+        # Commands and responses are transmitted in opposite directions at the same
+        # time, so only receiving the command occupies the device:
+        receive_time = self.transmission_time(len(line) + 2)
+        self.busy_until = max(self.busy_until, now) + receive_time + self.command_time
+        due_time = self.busy_until + self.transmission_time(len(response)) + self.latency
+        with self.responses_condition:
+            self.responses.append((due_time, response))
+            self.responses_condition.notify()
+
+    def writer_loop(self):
+        while True:
+            with self.responses_condition:
+                while not self.responses and not self.stopping:
+                    self.responses_condition.wait()
+                if self.stopping:
+                    return
+                due_time, response = self.responses.popleft()
+            delay = due_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                os.write(self.master, response)
+            except OSError:
+                return
+
+    def execute(self, line):
+        """Execute a command and return the response"""
+        command = line.strip()
+        if command and self.random.random_sample() < self.error_probability:
+            self.n_errors_injected += 1
+            return ERROR_UNRECOGNISED_COMMAND + b'\r\n'
+        try:
+            response = self.handle(command)
+        except CommandError as e:
+            return e.code + b'\r\n'
+        return response + b'OK\r\n'
+
+    def handle(self, command):
+        if not command:
+            return b''
+        if command == b'e d':
+            self.echo = False
+        elif command == b'e e':
+            self.echo = True
+        elif command in (b'I a', b'I e', b'I p'):
+            self.update_mode = command
+        elif command in (b'm 0', b'm a', b'm n', b'm t'):
+            self.mode = command
+        elif command.startswith(b'Kb '):
+            self.baud_rate = 1152000 // self.parse_int(command[3:], 16, 1, 0xFF)
+        elif command == b'QUE':
+            return self.query()
+        elif command[:1] in (b'F', b'V', b'P'):
+            self.set_static(command)
+        elif command[:1] == b't':
+            self.set_table_entry(command)
+        else:
+            raise CommandError(ERROR_UNRECOGNISED_COMMAND)
+        return b''
+
+    def parse_int(self, text, base, minimum, maximum, error=ERROR_UNRECOGNISED_COMMAND):
+        try:
+            value = int(text, base)
+        except ValueError:
+            raise CommandError(error)
+        if not minimum <= value <= maximum:
+            raise CommandError(error)
+        return value
+
+    def set_static(self, command):
+        try:
+            channel, value = command[1:].split()
+        except ValueError:
+            raise CommandError(ERROR_UNRECOGNISED_COMMAND)
+        channel = self.parse_int(channel, 10, 0, 3)
+        if command[:1] == b'F':
+            try:
+                freq = float(value)
+            except ValueError:
+                raise CommandError(ERROR_BAD_FREQUENCY)
+            if not 0 <= freq <= 171:
+                raise CommandError(ERROR_BAD_FREQUENCY)
+            self.static[channel]['freq'] = freq
+        elif command[:1] == b'V':
+            self.static[channel]['amp'] = self.parse_int(
+                value, 10, 0, 1023, ERROR_BAD_AMPLITUDE
+            )
+        else:
+            self.static[channel]['phase'] = self.parse_int(
+                value, 10, 0, 16383, ERROR_BAD_PHASE
+            )
+
+    def set_table_entry(self, command):
+        try:
+            channel, address, values = command[1:].split()
+            freq, phase, amp, flags = values.split(b',')
+        except ValueError:
+            raise CommandError(ERROR_UNRECOGNISED_COMMAND)
+        channel = self.parse_int(channel, 10, 0, 1)
+        address = self.parse_int(address, 16, 0, TABLE_SIZE - 1)
+        entry = self.table[channel, address]
+        entry['freq'] = self.parse_int(freq, 16, 0, 1710000000, ERROR_BAD_FREQUENCY)
+        entry['phase'] = self.parse_int(phase, 16, 0, 16383, ERROR_BAD_PHASE)
+        entry['amp'] = self.parse_int(amp, 16, 0, 1023, ERROR_BAD_AMPLITUDE)
+        self.parse_int(flags, 16, 0, 0xFF, ERROR_BAD_TIME)
+
+    def query(self):
+        lines = []
+        for channel in range(4):
+            values = self.static[channel]
+            if channel < 2 and self.mode == b'm t':
+                values = self.table[channel, 0]
+                freq = int(values['freq'])
+            else:
+                freq = int(round(values['freq'] * 1e7))
+            lines.append(
+                b'%08x %04x %04x 0000 0000 0000 0000\r\n'
+                % (freq, int(values['phase']), int(values['amp']))
+            )
+        return b''.join(lines)
+
+    def close(self):
+        self.stopping = True
+        with self.responses_condition:
+            self.responses_condition.notify()
+        self.reader.join()
+        self.writer.join()
+        os.close(self.master)
+        os.close(self.slave)
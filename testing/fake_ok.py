@@ -0,0 +1,236 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/testing/fake_ok.py                             #
+#                                                                   #
+# Copyright 2019, Monash University and contributors                #
+#                                                                   #
+# This file is part of labscript_devices, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""A simulated Opal Kelly XEM3001 running the Cicero pseudoclock firmware, in place of
+the Opal Kelly FrontPanel `ok` module, so that CiceroOpalKellyXEM3001Worker can be
+exercised without an FPGA.
+
+Call install() before the worker imports `ok`. Only the subset of okCFrontPanel used by
+the worker is implemented. Writes to the pipe at PIPE_IN_ADDR take `latency` seconds
+plus the time to transfer the data at `pipe_rate` bytes per second, as over USB, and
+are stored in `instructions`. The number of pipe writes and bytes written are counted
+in n_pipe_writes and n_pipe_bytes.
+
+Once started with the trigger in, the program held is run in real time with a reference
+clock of clock_frequency, until an instruction of all zeros or the end of the last data
+written. Instructions with reps of zero are waits, which are retriggered after the
+durations in `wait_durations`, in seconds, or time out. UpdateWireOuts() latches the
+counters the worker reads: the number of samples generated outside of waits, the number
+of samples spent in waits, the number of waits that timed out, and the status bits for
+finished and aborted. Like those of the real FPGA, these are 32-bit counters. The times
+at which waits finished and their durations in samples are given by wait_results()."""
+
+import sys
+import time
+import types
+
+import numpy as np
+
+PIPE_IN_ADDR = 0x80
+TRIGGER_IN_ADDR = 0x40
+WIRE_OUT_MASTER_SAMPLES = 0x22
+WIRE_OUT_TIMEOUT_COUNT = 0x24
+WIRE_OUT_STATUS = 0x25
+WIRE_OUT_WAIT_SAMPLES = 0x26
+
+STATUS_FINISHED = 1
+STATUS_ABORTED = 2
+
+# Bytes per instruction, and the number of instructions the FPGA can hold:
+INSTRUCTION_SIZE = 16
+MAX_INSTRUCTIONS = 2048
+
+
+def bytearray_to_pulse_program(data):
+    """Decode data written to the FPGA into a PULSE_PROGRAM table, the inverse of
+    pulse_program_to_bytearray(). The 48-bit periods are unsigned."""
+    words = np.frombuffer(bytes(data), dtype='<u2').reshape(-1, 8).astype(np.int64)
+    dtypes = [('on_period', np.int64), ('off_period', np.int64), ('reps', np.int64)]
+    pulse_program = np.zeros(len(words), dtype=dtypes)
+    pulse_program['on_period'] = (words[:, 0] << 32) | (words[:, 1] << 16) | words[:, 2]
+    pulse_program['off_period'] = (words[:, 3] << 32) | (words[:, 4] << 16) | words[:, 5]
+    pulse_program['reps'] = (words[:, 6] << 16) | words[:, 7]
+    return pulse_program
+
+
+class okCFrontPanel(object):
+    """Simulated XEM3001 with the Cicero firmware loaded"""
+
+    NoError = 0
+    DeviceNotOpen = -8
+
+    # Class attributes so that they can be set before the worker creates the device:
+    serials = ['fake-xem3001']
+    # Whether the firmware is already loaded, so that the worker need not flash it:
+    configured = True
+    latency = 1e-3
+    pipe_rate = 30e6
+    clock_frequency = 100e6
+    wait_durations = []
+
+    def __init__(self):
+        self.serial = None
+        self.front_panel_enabled = self.configured
+        self.instructions = bytearray(INSTRUCTION_SIZE * MAX_INSTRUCTIONS)
+        self.wire_ins = {}
+        self.pending_wire_ins = {}
+        self.wire_outs = {WIRE_OUT_STATUS: 0}
+        self.n_instructions_written = 0
+        self.start_time = None
+        self.status = 0
+        self.n_pipe_writes = 0
+        self.n_pipe_bytes = 0
+
+    def OpenBySerial(self, serial=''):
+        if isinstance(serial, bytes):
+            serial = serial.decode()
+        if serial not in self.serials and serial != '':
+            return self.DeviceNotOpen
+        self.serial = serial
+        return self.NoError
+
+    def IsFrontPanelEnabled(self):
+        return self.front_panel_enabled
+
+    def ConfigureFPGA(self, path):
+        self.front_panel_enabled = True
+        self.instructions[:] = bytes(len(self.instructions))
+        return self.NoError
+
+    def SetWireInValue(self, addr, value, mask=0xFFFFFFFF):
+        self.pending_wire_ins[addr] = value & mask
+        return self.NoError
+
+    def UpdateWireIns(self):
+        time.sleep(self.latency)
+        self.wire_ins.update(self.pending_wire_ins)
+        self.pending_wire_ins = {}
+
+    def UpdateWireOuts(self):
+        time.sleep(self.latency)
+        master_samples, wait_samples, timeout_count = 0, 0, 0
+        if self.start_time is not None:
+            master_samples, wait_samples, timeout_count, finished = self.counters(
+                time.perf_counter() - self.start_time
+            )
+            if finished:
+                self.status |= STATUS_FINISHED
+        for addr, value in [
+            (WIRE_OUT_MASTER_SAMPLES, master_samples),
+            (WIRE_OUT_WAIT_SAMPLES, wait_samples),
+        ]:
+            value &= 0xFFFFFFFF
+            self.wire_outs[addr] = value & 0xFFFF
+            self.wire_outs[addr + 1] = value >> 16
+        self.wire_outs[WIRE_OUT_TIMEOUT_COUNT] = timeout_count & 0xFFFF
+        self.wire_outs[WIRE_OUT_STATUS] = self.status
+
+    def GetWireOutValue(self, addr):
+        return self.wire_outs.get(addr, 0)
+
+    def ActivateTriggerIn(self, addr, bit):
+        time.sleep(self.latency)
+        if addr == TRIGGER_IN_ADDR:
+            # Bit 0 starts the state machine, bit 1 aborts it:
+            if bit == 0:
+                self.start()
+            elif self.start_time is not None and not self.status & STATUS_FINISHED:
+                self.start_time = None
+                self.status = STATUS_ABORTED
+        return self.NoError
+
+    def WriteToPipeIn(self, addr, data):
+        time.sleep(self.latency + len(data) / self.pipe_rate)
+        if addr == PIPE_IN_ADDR:
+            self.instructions[: len(data)] = data
+            self.n_instructions_written = len(data) // INSTRUCTION_SIZE
+        self.n_pipe_writes += 1
+        self.n_pipe_bytes += len(data)
+        return len(data)
+
+    def start(self):
+        """Work out the timeline of the program held, and start running it"""
+        pulse_program = self.pulse_program(self.n_instructions_written)
+        stops = np.where(
+            (pulse_program['on_period'] == 0)
+            & (pulse_program['off_period'] == 0)
+            & (pulse_program['reps'] == 0)
+        )[0]
+        if len(stops):
+            pulse_program = pulse_program[: stops[0]]
+        waits = pulse_program['reps'] == 0
+        # Samples spent in each instruction, as run or wait samples:
+        run_samples = pulse_program['reps'] * (
+            pulse_program['on_period'] + pulse_program['off_period']
+        )
+        run_samples[waits] = 0
+        # A wait times out after on_period + 1 samples:
+        timeout_samples = pulse_program['on_period'][waits] + 1
+        triggered_samples = np.full(len(timeout_samples), np.iinfo(np.int64).max)
+        durations = np.array(self.wait_durations[: len(timeout_samples)], dtype=float)
+        triggered_samples[: len(durations)] = np.round(durations * self.clock_frequency)
+        wait_samples = np.zeros(len(pulse_program), dtype=np.int64)
+        wait_samples[waits] = np.minimum(triggered_samples, timeout_samples)
+        self.timed_out = np.zeros(len(pulse_program), dtype=bool)
+        self.timed_out[waits] = triggered_samples >= timeout_samples
+        self.is_wait = waits
+        self.run_samples = run_samples
+        self.wait_samples = wait_samples
+        # Cumulative totals at the end of each instruction:
+        self.instruction_end = np.cumsum(run_samples + wait_samples)
+        self.run_samples_end = np.cumsum(run_samples)
+        self.wait_samples_end = np.cumsum(wait_samples)
+        self.timeouts_end = np.cumsum(self.timed_out)
+        self.status = 0
+        self.start_time = time.perf_counter()
+
+    def counters(self, elapsed):
+        """The samples generated outside of waits, samples in waits, number of waits
+        timed out, and whether the program has finished, the given time in seconds
+        after it was started"""
+        samples = int(elapsed * self.clock_frequency)
+        # The number of instructions completed:
+        i = np.searchsorted(self.instruction_end, samples, side='right')
+        if i == 0:
+            previous_end = master_samples = wait_samples = timeout_count = 0
+        else:
+            previous_end = self.instruction_end[i - 1]
+            master_samples = self.run_samples_end[i - 1]
+            wait_samples = self.wait_samples_end[i - 1]
+            timeout_count = self.timeouts_end[i - 1]
+        finished = i == len(self.instruction_end)
+        # Count the samples of the instruction in progress:
+        if not finished and self.is_wait[i]:
+            wait_samples += samples - previous_end
+        elif not finished:
+            master_samples += samples - previous_end
+        return int(master_samples), int(wait_samples), int(timeout_count), finished
+
+    def wait_results(self):
+        """The perf_counter() times at which each wait of the running program ends, and
+        their durations in samples"""
+        end_times = self.start_time + self.instruction_end[self.is_wait] / self.clock_frequency
+        return end_times, self.wait_samples[self.is_wait]
+
+    def pulse_program(self, n_instructions):
+        """The first n_instructions held by the FPGA, as a PULSE_PROGRAM table"""
+        return bytearray_to_pulse_program(
+            self.instructions[: INSTRUCTION_SIZE * n_instructions]
+        )
+
+
+def install():
+    """Make this module importable as ok"""
+    module = types.ModuleType('ok')
+    module.okCFrontPanel = okCFrontPanel
+    sys.modules['ok'] = module
+    return module